@@ -0,0 +1,56 @@
+"""Access policy used by check_access.
+
+Every endpoint maps to one rule, worked out once by ``compile_rules`` after
+all routes are registered, so the per-request check is a dict lookup:
+
+    PUBLIC         no checks at all (token pages, static files, error pages)
+    ADMIN_OR_USER  admin_* views: a logged-in admin passes, anyone else
+                   needs the user checks below
+    USER           needs a Chrome User-Agent and a valid user token
+
+User-Agent strings repeat a lot, so their classification is cached.
+"""
+from cache import LRUCache
+
+PUBLIC = 'public'
+ADMIN_OR_USER = 'admin_or_user'
+USER = 'user'
+
+PUBLIC_ENDPOINTS = frozenset({
+    'generate_token', 'create_token', 'verify_token', 'admin_login', 'static',
+    'redirect_to_1dm', 'page_not_found', 'internal_server_error', 'admin_logout',
+})
+
+_rules = {}
+browser_cache = LRUCache(maxsize=1024)
+
+
+def rule_for_endpoint(endpoint):
+    if endpoint in PUBLIC_ENDPOINTS:
+        return PUBLIC
+    if endpoint and endpoint.startswith('admin_'):
+        return ADMIN_OR_USER
+    return USER
+
+
+def compile_rules(app):
+    """Build the endpoint -> rule table; call once every route is registered"""
+    _rules.clear()
+    for endpoint in app.view_functions:
+        _rules[endpoint] = rule_for_endpoint(endpoint)
+
+
+def rule(endpoint):
+    # Unmatched requests (endpoint None) and late routes fall back to the slow path
+    found = _rules.get(endpoint)
+    return found if found is not None else rule_for_endpoint(endpoint)
+
+
+def is_allowed_browser(user_agent):
+    """Sirf Chrome: True for Chrome, False for Edge, Opera, Brave and everything else"""
+    allowed = browser_cache.get(user_agent)
+    if allowed is None:
+        ua = user_agent.lower()
+        allowed = 'chrome' in ua and 'edg/' not in ua and 'opr/' not in ua and 'brave' not in ua
+        browser_cache.set(user_agent, allowed)
+    return allowed
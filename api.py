@@ -0,0 +1,201 @@
+"""Versioned JSON API (/api/v1).
+
+Lists use keyset pagination: each page returns ``next_cursor``, an opaque
+token to pass back as ``?cursor=`` for the following page (``null`` on the
+last page). Pages are streamed row by row, carry an ETag and Last-Modified
+derived from the data generation, and answer conditional GETs with 304.
+"""
+import base64
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+
+import database
+from database import FILE_URL, LIVE_LINK, URL_JOIN, get_batch, get_db, get_subject, search_contents
+from links import MEDIA_KINDS
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+CONTENT_TYPES = ('lecture', 'notes', 'dpp', 'solution', 'other')
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, *types):
+    """Decode a cursor into values of the given ``types`` (400 if it does not fit)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError('wrong cursor shape')
+        return [t(v) for t, v in zip(types, values)]
+    except (ValueError, TypeError):
+        abort(400, description='invalid cursor')
+
+
+def _limit():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400, description='limit must be an integer')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and since >= last_modified
+
+
+def paginated(sql, params, limit, row_to_dict, cursor_of, live_at=None):
+    """Stream one page of ``sql`` as ``{"data": [...], "next_cursor": ...}``.
+
+    ``sql`` must be keyset-ordered and end in ``LIMIT ?``; one extra row is
+    fetched to tell whether another page follows. Pass the ``live_at`` the
+    query filters link expiry by, so cached copies expire with it.
+    """
+    # The generation and the page come from one read transaction: a publish
+    # landing between the two would tag new rows with the old ETag. The
+    # transaction lasts while the page streams; release_db ends it.
+    conn = get_db()
+    conn.execute("BEGIN")
+    generation, updated_at = conn.execute(
+        "SELECT generation, updated_at FROM data_generation WHERE id = 1").fetchone()
+    if live_at is not None:
+        updated_at = max(updated_at, live_at - database.EXPIRY_CHECK_INTERVAL)
+    last_modified = datetime.fromtimestamp(updated_at, timezone.utc)
+    etag = hashlib.sha1(repr((request.full_path, generation, live_at)).encode()).hexdigest()
+
+    if _not_modified(etag, last_modified):
+        conn.rollback()
+        response = Response(status=304)
+    else:
+        c = conn.execute(sql, params + (limit + 1,))
+
+        def generate():
+            yield '{"data":['
+            last = None
+            for n, row in enumerate(c):
+                if n == limit:
+                    yield '],"next_cursor":%s}' % json.dumps(encode_cursor(cursor_of(last)))
+                    return
+                yield (',' if n else '') + json.dumps(row_to_dict(row), separators=(',', ':'))
+                last = row
+            yield '],"next_cursor":null}'
+
+        response = Response(stream_with_context(generate()), mimetype='application/json')
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def api_error(e):
+    return jsonify({'error': e.description}), e.code
+
+
+@api.route('/batches')
+def batches():
+    limit = _limit()
+    after = request.args.get('cursor')
+    if after:
+        sql = ("SELECT batch_id, title, description, created_at FROM batches "
+               "WHERE published = 1 AND batch_id > ? ORDER BY batch_id LIMIT ?")
+        params = tuple(decode_cursor(after, str))
+    else:
+        sql = ("SELECT batch_id, title, description, created_at FROM batches "
+               "WHERE published = 1 ORDER BY batch_id LIMIT ?")
+        params = ()
+    return paginated(sql, params, limit, dict, lambda row: [row['batch_id']])
+
+
+@api.route('/batches/<batch_id>/subjects')
+def batch_subjects(batch_id):
+    if not get_batch(batch_id):
+        abort(404, description='batch not found')
+    limit = _limit()
+    after = request.args.get('cursor')
+    last_id = decode_cursor(after, int)[0] if after else 0
+    sql = ("SELECT subject_id, batch_id, name FROM subjects "
+           "WHERE batch_id = ? AND subject_id > ? ORDER BY subject_id LIMIT ?")
+    return paginated(sql, (batch_id, last_id), limit, dict, lambda row: [row['subject_id']])
+
+
+@api.route('/subjects/<int:subject_id>/contents')
+def subject_contents(subject_id):
+    if not get_subject(subject_id):
+        abort(404, description='subject not found')
+    limit = _limit()
+    after = request.args.get('cursor')
+    content_type = request.args.get('type')
+    select = ("SELECT c.content_id, c.content_type, c.title, " + FILE_URL + " AS file_url, "
+              "c.media_kind, p.host, c.expires_at FROM contents c " + URL_JOIN)
+
+    # ?kind=hls|dash|mp4|pdf, and ?live=1 for only links that still work
+    filters = ""
+    filter_params = ()
+    kind = request.args.get('kind')
+    if kind:
+        kinds = [name for _, name in MEDIA_KINDS]
+        if kind not in kinds:
+            abort(400, description='kind must be one of: ' + ', '.join(kinds))
+        filters += " AND c.media_kind = ?"
+        filter_params += (kind,)
+    live_at = None
+    if request.args.get('live') == '1':
+        live_at = database.link_clock()
+        filters += " AND " + LIVE_LINK
+        filter_params += (live_at,)
+
+    if content_type:
+        if content_type not in CONTENT_TYPES:
+            abort(400, description='type must be one of: ' + ', '.join(CONTENT_TYPES))
+        last_id = decode_cursor(after, int)[0] if after else 0
+        sql = (select +
+               " WHERE c.subject_id = ? AND c.content_type = ? AND c.content_id > ?" + filters +
+               " ORDER BY c.content_id LIMIT ?")
+        params = (subject_id, content_type, last_id) + filter_params
+        cursor_of = lambda row: [row['content_id']]
+    else:
+        # Same order as the subject page; walks idx_contents_subject_type
+        last_type, last_id = decode_cursor(after, str, int) if after else ('', 0)
+        sql = (select +
+               " WHERE c.subject_id = ? AND (c.content_type, c.content_id) > (?, ?)" + filters +
+               " ORDER BY c.content_type, c.content_id LIMIT ?")
+        params = (subject_id, last_type, last_id) + filter_params
+        cursor_of = lambda row: [row['content_type'], row['content_id']]
+
+    return paginated(sql, params, limit, dict, cursor_of, live_at)
+
+
+@api.route('/search')
+def search():
+    """Ranked search; paginated by ``page`` since rank order has no stable key"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        abort(400, description='q is required')
+    content_type = request.args.get('type') or None
+    if content_type and content_type not in CONTENT_TYPES:
+        abort(400, description='type must be one of: ' + ', '.join(CONTENT_TYPES))
+    limit = _limit()
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    rows = search_contents(q, content_type, request.args.get('batch_id') or None,
+                           limit=limit + 1, offset=(page - 1) * limit)
+    return jsonify({
+        'data': [dict(row) for row in rows[:limit]],
+        'page': page,
+        'next_page': page + 1 if len(rows) > limit else None,
+    })
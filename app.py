@@ -1,34 +1,86 @@
-from flask import Flask, render_template, send_from_directory, request, redirect, url_for, session, flash, jsonify
-import sqlite3
+from flask import Flask, render_template, send_from_directory, request, redirect, url_for, session, flash, jsonify, make_response, abort
 import os
+import posixpath
+import hashlib
+from functools import wraps
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import get_input_stream
 import secrets
-from datetime import datetime, timedelta
-import json
-import traceback
+import shutil
+import time
+from datetime import datetime
+import logging
+import re
+import zipfile
 
+import database
 from database import (
     init_db,
-    add_batch,
-    add_subject,
-    add_content,
+    delete_batch,
     get_all_batches,
     get_batch,
+    get_subject,
     get_subjects,
-    get_contents
+    get_contents_page,
+    get_subject_sections,
+    get_content_counts,
+    get_expiring_batches,
+    link_clock,
+    search_contents
 )
+from ingest import ingest_file
+import jobs
+import metrics
+import profiling
+import compress
+import assets
+import access
+import export
+from api import api
+from cache import LRUCache
 
 # Initialize Flask app
-app = Flask(__name__)
+# static_folder=None: /static is served by static_files below (see assets.py)
+app = Flask(__name__, static_folder=None)
 app.secret_key = 'your_very_secret_key_here_123'
 
 # Configuration
 app.config['DATABASE'] = 'pw_data.db'
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['ALLOWED_EXTENSIONS'] = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+app.config['UPLOAD_FOLDER'] = 'uploads'  # queued upload files; kept out of static/ so they are not public
+app.config['ARCHIVE_FOLDER'] = os.environ.get('ARCHIVE_FOLDER', 'upload_archive')  # gzipped raw uploads, when asked for
+app.config['ALLOWED_EXTENSIONS'] = {'txt', 'zip', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+app.config['STREAM_UPLOAD_MAX_BYTES'] = 1024 * 1024 * 1024  # max body for /admin/upload/stream
+app.config['BUNDLE_MAX_BYTES'] = 256 * 1024 * 1024  # max unpacked size of an uploaded zip
+app.config['INGEST_PROCESSES'] = None  # parser processes for zip/multi-file uploads (default: one per core)
+app.config['PAGE_CACHE_SIZE'] = 256  # rendered batch/subject pages kept per worker
+app.config['SUBJECT_PAGE_SIZE'] = 24  # cards per section on the subject page and per "load more"
+app.config['HIDE_DEAD_LINKS'] = os.environ.get('HIDE_DEAD_LINKS', '1') != '0'  # leave expired links off subject pages
+app.config['EXPORT_DIR'] = os.environ.get('EXPORT_DIR')  # static HTML export, refreshed after uploads (see export.py)
+app.config['SITE_URL'] = os.environ.get('SITE_URL', 'http://localhost')  # base for absolute links in the export
+app.config['MINIFY_HTML'] = os.environ.get('MINIFY_HTML', '1') != '0'  # strip template indentation at load (see compress.py)
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))  # gzip level for HTML/JSON responses; 0 = off
+app.config['COMPRESS_BR_LEVEL'] = int(os.environ.get('COMPRESS_BR_LEVEL', 5))  # brotli quality, when brotli is installed
+app.config['COMPRESS_MIN_SIZE'] = 512  # smaller bodies are sent as they are
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')  # request profiles (see profiling.py)
+app.config['PROFILE_KEEP'] = 50  # profiles kept on disk; older ones are deleted
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'WARNING')  # DEBUG for per-request tracing
 TOKEN_EXPIRY_HOURS = 24
 
+# Logging: debug calls are filtered out before any message is formatted
+# (the level is LOG_LEVEL, set by configure_app)
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+log = logging.getLogger(__name__)
+
+# Metrics hooks go first so their timing covers check_access too
+metrics.init_app(app)
+profiling.init_app(app)
+compress.init_app(app)
+database.init_app(app)
+assets.init_app(app)
+app.register_blueprint(api)
+
 # Admin credentials
 ADMIN_CREDENTIALS = {
     'username': 'LB_HUB_1302_MERI_PYARI_WEBSITE',
@@ -40,85 +92,68 @@ def generate_user_token():
     """Generate a unique token for user"""
     try:
         token = secrets.token_urlsafe(32)
-        expiry = datetime.now() + timedelta(hours=TOKEN_EXPIRY_HOURS)
+        expiry = int(time.time()) + TOKEN_EXPIRY_HOURS * 3600
         
-        print(f"Generated token: {token[:10]}... expiry: {expiry}")
+        log.debug("Generated token: %s... expiry: %s", token[:10], expiry)
         
-        # Store token in session with expiry
+        # Store token in session with expiry (unix time, so checking it needs no parsing)
         session['user_token'] = token
-        session['token_expiry'] = expiry.isoformat()
-        
-        print(f"Session updated: token={session.get('user_token', 'None')[:10]}...")
+        session['token_expiry'] = expiry
         return token
     except Exception as e:
-        print(f"Error generating token: {str(e)}")
-        print(traceback.format_exc())
+        log.exception("Error generating token: %s", e)
         return None
 
 def is_token_valid():
     """Check if user has valid token"""
     try:
-        if 'user_token' not in session or 'token_expiry' not in session:
-            print("Token or expiry not in session")
+        sess = session._get_current_object()
+        expiry = sess.get('token_expiry')
+        if expiry is None or 'user_token' not in sess:
+            log.debug("Token or expiry not in session")
             return False
         
-        expiry = datetime.fromisoformat(session['token_expiry'])
-        is_valid = datetime.now() < expiry
-        print(f"Token validity check: {is_valid}, expires: {expiry}")
-        return is_valid
+        if isinstance(expiry, str):
+            # Sessions issued before expiry became unix time; convert once
+            expiry = int(datetime.fromisoformat(expiry).timestamp())
+            sess['token_expiry'] = expiry
+        
+        return time.time() < expiry
     except Exception as e:
-        print(f"Error checking token validity: {str(e)}")
+        log.warning("Error checking token validity: %s", e)
         return False
 
 def clear_expired_token():
     """Clear expired token from session"""
-    print("Clearing expired token...")
+    log.debug("Clearing expired token")
     session.pop('user_token', None)
     session.pop('token_expiry', None)
 
 @app.before_request
 def check_access():
-    print(f"📋 Checking access for: {request.endpoint}, path: {request.path}")
+    # Every attribute lookup through the request proxy costs a few microseconds
+    req = request._get_current_object()
     
-    # Skip token check for these endpoints and static files
-    skip_endpoints = ['generate_token', 'create_token', 'verify_token', 'admin_login', 
-                     'static', 'redirect_to_1dm', 'page_not_found', 'internal_server_error',
-                     'admin_logout']
-    
-    # Always allow static files
-    if request.path.startswith('/static/'):
-        print("📁 Allowing static file")
-        return None  # Explicitly return None for static files
-    
-    # Allow token-related and admin login pages
-    if request.endpoint in skip_endpoints:
-        print(f"✅ Skipping token check for: {request.endpoint}")
+    # Static files, token pages etc. are public (see access.py)
+    rule = access.rule(req.endpoint)
+    if rule is access.PUBLIC:
         return None
     
     # Allow admin routes if logged in
-    if request.endpoint and request.endpoint.startswith('admin_') and session.get('admin_logged_in'):
-        print(f"👨‍💼 Allowing admin route: {request.endpoint}")
+    if rule is access.ADMIN_OR_USER and session.get('admin_logged_in'):
         return None
     
     # Browser check - sirf Chrome allow karo
-    user_agent = request.headers.get('User-Agent', '').lower()
-    is_chrome = 'chrome' in user_agent
-    is_edge = 'edg/' in user_agent
-    is_opera = 'opr/' in user_agent
-    is_brave = 'brave' in user_agent
-    
-    if not is_chrome or is_edge or is_opera or is_brave:
-        print("🚫 Browser check failed, redirecting to Chrome")
+    if not access.is_allowed_browser(req.environ.get('HTTP_USER_AGENT', '')):
+        log.debug("Browser check failed for %s, redirecting to Chrome", req.path)
         return redirect("https://www.google.com/chrome/")
     
     # Check token for all other routes
-    print("🔐 Checking token validity...")
     if not is_token_valid():
-        print("❌ Token invalid, redirecting to generate token")
+        log.debug("Token invalid, redirecting to generate token")
         clear_expired_token()
         return redirect(url_for('generate_token'))
     
-    print("✅ Token is valid, proceeding...")
     return None  
 
 # Token routes
@@ -135,7 +170,7 @@ def generate_token():
             # Agar EarnLinks se aaya hai to token generate karo
             token = generate_user_token()
             if token:
-                expiry = datetime.fromisoformat(session['token_expiry'])
+                expiry = datetime.fromtimestamp(session['token_expiry'])
                 expiry_str = expiry.strftime('%d-%m-%Y %I:%M %p')
                 return render_template("token/success.html", token=token, expiry=expiry_str)
         
@@ -146,7 +181,7 @@ def generate_token():
     if request.method == "POST":
         token = generate_user_token()
         if token:
-            expiry = datetime.fromisoformat(session['token_expiry'])
+            expiry = datetime.fromtimestamp(session['token_expiry'])
             expiry_str = expiry.strftime('%d-%m-%Y %I:%M %p')
             return render_template("token/success.html", token=token, expiry=expiry_str)
         else:
@@ -154,39 +189,32 @@ def generate_token():
             return redirect(url_for('generate_token'))
 @app.route('/create-token', methods=['POST'])
 def create_token():
-    print("Create token route called")
     try:
         # Generate new token
         token = generate_user_token()
         
         if not token:
-            print("Failed to generate token")
             flash('Failed to generate token. Please try again.', 'danger')
             return redirect(url_for('generate_token'))
         
         # Get expiry time for display
-        expiry = datetime.fromisoformat(session['token_expiry'])
+        expiry = datetime.fromtimestamp(session['token_expiry'])
         expiry_str = expiry.strftime('%d-%m-%Y %I:%M %p')
         
-        print(f"Token created successfully, redirecting to success page")
         return render_template('token/success.html', 
                              token=token, 
                              expiry=expiry_str,
                              expiry_iso=expiry.isoformat())  # ISO format bhi send karo
     except Exception as e:
-        print(f"Error in create_token: {str(e)}")
-        print(traceback.format_exc())
+        log.exception("Error in create_token: %s", e)
         flash('Error generating token. Please try again.', 'danger')
         return redirect(url_for('generate_token'))
 
 @app.route('/verify-token')
 def verify_token():
-    print("Verify token route called")
     if is_token_valid():
-        print("Token is valid, redirecting to home")
         return redirect(url_for('home'))
     else:
-        print("Token is invalid, redirecting to generate")
         clear_expired_token()
         flash('Token expired or invalid. Please generate a new token.', 'danger')
         return redirect(url_for('generate_token'))
@@ -194,9 +222,7 @@ def verify_token():
 # Home route
 @app.route('/')
 def home():
-    print("Home route accessed")
     if not is_token_valid():
-        print("Direct access attempt without valid token, redirecting")
         return redirect(url_for('generate_token'))
     
     try:
@@ -206,7 +232,7 @@ def home():
         token_info = None
         if 'token_expiry' in session:
             try:
-                expiry = datetime.fromisoformat(session['token_expiry'])
+                expiry = datetime.fromtimestamp(session['token_expiry'])
                 time_left = expiry - datetime.now()
                 
                 # Convert timedelta to readable format
@@ -218,14 +244,12 @@ def home():
                     'expires_at': expiry.strftime('%d-%m-%Y %I:%M %p'),
                     'time_left': time_left_str
                 }
-                print(f"Token info: {token_info}")
             except Exception as e:
-                print(f"Error getting token info: {str(e)}")
+                log.warning("Error getting token info: %s", e)
         
         return render_template('index.html', batches=batches, token_info=token_info)
     except Exception as e:
-        print(f"Error in home route: {str(e)}")
-        print(traceback.format_exc())
+        log.exception("Error in home route: %s", e)
         return render_template('index.html', batches=[], token_info=None)
 
 # Debug route
@@ -248,6 +272,8 @@ def delete_batch_route(batch_id):
     
     try:
         delete_batch(batch_id)
+        # Take its pages out of the static export too
+        jobs.refresh_export_later(app)
         flash(f'Batch {batch_id} deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting batch: {str(e)}', 'danger')
@@ -260,134 +286,85 @@ def redirect_to_1dm():
     link = request.args.get("link")
     return render_template("redirect.html", file_url=link)
 
+# Rendered page cache, sized by configure_app
+page_cache = LRUCache()
+
+def _templates_digest():
+    """Changes whenever a template file or asset URL changes, so a deploy invalidates old ETags"""
+    digest = hashlib.sha1(assets.version().encode())
+    digest.update(b'minified' if app.config['MINIFY_HTML'] else b'')
+    for root, dirs, files in sorted(os.walk(os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+TEMPLATES_DIGEST = None   # set by configure_app
+
+def cached_page(view):
+    """Cache a read-only page per (url and query args, data generation, host, admin flag).
+
+    The ETag is derived from that key, so If-None-Match is answered with 304
+    before the view runs. Redirects (e.g. not found) are never cached.
+    """
+    @wraps(view)
+    def wrapper(**kwargs):
+        # An admin profiling this page wants the render, not a cache lookup
+        if profiling.skip_caches():
+            return view(**kwargs)
+        key = (
+            request.endpoint,
+            tuple(sorted(kwargs.items())),
+            request.query_string,
+            database.current_generation(),
+            request.host,
+            bool(session.get('admin_logged_in')),
+            TEMPLATES_DIGEST,
+            link_clock(),
+        )
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()
+        
+        # Weak comparison: compressed responses carry the ETag as W/"..."
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            body = page_cache.get(key)
+            if body is None:
+                rv = view(**kwargs)
+                if not isinstance(rv, str):
+                    return rv
+                body = rv.encode('utf-8')
+                page_cache.set(key, body)
+            response = make_response(body)
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return wrapper
+
 # Helper functions
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-# Delete existing batch and its dependencies
-def delete_batch(batch_id):
-    conn = sqlite3.connect(app.config['DATABASE'])
-    c = conn.cursor()
-    
-    # Delete contents associated with subjects
-    c.execute("SELECT subject_id FROM subjects WHERE batch_id = ?", (batch_id,))
-    subject_ids = [row[0] for row in c.fetchall()]
-    if subject_ids:
-        c.execute("DELETE FROM contents WHERE subject_id IN ({})".format(','.join('?' * len(subject_ids))), subject_ids)
-    
-    # Delete subjects
-    c.execute("DELETE FROM subjects WHERE batch_id = ?", (batch_id,))
-    
-    # Delete batch
-    c.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
-    
-    conn.commit()
-    conn.close()
-    print(f"Deleted batch and dependencies: {batch_id}")
+# Batch ids become file names in the export and must not contain the "~"
+# of the hidden ids replaced batches are built under (ingest._publish_batch)
+def valid_batch_id(batch_id):
+    return re.fullmatch(r'[A-Za-z0-9_]+', batch_id) is not None
 
 # Parse TXT file with overwrite logic
 def parse_txt(filepath, batch_id, batch_title):
-    success = False
     try:
-        # Check if batch exists and delete it
-        conn = sqlite3.connect(app.config['DATABASE'])
-        c = conn.cursor()
-        c.execute("SELECT batch_id FROM batches WHERE batch_id = ?", (batch_id,))
-        if c.fetchone():
-            delete_batch(batch_id)
-            print(f"Overwriting existing batch: {batch_id}")
-        conn.close()
-        
-        # Add new batch
-        try:
-            add_batch(batch_id, batch_title, description="")
-            print(f"Batch added successfully: {batch_id}, {batch_title}")
-        except sqlite3.IntegrityError as e:
-            print(f"Batch insertion failed: {batch_id} already exists or invalid data, Error: {str(e)}")
-            return False
-        
-        subjects = {}
-        current_subject = None
-        
-        with open(filepath, 'r', encoding='utf-8') as file:
-            for line_number, line in enumerate(file, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                
-                # Detect subject lines (format: "SubjectName - ")
-                if line.endswith(" -"):
-                    current_subject = line[:-2].strip()
-                    if current_subject:
-                        subjects[current_subject] = {
-                            "Lecture": [],
-                            "Notes": [],
-                            "DPP": [],
-                            "DPP Solution": [],
-                            "Other": []
-                        }
-                        try:
-                            subject_id = add_subject(batch_id, current_subject)
-                            subjects[current_subject]['id'] = subject_id
-                            print(f"Subject added: {current_subject}, ID: {subject_id}, Line: {line_number}")
-                        except Exception as e:
-                            print(f"Subject insertion failed: {current_subject}, Line: {line_number}, Error: {str(e)}")
-                            current_subject = None
-                    else:
-                        print(f"Empty subject name at line {line_number}")
-                    continue
-                
-                # Process content lines (format: "Title:URL")
-                if "http" in line and current_subject:
-                    try:
-                        title, url = line.split(":", 1)
-                        title = title.strip()
-                        url = url.strip()
-                        
-                        if not title or not url:
-                            print(f"Invalid title or URL at line {line_number}: {line}")
-                            continue
-                        
-                        # Validate URL (basic check)
-                        if not url.startswith(('http://', 'https://')):
-                            print(f"Invalid URL format at line {line_number}: {url}")
-                            continue
-                        
-                        # Classify content type
-                        content_type = "other"
-                        title_lower = title.lower()
-                        
-                        if any(ext in url.lower() for ext in ['.mp4', '.m3u8', '.mpd']):
-                            content_type = "lecture"
-                        elif "class notes" in title_lower:
-                            content_type = "notes"
-                        elif "dpp solution" in title_lower:
-                            content_type = "solution"
-                        elif "dpp" in title_lower:
-                            content_type = "dpp"
-                        
-                        try:
-                            add_content(subjects[current_subject]['id'], content_type, title, url)
-                            print(f"Content added: {title}, Type: {content_type}, URL: {url}, Line: {line_number}")
-                            subjects[current_subject][content_type.capitalize()].append({
-                                "title": title,
-                                "url": url
-                            })
-                        except Exception as e:
-                            print(f"Content insertion failed: {title}, Line: {line_number}, Error: {str(e)}")
-                            continue
-                    except ValueError as e:
-                        print(f"Error parsing line {line_number}: {line}, Error: {str(e)}")
-                        continue
-                elif "http" in line and not current_subject:
-                    print(f"Content line {line_number} ignored: No current subject - {line}")
-        
-        success = True
+        stats = ingest_file(filepath, batch_id, batch_title)
+        log.info("Batch %s ingested: %d subjects, %d contents from %d lines",
+                 batch_id, stats['subjects'], stats['contents'], stats['lines'])
+        return True
     except Exception as e:
-        print(f"Error processing file: {str(e)}, File: {filepath}, Stack trace: {str(e.__traceback__)}")
-    finally:
-        return success
+        log.exception("Error processing file: %s, File: %s", e, filepath)
+        return False
 
 # Admin Upload Route
 @app.route('/admin/upload', methods=['GET', 'POST'])
@@ -396,44 +373,47 @@ def upload_file():
         return redirect(url_for('admin_login'))
 
     if request.method == 'POST':
-        file = request.files['file']
-        batch_id = request.form['batch_id']
+        files = [f for f in request.files.getlist('file') if f and f.filename]
+        batch_id = request.form.get('batch_id', '').strip()
         title = request.form.get('title', '')
+        incremental = request.form.get('mode') == 'incremental'
         
-        print(f"Starting upload for batch: {batch_id}")
-        
-        if not file or file.filename == '':
+        if not files:
             flash('No file selected', 'danger')
             return redirect(request.url)
             
-        if not allowed_file(file.filename):
-            flash('Only TXT files are allowed', 'danger')
+        if not all(allowed_file(f.filename) for f in files):
+            flash('Only TXT or ZIP files are allowed', 'danger')
+            return redirect(request.url)
+        
+        # Several files or a zip: one batch per TXT file, parsed in parallel
+        if len(files) > 1 or files[0].filename.lower().endswith('.zip'):
+            return upload_bundle(files, incremental)
+        file = files[0]
+        
+        if not valid_batch_id(batch_id):
+            flash('Batch ID is required (letters, numbers and underscores only)', 'danger')
             return redirect(request.url)
             
         try:
-            # Save file
-            filename = secure_filename(file.filename)
+            # Save file (unique name, so queued jobs never overwrite each other's input)
+            filename = f"{secrets.token_hex(4)}_{secure_filename(file.filename)}"
             upload_folder = app.config['UPLOAD_FOLDER']
             os.makedirs(upload_folder, exist_ok=True)
             filepath = os.path.join(upload_folder, filename)
             file.save(filepath)
-            print(f"File saved to: {filepath}")
-            
-            # Process file
-            print("Starting file processing...")
-            if parse_txt(filepath, batch_id, title):
-                flash('Batch uploaded successfully! (Overwrote existing batch if any)', 'success')
-                print("File processed successfully")
-            else:
-                flash('Failed to process file content', 'danger')
-                print("File processing failed. Check logs for details.")
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+            log.debug("File saved to: %s", filepath)
             
+            # Parse in the background; the job endpoint reports progress
+            job = jobs.submit(app, filepath, batch_id, title, incremental)
+            log.info("Queued ingestion job %s for batch %s", job.id, batch_id)
+            if wants_json():
+                return jsonify(job.to_dict()), 202
+            flash(f'Upload queued as job {job.id}. The batch will appear once processing finishes.', 'success')
             return redirect(url_for('admin_dashboard'))
             
         except Exception as e:
-            print(f"Upload error: {str(e)}")
+            log.exception("Upload error: %s", e)
             flash(f'Error: {str(e)}', 'danger')
             if 'filepath' in locals() and os.path.exists(filepath):
                 os.remove(filepath)
@@ -441,30 +421,212 @@ def upload_file():
     
     return render_template('admin/upload.html')
 
+# Zip / multi-file uploads
+def bundle_entry(name, path=None, error=None):
+    """Job entry for one batch file; the batch id and title come from its name"""
+    stem = os.path.splitext(os.path.basename(name.replace('\\', '/')))[0]
+    batch_id = re.sub(r'[^A-Za-z0-9_]', '_', stem)
+    if error is None and not valid_batch_id(batch_id):
+        error = 'skipped: no batch id in the file name'
+    return {'file': name, 'path': path, 'batch_id': batch_id,
+            'title': stem.replace('_', ' ').strip(), 'error': error}
+
+def save_upload_part(source, upload_folder, name, budget):
+    """Copy ``source`` to a unique file, reading at most ``budget`` bytes; returns (path, size)"""
+    path = os.path.join(upload_folder, f"{secrets.token_hex(4)}_{secure_filename(os.path.basename(name)) or 'batch.txt'}")
+    size = 0
+    with open(path, 'wb') as out:
+        while True:
+            chunk = source.read(64 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > budget:
+                out.close()
+                os.remove(path)
+                raise ValueError('upload is larger than BUNDLE_MAX_BYTES unpacked')
+            out.write(chunk)
+    return path, size
+
+def claim_batch_id(entry, taken):
+    """Skip ``entry`` if an earlier file of the bundle maps to the same batch id
+    ("b two.txt" and "b-two.txt" both load b_two); returns True if it may load"""
+    first = taken.setdefault(entry['batch_id'], entry)
+    if first is not entry:
+        entry['error'] = f"skipped: same batch id ({entry['batch_id']}) as {first['file']}"
+    return first is entry
+
+def save_bundle(files, upload_folder):
+    """Save uploaded TXT files and the TXT members of uploaded zips; returns job entries"""
+    entries = []
+    taken = {}   # batch id -> entry that loads it
+    budget = app.config['BUNDLE_MAX_BYTES']
+    try:
+        for file in files:
+            if not file.filename.lower().endswith('.zip'):
+                entry = bundle_entry(file.filename)
+                entries.append(entry)
+                if claim_batch_id(entry, taken):
+                    entry['path'], size = save_upload_part(file.stream, upload_folder, file.filename, budget)
+                    budget -= size
+                continue
+            try:
+                archive = zipfile.ZipFile(file.stream)
+            except zipfile.BadZipFile:
+                entries.append(bundle_entry(file.filename, error='not a valid zip file'))
+                continue
+            with archive:
+                for member in archive.infolist():
+                    # Folders and macOS resource-fork junk
+                    if member.is_dir() or member.filename.startswith('__MACOSX/') \
+                            or os.path.basename(member.filename).startswith('.'):
+                        continue
+                    name = f"{file.filename}/{member.filename}"
+                    if not member.filename.lower().endswith('.txt'):
+                        entries.append(bundle_entry(name, error='skipped: not a .txt file'))
+                        continue
+                    entry = bundle_entry(name)
+                    entries.append(entry)
+                    if claim_batch_id(entry, taken):
+                        with archive.open(member) as source:
+                            entry['path'], size = save_upload_part(source, upload_folder, member.filename, budget)
+                        budget -= size
+    except BaseException:
+        for entry in entries:
+            if entry['path'] and os.path.exists(entry['path']):
+                os.remove(entry['path'])
+        raise
+    return entries
+
+def upload_bundle(files, incremental):
+    try:
+        upload_folder = app.config['UPLOAD_FOLDER']
+        os.makedirs(upload_folder, exist_ok=True)
+        entries = save_bundle(files, upload_folder)
+    except Exception as e:
+        log.exception("Upload error: %s", e)
+        flash(f'Error: {str(e)}', 'danger')
+        return redirect(request.url)
+    if not any(entry['path'] for entry in entries):
+        flash('No TXT batch files found in the upload', 'danger')
+        return redirect(request.url)
+    
+    job = jobs.submit_bundle(app, entries, incremental)
+    log.info("Queued bundle job %s with %d files", job.id, len(entries))
+    if wants_json():
+        return jsonify(job.to_dict()), 202
+    flash(f'{len(entries)} files queued as job {job.id}. Each batch will appear once it is processed.', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+# Streaming upload: the request body is the TXT file itself, parsed by its
+# job as it arrives (jobs.submit_stream) rather than saved first. The 202
+# comes once the body is in. MAX_CONTENT_LENGTH does not apply;
+# STREAM_UPLOAD_MAX_BYTES does. An existing batch is replaced unless
+# mode=incremental is given.
+#   curl --data-binary @batch.txt -H 'Content-Type: text/plain' \
+#        '.../admin/upload/stream?batch_id=NEET_2024&title=NEET+2024&archive=1'
+@app.route('/admin/upload/stream', methods=['POST'])
+def admin_upload_stream():
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'login required'}), 401
+    
+    batch_id = request.args.get('batch_id', '').strip()
+    title = request.args.get('title', '')
+    incremental = request.args.get('mode') == 'incremental'
+    if not valid_batch_id(batch_id):
+        return jsonify({'error': 'batch_id is required (letters, numbers and underscores only)'}), 400
+    
+    # Only with archive=1 is the body kept, gzipped as it arrives; the job
+    # moves the .gz into ARCHIVE_FOLDER once the batch is in
+    archive_path = None
+    if request.args.get('archive') in ('1', 'on', 'true'):
+        archive_path = os.path.join(app.config['ARCHIVE_FOLDER'],
+                                    f"{batch_id}_{time.strftime('%Y%m%d-%H%M%S')}.txt.gz")
+    
+    job, sink = jobs.submit_stream(app, batch_id, title, incremental, archive_path)
+    try:
+        # An exception leaving the block fails the job instead of loading part of the batch
+        with sink:
+            # Read wsgi.input directly: request.stream would enforce MAX_CONTENT_LENGTH
+            stream = get_input_stream(request.environ, max_content_length=app.config['STREAM_UPLOAD_MAX_BYTES'])
+            shutil.copyfileobj(stream, sink, 64 * 1024)
+    except HTTPException as e:   # too large, or the client went away
+        return jsonify({'error': e.description, 'job_id': job.id}), e.code
+    
+    log.info("Received streamed upload of batch %s for job %s", batch_id, job.id)
+    if request.args.get('notify'):
+        flash(f'Upload queued as job {job.id}. The batch will appear once processing finishes.', 'success')
+    return jsonify(job.to_dict()), 202
+
+# Ingestion job status
+@app.route('/admin/jobs/<job_id>')
+def admin_job_status(job_id):
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'login required'}), 401
+    
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(job)
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'login required'}), 401
+    
+    return jsonify(jobs.recent_jobs())
+
 # Subject details
+SUBJECT_SECTIONS = ('lecture', 'notes', 'dpp', 'solution')
+
+def live_at():
+    """Time subject pages check link expiry against, or None to show every link"""
+    return link_clock() if app.config['HIDE_DEAD_LINKS'] else None
+
+def subject_section(subject_id, content_type, after=0):
+    """One page of a subject section after the first: (items, url of the next page or None)"""
+    size = app.config['SUBJECT_PAGE_SIZE']
+    return _with_next_url(subject_id, content_type,
+                          get_contents_page(subject_id, content_type, after, size + 1, live_at()))
+
+def _with_next_url(subject_id, content_type, items):
+    # One extra row is fetched to tell whether another page follows
+    size = app.config['SUBJECT_PAGE_SIZE']
+    if len(items) <= size:
+        return items, None
+    items = items[:size]
+    next_url = url_for('subject_items', subject_id=subject_id, content_type=content_type,
+                       after=items[-1]['content_id'])
+    return items, next_url
+
 @app.route('/subject/<int:subject_id>')
+@cached_page
 def show_subject(subject_id):
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM subjects WHERE subject_id = ?', (subject_id,))
-    subject = cursor.fetchone()
+    subject = get_subject(subject_id)
     
     if not subject:
-        conn.close()
         flash('Subject not found!', 'danger')
         return redirect(url_for('home'))
     
-    # Get contents and categorize
-    contents = get_contents(subject_id)
-    lectures = [c for c in contents if c['content_type'] == 'lecture']
-    notes = [c for c in contents if c['content_type'] == 'notes']
-    dpps = [c for c in contents if c['content_type'] == 'dpp']
-    solutions = [c for c in contents if c['content_type'] == 'solution']
-    others = [c for c in contents if c['content_type'] == 'other']
+    # Only the first page of each section, in one query; the rest is fetched as the user scrolls
+    first_pages = get_subject_sections(subject_id, SUBJECT_SECTIONS, app.config['SUBJECT_PAGE_SIZE'] + 1, live_at())
+    sections = {content_type: _with_next_url(subject_id, content_type, rows)
+                for content_type, rows in first_pages.items()}
+    counts = get_content_counts(subject_id, live_at())
+    
+    return render_template('subject.html', subject=subject, sections=sections, counts=counts)
+
+# Next page of cards for one section, after content id ``after``, as an HTML
+# fragment. A plain path (no query string) so static exports can hold it too.
+# JSON clients use /api/v1/subjects/<id>/contents?type=... instead.
+@app.route('/subject/<int:subject_id>/<content_type>/<int:after>')
+@cached_page
+def subject_items(subject_id, content_type, after):
+    if content_type not in SUBJECT_SECTIONS or not get_subject(subject_id):
+        abort(404)
     
-    conn.close()
-    return render_template('subject.html', subject=subject, lectures=lectures, notes=notes, dpps=dpps, solutions=solutions, others=others)
+    items, next_url = subject_section(subject_id, content_type, after)
+    return render_template('subject_items.html', content_type=content_type, items=items, next_url=next_url)
 
 # Admin routes
 @app.route('/admin/login', methods=['GET', 'POST'])
@@ -492,9 +654,12 @@ def admin_logout():
     return redirect(url_for('home'))
 
 # Static files route
-@app.route('/static/<path:filename>')
+@app.route('/static/<path:filename>', endpoint='static')
 def static_files(filename):
-    return send_from_directory('static', filename)
+    # static/uploads holds raw batch files; those are never public
+    if posixpath.normpath(filename).split('/')[0].lower() == 'uploads':
+        abort(404)
+    return assets.send_static(os.path.join(app.root_path, 'static'), filename)
 
 @app.route('/admin/dashboard')
 def admin_dashboard():
@@ -504,6 +669,127 @@ def admin_dashboard():
     batches = get_all_batches()
     return render_template('admin/dashboard.html', batches=batches)
 
+# Batches whose stream links expire soon (JWT exp claims read at ingest)
+@app.route('/admin/expiring')
+def admin_expiring():
+    if not session.get('admin_logged_in'):
+        if wants_json():
+            return jsonify({'error': 'login required'}), 401
+        return redirect(url_for('admin_login'))
+    
+    days = request.args.get('days', 7, type=int)
+    days = max(0, min(days, 3650))
+    now = int(time.time())
+    batches = []
+    for row in get_expiring_batches(now + days * 86400, now):
+        batch = dict(row)
+        for key in ('first_expiry', 'last_expiry'):
+            batch[key + '_utc'] = time.strftime('%Y-%m-%d %H:%M', time.gmtime(batch[key]))
+        batches.append(batch)
+    if wants_json():
+        return jsonify({'days': days, 'batches': batches})
+    return render_template('admin/expiring.html', days=days, now=now, batches=batches)
+
+# Request profiles (see profiling.py): list and sampling toggle, one profile, its .prof file
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    if not session.get('admin_logged_in'):
+        if wants_json():
+            return jsonify({'error': 'login required'}), 401
+        return redirect(url_for('admin_login'))
+
+    directory = app.config['PROFILE_DIR']
+    if request.method == 'POST':
+        # Percent of requests, e.g. 5 or 0.5; 0 switches sampling off
+        percent = max(0.0, min(request.form.get('percent', 0, type=float), 100.0))
+        minutes = max(1, min(request.form.get('minutes', 30, type=int), 24 * 60))
+        endpoints = [e.strip() for e in request.form.get('endpoints', '').split(',') if e.strip()]
+        profiling.set_settings(directory, percent / 100, endpoints, minutes)
+        if wants_json():
+            return jsonify(profiling.get_settings(directory))
+        flash('Sampling %s' % ('set to %g%% for %d minutes' % (percent, minutes) if percent else 'switched off'),
+              'success')
+        return redirect(url_for('admin_profile'))
+
+    settings = profiling.get_settings(directory)
+    settings['active'] = bool(settings['rate']) and time.time() < settings['until']
+    profiles = profiling.list_profiles(directory)
+    if wants_json():
+        return jsonify({'settings': settings, 'profiles': profiles})
+    for profile in profiles:
+        profile['time_utc'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(profile['time']))
+    return render_template('admin/profile.html', settings=settings, profiles=profiles,
+                           keep=app.config['PROFILE_KEEP'])
+
+@app.route('/admin/profile/<name>')
+def admin_profile_detail(name):
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    profile = profiling.load_profile(app.config['PROFILE_DIR'], name)
+    if profile is None:
+        abort(404)
+    if wants_json():
+        return jsonify(profile)
+    profile['time_utc'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(profile['time']))
+    return render_template('admin/profile_detail.html', profile=profile)
+
+@app.route('/admin/profile/<name>.prof')
+def admin_profile_download(name):
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+
+    path = profiling.stats_file(app.config['PROFILE_DIR'], name)
+    if path is None:
+        abort(404)
+    return send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path),
+                               as_attachment=True, mimetype='application/octet-stream')
+
+# Search
+SEARCH_PAGE_SIZE = 20
+CONTENT_TYPE_LABELS = [
+    ('lecture', 'Lectures'),
+    ('notes', 'Notes'),
+    ('dpp', 'DPPs'),
+    ('solution', 'DPP Solutions'),
+    ('other', 'Other'),
+]
+
+@app.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    content_type = request.args.get('type') or None
+    batch_id = request.args.get('batch_id') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+    
+    results = []
+    if q:
+        results = search_contents(q, content_type, batch_id,
+                                  limit=SEARCH_PAGE_SIZE + 1, offset=(page - 1) * SEARCH_PAGE_SIZE)
+    has_next = len(results) > SEARCH_PAGE_SIZE
+    
+    return render_template('search.html', q=q, content_type=content_type, batch_id=batch_id,
+                           results=results[:SEARCH_PAGE_SIZE], page=page, has_next=has_next,
+                           content_types=CONTENT_TYPE_LABELS)
+
+# Metrics (JSON by default, Prometheus text with ?format=prometheus)
+@app.route('/admin/metrics')
+def admin_metrics():
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'login required'}), 401
+    
+    if request.args.get('format') == 'prometheus' or request.accept_mimetypes.best == 'text/plain':
+        return metrics.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    
+    data = metrics.snapshot()
+    data['caches'] = {
+        'query': database.query_cache.stats(),
+        'page': page_cache.stats(),
+        'browser': access.browser_cache.stats(),
+        'compressed': compress.compressed_cache.stats(),
+    }
+    return jsonify(data)
+
 # API endpoint
 @app.route('/api/batches')
 def api_batches():
@@ -511,16 +797,17 @@ def api_batches():
     return jsonify([dict(batch) for batch in batches])
 
 @app.route('/batch/<batch_id>')
+@cached_page
 def show_batch(batch_id):
     batch = get_batch(batch_id)
-    print(f"Batch data: {dict(batch) if batch else 'None'}")
     
     if not batch:
         flash('Batch not found!', 'danger')
         return redirect(url_for('home'))
     
-    subjects = get_subjects(batch_id)
-    print(f"Subjects data: {[dict(s) for s in subjects] if subjects else 'None'}")
+    subjects = get_subjects(batch_id, live_at())
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Batch %s: %d subjects", batch_id, len(subjects))
     
     return render_template('batch.html', batch=batch, subjects=subjects)
 
@@ -533,11 +820,51 @@ def page_not_found(e):
 def internal_server_error(e):
     return render_template('404.html'), 500
 
-# Initialize the database and run the app
-if __name__ == '__main__':
-    init_db()
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
+# Every route is registered by now
+access.compile_rules(app)
+export.init_app(app, SUBJECT_SECTIONS, TEMPLATES_DIGEST)
+
+def configure_app():
+    """Apply the settings that are read once rather than per request: log
+    level, cache sizes, template minifying and the templates digest"""
+    global TEMPLATES_DIGEST
+    logging.getLogger().setLevel(app.config['LOG_LEVEL'])
+    page_cache.maxsize = app.config['PAGE_CACHE_SIZE']
+    database.configure(app)
+    compress.configure(app)
+    TEMPLATES_DIGEST = _templates_digest()
+    app.extensions['export']['templates_digest'] = TEMPLATES_DIGEST
+
+configure_app()
 
+# One-off setup of the module-level app, which is built with its routes at
+# import time. Not a factory: every call returns that same app. setup_app()
+# applies config overrides (configure_app again) and does the setup that used
+# to happen only under __main__, so gunicorn workers get it too.
+def setup_app(config=None):
+    if config:
+        app.config.update(config)
+        configure_app()
+    with app.app_context():
+        init_db()
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Nothing opened here may cross a fork (see gunicorn.conf.py)
+    database.close_db()
+    return app
 
+def warm_up(app):
+    """Compile every template and prime the query cache for the listing pages"""
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    with app.app_context():
+        database.current_generation()
+        for batch in get_all_batches():
+            get_batch(batch['batch_id'])
+            get_subjects(batch['batch_id'], live_at())
+    log.info("Warm-up done in %.1f ms", (time.perf_counter() - started) * 1000)
+
+# Initialize the database and run the app
+if __name__ == '__main__':
+    setup_app()
     app.run(debug=False)
@@ -0,0 +1,146 @@
+"""Fingerprinted, precompressed static assets.
+
+``flask build-assets`` copies every file under static/ (except uploads/) to
+static/dist/ with a content hash in its name, writes .gz and .br variants
+next to it, and records the mapping in static/dist/manifest.json. While a
+manifest exists, ``url_for('static', filename=...)`` points at the
+fingerprinted copy, which is served with a one-year immutable
+Cache-Control and the best Content-Encoding the client accepts.
+
+Brotli output needs the optional ``brotli`` package; without it only gzip
+variants are written.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+import click
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+SKIP_DIRS = {DIST, 'uploads'}
+
+# Only text formats are worth compressing
+COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.txt', '.json', '.xml', '.map'}
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_manifest = {}      # logical path -> dist path, e.g. css/style.css -> dist/css/style.1a2b3c4d5e.css
+_fingerprinted = set()
+
+
+def fingerprint(path, digest):
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, digest[:10], ext)
+
+
+def precompress(path, data):
+    """Write ``path``.gz (and ``path``.br with brotli) for ``data``; returns size notes"""
+    sizes = []
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, 9, mtime=0))
+    sizes.append('gz %d' % os.path.getsize(path + '.gz'))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+        sizes.append('br %d' % os.path.getsize(path + '.br'))
+    return sizes
+
+
+def build(static_folder, echo=print):
+    """(Re)build static/dist and its manifest; returns the manifest.
+
+    Files from earlier builds are left in place, so pages that still link to
+    them keep working.
+    """
+    dist = os.path.join(static_folder, DIST)
+    manifest = {}
+
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            target = fingerprint(logical, hashlib.sha256(data).hexdigest())
+            out = os.path.join(dist, *target.split('/'))
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, 'wb') as f:
+                f.write(data)
+
+            sizes = ['%d' % len(data)]
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                sizes += precompress(out, data)
+            manifest[logical] = DIST + '/' + target
+            echo('%s -> %s (%s)' % (logical, target, ', '.join(sizes)))
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    global _manifest, _fingerprinted
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as f:
+            _manifest = json.load(f)
+    except (OSError, ValueError):
+        _manifest = {}
+    _fingerprinted = set(_manifest.values())
+
+
+def version():
+    """Short digest of the manifest; changes whenever asset URLs change"""
+    return hashlib.sha1(json.dumps(_manifest, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def send_static(static_folder, filename):
+    """Serve a static file; fingerprinted copies get immutable caching and precompressed bodies"""
+    if filename not in _fingerprinted:
+        return send_from_directory(static_folder, filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.accept_encodings
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[candidate] and os.path.exists(os.path.join(static_folder, filename + suffix)):
+            encoding = candidate
+            filename += suffix
+            break
+
+    response = send_from_directory(static_folder, filename, mimetype=mimetype, max_age=31536000)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Disposition', None)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    static_folder = os.path.join(app.root_path, 'static')
+    load_manifest(static_folder)
+
+    @app.url_defaults
+    def fingerprinted_static_url(endpoint, values):
+        if endpoint == 'static' and _manifest:
+            filename = values.get('filename')
+            if filename in _manifest:
+                values['filename'] = _manifest[filename]
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Fingerprint and precompress everything under static/."""
+        manifest = build(static_folder, echo=click.echo)
+        load_manifest(static_folder)
+        click.echo('%d assets written to static/%s' % (len(manifest), DIST))
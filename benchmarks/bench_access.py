@@ -0,0 +1,71 @@
+"""Per-request cost of the check_access gate, before and after the access policy.
+
+"before" is the old gate: it rebuilt the skip list, lowercased the User-Agent
+and scanned it four times, and parsed an ISO token expiry on every request.
+"after" is app.check_access with the compiled endpoint rules, the cached
+browser check and the epoch-int expiry. Both run inside an already-pushed
+request context, so only the gate itself is timed.
+"""
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+from common import CHROME_UA, load_app, quiet, remove_db, temp_db_path, user_session
+
+
+def legacy_check_access():
+    from flask import redirect, request, session
+
+    if request.endpoint == 'static':
+        return None
+    skip_endpoints = ['generate_token', 'create_token', 'verify_token', 'admin_login',
+                      'static', 'redirect_to_1dm', 'page_not_found', 'internal_server_error',
+                      'admin_logout']
+    if request.endpoint in skip_endpoints:
+        return None
+    if request.endpoint and request.endpoint.startswith('admin_') and session.get('admin_logged_in'):
+        return None
+    user_agent = request.headers.get('User-Agent', '').lower()
+    is_chrome = 'chrome' in user_agent
+    is_edge = 'edg/' in user_agent
+    is_opera = 'opr/' in user_agent
+    is_brave = 'brave' in user_agent
+    if not is_chrome or is_edge or is_opera or is_brave:
+        return redirect("https://www.google.com/chrome/")
+    if 'user_token' not in session or 'token_expiry' not in session:
+        return redirect('/generate-token')
+    if not datetime.now() < datetime.fromisoformat(session['token_expiry']):
+        return redirect('/generate-token')
+    return None
+
+
+def run(number):
+    from flask import session
+
+    import app as app_module
+
+    db_path = temp_db_path()
+    app = load_app(db_path)
+    urls = ('/batch/bench', '/generate-token')
+
+    print('%-18s %12s %12s %8s' % ('url', 'before us', 'after us', 'speedup'))
+    for url in urls:
+        timings = {}
+        for mode, gate in (('before', legacy_check_access), ('after', app_module.check_access)):
+            with app.test_request_context(url, headers={'User-Agent': CHROME_UA}):
+                session.update(user_session())
+                if mode == 'before':
+                    session['token_expiry'] = (datetime.now() + timedelta(hours=1)).isoformat()
+                with quiet():
+                    assert gate() is None, (mode, url)
+                    best = min(timeit.repeat(gate, number=number, repeat=5))
+                timings[mode] = best / number * 1e6
+        print('%-18s %12.2f %12.2f %7.1fx' % (url, timings['before'], timings['after'],
+                                             timings['before'] / timings['after']))
+    remove_db(db_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000, help='gate calls per timing run')
+    run(parser.parse_args().number)
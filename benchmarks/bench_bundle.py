@@ -0,0 +1,99 @@
+"""Total ingest time for many batch files: one upload each vs. one zip.
+
+"sequential" posts every TXT file to /admin/upload on its own and waits for
+its job before sending the next, like an admin uploading them one by one.
+"bundle" posts all of them in a single zip: the files are parsed on the
+process pool while the job thread writes the batches already parsed.
+
+Both go through the test client, each run loading new batches. The bundle is run
+twice: the first run includes starting the parser processes.
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+from common import CHROME_UA, load_app, quiet, remove_db, temp_db_path, user_session, write_synthetic_batch
+
+
+def admin_client(app):
+    client = app.test_client()
+    client.environ_base['HTTP_USER_AGENT'] = CHROME_UA
+    with client.session_transaction() as sess:
+        sess.update(user_session(), admin_logged_in=True)
+    return client
+
+
+def wait(client, job_id):
+    while True:
+        job = client.get('/admin/jobs/%s' % job_id).get_json()
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.005)
+
+
+def upload(client, files, data=None):
+    response = client.post('/admin/upload', data=dict(data or {}, mode='replace', file=files),
+                           headers={'Accept': 'application/json'}, content_type='multipart/form-data')
+    assert response.status_code == 202, response.data[:200]
+    return wait(client, response.get_json()['job_id'])
+
+
+def sequential(client, paths, prefix):
+    for path in paths:
+        batch_id = prefix + os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'rb') as f:
+            job = upload(client, [(f, os.path.basename(path))], {'batch_id': batch_id, 'title': batch_id})
+        assert job['status'] == 'done', job
+
+
+def bundle(client, paths, prefix):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path in paths:
+            archive.write(path, prefix + os.path.basename(path))
+    buf.seek(0)
+    job = upload(client, [(buf, 'batches.zip')])
+    assert job['status'] == 'done', job
+    assert job['batches_done'] == len(paths), job
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='pw_bundle_')
+    db_path = temp_db_path()
+    try:
+        paths = [write_synthetic_batch(os.path.join(workdir, 'BATCH_%02d.txt' % n), args.subjects, args.items)
+                 for n in range(args.files)]
+        app = load_app(db_path)
+        app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+        if args.processes:
+            app.config['INGEST_PROCESSES'] = args.processes
+        client = admin_client(app)
+        lines = args.files * args.subjects * (args.items + 1)
+
+        print('%d files x %d lines, %d parser processes' % (
+            args.files, lines // args.files, app.config['INGEST_PROCESSES'] or os.cpu_count()))
+        print('%-18s %10s %12s' % ('mode', 'total s', 'lines/s'))
+        # Every run loads new batch ids, so none of them pays for replacing old rows
+        for run_number, (mode, fn) in enumerate((('sequential', sequential), ('bundle (cold)', bundle),
+                                                 ('bundle', bundle))):
+            with quiet():
+                start = time.perf_counter()
+                fn(client, paths, 'R%d_' % run_number)
+                elapsed = time.perf_counter() - start
+            print('%-18s %10.2f %12.0f' % (mode, elapsed, lines / elapsed))
+    finally:
+        remove_db(db_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=12, help='batch files (default 12)')
+    parser.add_argument('--subjects', type=int, default=10, help='subjects per file (default 10)')
+    parser.add_argument('--items', type=int, default=2000, help='content lines per subject (default 2000)')
+    parser.add_argument('--processes', type=int, default=0, help='parser processes (default: one per core)')
+    run(parser.parse_args())
@@ -0,0 +1,102 @@
+"""Bytes on the wire and CPU per request with minified templates and compression.
+
+Pages of a synthetic batch (one subject with --items lines) are fetched
+through the test client.
+
+Sizes: the body as rendered from the unminified templates, minified, then
+gzip at levels 1/6/9 (and brotli when installed) of the minified body.
+"cpu ms" is compress.compress() alone at the configured level, best of
+three.
+
+Timing, per request (page cache warm):
+
+    identity     no Accept-Encoding
+    compress     Accept-Encoding: gzip, the compressed-body cache emptied
+                 first, so every request compresses
+    cached       Accept-Encoding: gzip with the compressed body cached
+                 (what repeat visits to a cached page cost)
+"""
+import argparse
+import gzip
+import os
+import time
+
+from common import load_app, logged_in_client, measure, quiet, remove_db, temp_db_path, write_synthetic_batch
+
+
+def run(args):
+    import compress
+    import database
+    from app import page_cache
+    from ingest import ingest_file
+
+    db_path = temp_db_path()
+    batch_file = db_path + '.txt'
+    try:
+        app = load_app(db_path)
+        write_synthetic_batch(batch_file, 1, args.items)
+        with quiet(), app.app_context():
+            ingest_file(batch_file, 'bench', 'Benchmark Batch')
+            subject_id = database.get_subjects('bench')[0]['subject_id']
+            after = database.get_contents_page(subject_id, 'lecture', 0, app.config['SUBJECT_PAGE_SIZE'])[-1][0]
+        client = logged_in_client(app)
+        urls = ('/', '/batch/bench', '/subject/%d' % subject_id, '/subject/%d/lecture/%d' % (subject_id, after),
+                '/api/v1/subjects/%d/contents' % subject_id)
+
+        def bodies():
+            page_cache.clear()
+            app.jinja_env.cache.clear()
+            return [client.get(url).data for url in urls]
+
+        minifier = app.jinja_loader
+        with quiet():
+            app.jinja_loader = minifier.loader
+            raw = bodies()
+            app.jinja_loader = minifier
+            minified = bodies()
+
+        levels = (1, 6, 9)
+        encoders = [('gzip-%d' % level, lambda data, level=level: gzip.compress(data, level)) for level in levels]
+        if compress.brotli is not None:
+            encoders.append(('br-5', lambda data: compress.brotli.compress(data, quality=5)))
+        print('%-30s %9s %9s' % ('url', 'raw', 'minified') + ''.join(' %9s' % name for name, fn in encoders)
+              + ' %9s' % 'cpu ms')
+        for url, before, body in zip(urls, raw, minified):
+            cpu = float('inf')
+            for _ in range(3):
+                start = time.perf_counter()
+                for _ in range(100):
+                    compress.compress(body, 'gzip', app.config)
+                cpu = min(cpu, (time.perf_counter() - start) / 100)
+            print('%-30s %9d %9d' % (url, len(before), len(body)) + ''.join(' %9d' % len(fn(body)) for name, fn in encoders)
+                  + ' %9.3f' % (cpu * 1000))
+
+        gz = {'Accept-Encoding': 'gzip'}
+
+        def fresh(url):
+            compress.compressed_cache.clear()
+            return client.get(url, headers=gz)
+
+        rows = []
+        with quiet():
+            for url in urls:
+                client.get(url)
+                rows.append((url,
+                             1000 / measure(lambda: client.get(url), args.seconds)[1],
+                             1000 / measure(lambda: fresh(url), args.seconds)[1],
+                             1000 / measure(lambda: client.get(url, headers=gz), args.seconds)[1]))
+        print()
+        print('%-30s %12s %12s %12s' % ('url (ms/request)', 'identity', 'compress', 'cached'))
+        for row in rows:
+            print('%-30s %12.3f %12.3f %12.3f' % row)
+    finally:
+        remove_db(db_path)
+        if os.path.exists(batch_file):
+            os.remove(batch_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=2000, help='content lines in the subject (default 2000)')
+    parser.add_argument('--seconds', type=float, default=1.0, help='seconds per timing (default 1)')
+    run(parser.parse_args())
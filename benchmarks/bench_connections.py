@@ -0,0 +1,59 @@
+"""Requests/sec for /batch/<id> and /subject/<id> with and without connection reuse.
+
+"before" closes the thread's connection after every request (and skips the
+per-connection pragmas), which mirrors the old connect-per-query helpers.
+"after" is the default pooled, per-thread connection.
+"""
+import argparse
+import os
+
+from common import ingest_sample, load_app, logged_in_client, measure, quiet, temp_db_path
+
+
+def run(seconds):
+    import database
+
+    db_path = temp_db_path()
+    app = load_app(db_path)
+    ingest_sample(app)
+    with app.app_context():
+        subject_id = database.get_subjects('bench')[0]['subject_id']
+
+    client = logged_in_client(app)
+    urls = ['/batch/bench', '/subject/%d' % subject_id]
+
+    def close_after_request(exc=None):
+        database.close_db()
+
+    results = {}
+    for mode in ('before', 'after'):
+        pragmas = database.CONNECTION_PRAGMAS
+        if mode == 'before':
+            database.CONNECTION_PRAGMAS = ()
+            app.teardown_appcontext_funcs.append(close_after_request)
+        try:
+            for url in urls:
+                with quiet():
+                    assert client.get(url).status_code == 200, url
+                    _, rps = measure(lambda: client.get(url), seconds)
+                results[(mode, url)] = rps
+        finally:
+            database.CONNECTION_PRAGMAS = pragmas
+            if close_after_request in app.teardown_appcontext_funcs:
+                app.teardown_appcontext_funcs.remove(close_after_request)
+            database.close_db()
+
+    print('%-24s %12s %12s %8s' % ('url', 'before r/s', 'after r/s', 'speedup'))
+    for url in urls:
+        before, after = results[('before', url)], results[('after', url)]
+        print('%-24s %12.1f %12.1f %7.2fx' % (url, before, after, after / before))
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2.0, help='duration of each measurement')
+    run(parser.parse_args().seconds)
@@ -0,0 +1,48 @@
+"""Time a full batch ingest (parse_txt) for a synthetic file of a given size."""
+import argparse
+import os
+import time
+
+from common import load_app, quiet, temp_db_path, write_synthetic_batch
+
+
+def run(subjects, items):
+    db_path = temp_db_path()
+    txt_path = write_synthetic_batch(db_path + '.txt', subjects, items)
+    app = load_app(db_path)
+    from app import parse_txt
+    from ingest import ingest_file
+
+    # A copy with a few lectures appended to the last subject
+    changed_path = db_path + '.changed.txt'
+    with open(txt_path, encoding='utf-8') as src, open(changed_path, 'w', encoding='utf-8') as dst:
+        dst.write(src.read())
+        for n in range(5):
+            dst.write('New Lecture %d:https://stream.example.app/new/%d/master.m3u8\n' % (n, n))
+
+    lines = subjects * (items + 1)
+    attempts = (
+        ('first upload', lambda: parse_txt(txt_path, 'bench', 'Benchmark Batch')),
+        ('re-upload', lambda: parse_txt(txt_path, 'bench', 'Benchmark Batch')),
+        ('incr. same', lambda: ingest_file(txt_path, 'bench', 'Benchmark Batch', incremental=True)),
+        ('incr. +5', lambda: ingest_file(changed_path, 'bench', 'Benchmark Batch', incremental=True)),
+    )
+    for attempt, fn in attempts:
+        start = time.perf_counter()
+        with quiet(), app.app_context():
+            assert fn()
+        elapsed = time.perf_counter() - start
+        print('%-13s %7d lines  %8.3f s  %10.0f lines/s' % (attempt, lines, elapsed, lines / elapsed))
+    os.remove(changed_path)
+
+    for suffix in ('', '-wal', '-shm', '.txt'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subjects', type=int, default=20)
+    parser.add_argument('--items', type=int, default=1000, help='content lines per subject')
+    args = parser.parse_args()
+    run(args.subjects, args.items)
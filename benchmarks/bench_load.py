@@ -0,0 +1,250 @@
+"""Load test: throughput and p50/p99 latency under concurrent clients.
+
+Writes a synthetic dataset in the upload format, ingests it, then drives
+/, /batch/<id>, /subject/<id> and /api/batches with --clients concurrent
+clients: in-process through the Flask test client, over HTTP against a local
+gunicorn, or both. Each client picks routes (and batch/subject ids) at random.
+
+    python benchmarks/bench_load.py --subjects 1000 --items 100 --clients 16
+
+Client threads share the GIL with the in-process app, so test-client numbers
+measure app cost per request; the gunicorn numbers include real workers.
+"""
+import argparse
+import http.client
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import (CHROME_UA, ROOT, load_app, logged_in_client, quiet, remove_db, session_cookie,
+                    write_synthetic_batch)
+
+ROUTES = ('home', 'batch', 'subject', 'api_batches')
+MAX_SUBJECTS = 10000
+MAX_ROWS = 1000000
+
+
+def build_dataset(app, batches, subjects, items):
+    """Ingest ``subjects`` subjects of ``items`` rows each, spread over ``batches`` batches"""
+    import database
+    from ingest import ingest_file
+
+    fd, batch_file = tempfile.mkstemp(prefix='pw_load_', suffix='.txt')
+    os.close(fd)
+    batch_ids, subject_ids = [], []
+    try:
+        for b in range(batches):
+            count = subjects // batches + (1 if b < subjects % batches else 0)
+            if not count:
+                continue
+            batch_id = 'load%d' % b
+            write_synthetic_batch(batch_file, count, items)
+            with quiet(), app.app_context():
+                ingest_file(batch_file, batch_id, 'Load Batch %d' % b)
+                subject_ids += [row['subject_id'] for row in database.get_subjects(batch_id)]
+            batch_ids.append(batch_id)
+    finally:
+        os.remove(batch_file)
+    return batch_ids, subject_ids
+
+
+def pick(rng, batch_ids, subject_ids):
+    route = rng.choice(ROUTES)
+    if route == 'home':
+        return route, '/'
+    if route == 'batch':
+        return route, '/batch/%s' % rng.choice(batch_ids)
+    if route == 'subject':
+        return route, '/subject/%d' % rng.choice(subject_ids)
+    return route, '/api/batches'
+
+
+def drive(make_sender, clients, seconds, batch_ids, subject_ids):
+    """Run ``clients`` threads for ``seconds``; return {route: (latencies, errors)}.
+
+    ``make_sender()`` is called once per thread and returns ``send(url) -> status``.
+    """
+    results = {route: ([], [0]) for route in ROUTES}
+    lock = threading.Lock()
+    start = threading.Barrier(clients + 1)
+
+    def client(n):
+        rng = random.Random(n)
+        send = make_sender()
+        latencies = {route: [] for route in ROUTES}
+        errors = dict.fromkeys(ROUTES, 0)
+        start.wait()
+        deadline = time.perf_counter() + seconds
+        while True:
+            route, url = pick(rng, batch_ids, subject_ids)
+            began = time.perf_counter()
+            status = send(url)
+            done = time.perf_counter()
+            latencies[route].append(done - began)
+            if status != 200:
+                errors[route] += 1
+            if done >= deadline:
+                break
+        with lock:
+            for route in ROUTES:
+                results[route][0].extend(latencies[route])
+                results[route][1][0] += errors[route]
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    with quiet():
+        start.wait()
+        for thread in threads:
+            thread.join()
+    return {route: (latencies, errors[0]) for route, (latencies, errors) in results.items()}
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def report(target, results, seconds):
+    everything = []
+    total_errors = 0
+    for route in ROUTES:
+        latencies, errors = results[route]
+        everything += latencies
+        total_errors += errors
+        print_row(target, route, sorted(latencies), errors, seconds)
+    print_row(target, 'all', sorted(everything), total_errors, seconds)
+
+
+def print_row(target, route, latencies, errors, seconds):
+    if not latencies:
+        print('%-10s %-12s %9d' % (target, route, 0))
+        return
+    print('%-10s %-12s %9d %9.1f %9.2f %9.2f %7d' % (
+        target, route, len(latencies), len(latencies) / seconds,
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000, errors))
+
+
+def test_client_sender(app):
+    def make():
+        client = logged_in_client(app)
+        return lambda url: client.get(url).status_code
+    return make
+
+
+def http_sender(port, cookie):
+    headers = {'User-Agent': CHROME_UA, 'Cookie': cookie}
+
+    def make():
+        state = {'conn': None}
+
+        def send(url):
+            conn = state['conn'] or http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            state['conn'] = conn
+            try:
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                state['conn'] = None
+                return 0
+            if response.will_close:
+                conn.close()
+                state['conn'] = None
+            return response.status
+        return send
+    return make
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, port, workers):
+    # The app opens the relative path pw_data.db, so run it from workdir; that
+    # also keeps gunicorn from picking up the repo's gunicorn.conf.py
+    cmd = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+           '--bind', '127.0.0.1:%d' % port, '--chdir', workdir, '--pythonpath', ROOT,
+           '--log-level', 'warning', 'app:app']
+    server = subprocess.Popen(cmd, cwd=workdir, env=dict(os.environ, LOG_LEVEL='WARNING'))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with status %d' % server.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start listening within 30s')
+
+
+def run(args):
+    import database
+    from app import page_cache
+
+    workdir = tempfile.mkdtemp(prefix='pw_load_')
+    db_path = os.path.join(workdir, 'pw_data.db')
+    try:
+        app = load_app(db_path)
+        began = time.perf_counter()
+        batch_ids, subject_ids = build_dataset(app, args.batches, args.subjects, args.items)
+        print('dataset: %d batches, %d subjects, %d contents, ingested in %.1fs'
+              % (len(batch_ids), len(subject_ids), args.subjects * args.items,
+                 time.perf_counter() - began))
+        database.close_db()
+
+        print('%-10s %-12s %9s %9s %9s %9s %7s' % (
+            'target', 'route', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+
+        if args.target in ('testclient', 'both'):
+            if args.cold:
+                page_cache.maxsize = 0
+                database.query_cache.maxsize = 0
+            results = drive(test_client_sender(app), args.clients, args.seconds, batch_ids, subject_ids)
+            report('testclient', results, args.seconds)
+
+        if args.target in ('gunicorn', 'both'):
+            port = free_port()
+            server = start_gunicorn(workdir, port, args.workers)
+            try:
+                send = http_sender(port, session_cookie(app))
+                results = drive(send, args.clients, args.seconds, batch_ids, subject_ids)
+                report('gunicorn', results, args.seconds)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        remove_db(db_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batches', type=int, default=5, help='number of batches (default 5)')
+    parser.add_argument('--subjects', type=int, default=100,
+                        help='total subjects, 10 to %d (default 100)' % MAX_SUBJECTS)
+    parser.add_argument('--items', type=int, default=100, help='content rows per subject (default 100)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients (default 8)')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of each run (default 5)')
+    parser.add_argument('--target', choices=('testclient', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers (default 2)')
+    parser.add_argument('--cold', action='store_true',
+                        help='disable the page and query caches (test client only)')
+    args = parser.parse_args()
+    if not 10 <= args.subjects <= MAX_SUBJECTS:
+        parser.error('--subjects must be between 10 and %d' % MAX_SUBJECTS)
+    if args.subjects * args.items > MAX_ROWS:
+        parser.error('--subjects x --items must not exceed %d content rows' % MAX_ROWS)
+    if args.batches < 1 or args.batches > args.subjects:
+        parser.error('--batches must be between 1 and --subjects')
+    run(args)
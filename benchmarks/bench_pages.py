@@ -0,0 +1,77 @@
+"""Render time and bytes sent for batch/subject pages: cold, warm and 304.
+
+Also renders a cold subject page for synthetic subjects of growing size; with
+the lazy sections the time and bytes should stay flat.
+"""
+import argparse
+import os
+
+from common import (ingest_sample, load_app, logged_in_client, measure, quiet, temp_db_path,
+                    write_synthetic_batch)
+
+SUBJECT_SIZES = (10, 100, 1000, 10000)
+
+
+def wire_bytes(response):
+    headers = sum(len(k) + len(v) + 4 for k, v in response.headers.items())
+    return headers + len(response.data)
+
+
+def run(seconds):
+    import database
+    from app import page_cache
+
+    db_path = temp_db_path()
+    app = load_app(db_path)
+    ingest_sample(app)
+    with app.app_context():
+        subject_id = database.get_subjects('bench')[0]['subject_id']
+    client = logged_in_client(app)
+
+    def cold(url):
+        page_cache.clear()
+        database.query_cache.clear()
+        return client.get(url)
+
+    print('%-16s %-5s %10s %10s' % ('url', 'mode', 'ms/req', 'bytes'))
+    for url in ('/batch/bench', '/subject/%d' % subject_id):
+        with quiet():
+            etag = client.get(url).headers['ETag']
+            modes = (
+                ('cold', lambda: cold(url)),
+                ('warm', lambda: client.get(url)),
+                ('304', lambda: client.get(url, headers={'If-None-Match': etag})),
+            )
+            rows = []
+            for mode, fn in modes:
+                response = fn()
+                calls, rate = measure(fn, seconds)
+                rows.append((url, mode, 1000 / rate, wire_bytes(response)))
+        for row in rows:
+            print('%-16s %-5s %10.3f %10d' % row)
+
+    print()
+    print('%-16s %10s %10s' % ('items/subject', 'cold ms', 'bytes'))
+    for items in SUBJECT_SIZES:
+        batch_file = db_path + '.txt'
+        write_synthetic_batch(batch_file, 1, items)
+        with quiet():
+            with app.app_context():
+                from ingest import ingest_file
+                ingest_file(batch_file, 'sized', 'Sized')
+                subject_id = database.get_subjects('sized')[0]['subject_id']
+            url = '/subject/%d' % subject_id
+            response = cold(url)
+            calls, rate = measure(lambda: cold(url), seconds)
+        os.remove(batch_file)
+        print('%-16d %10.3f %10d' % (items, 1000 / rate, wire_bytes(response)))
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2.0, help='duration of each measurement')
+    run(parser.parse_args().seconds)
@@ -0,0 +1,112 @@
+"""Where ingest time goes: reading, parsing, classifying, and writing to SQLite.
+
+Times each stage separately on a synthetic multi-MB batch file:
+
+    read       iterate and strip the lines only
+    classify   classify() on pre-split (title, url) pairs
+    parse      ingest.iter_records(), parsing plus classify, no database
+    ingest     ingest.ingest_batch() into a fresh database (parse + persist)
+
+``--profile`` prints the top cProfile entries for a parse pass, and
+``--memory`` reports tracemalloc peaks for streaming vs. materialising the
+records.
+
+    python benchmarks/bench_parser.py --subjects 20 --items 5000 --profile --memory
+"""
+import argparse
+import collections
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+import time
+import tracemalloc
+
+from common import load_app, quiet, remove_db, temp_db_path, write_synthetic_batch
+
+
+def best_of(fn, repeat):
+    """Fastest of ``repeat`` runs, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def consume(iterable):
+    collections.deque(iterable, maxlen=0)
+
+
+def run(args):
+    from ingest import classify, ingest_batch, iter_records
+
+    fd, batch_file = tempfile.mkstemp(prefix='pw_parse_', suffix='.txt')
+    os.close(fd)
+    write_synthetic_batch(batch_file, args.subjects, args.items)
+    with open(batch_file, encoding='utf-8') as f:
+        lines = f.readlines()
+    os.remove(batch_file)
+    size_mb = sum(len(line) for line in lines) / 1e6
+    pairs = [line.strip().partition(':')[::2] for line in lines if 'http' in line]
+    print('input: %d lines, %.1f MB' % (len(lines), size_mb))
+
+    stages = [
+        ('read', lambda: consume(line.strip() for line in lines)),
+        ('classify', lambda: consume(classify(title, url) for title, url in pairs)),
+        ('parse', lambda: consume(iter_records(lines))),
+    ]
+
+    db_path = temp_db_path()
+    app = load_app(db_path)
+
+    def ingest():
+        with quiet(), app.app_context():
+            ingest_batch(lines, 'parser', 'Parser Benchmark')
+
+    stages.append(('ingest', ingest))
+
+    print('%-10s %10s %12s %10s %8s' % ('stage', 'seconds', 'lines/s', 'MB/s', 'share'))
+    timings = [(name, best_of(fn, args.repeat)) for name, fn in stages]
+    total = timings[-1][1]
+    for name, seconds in timings:
+        print('%-10s %10.3f %12.0f %10.1f %7.0f%%' % (
+            name, seconds, len(lines) / seconds, size_mb / seconds, 100 * seconds / total))
+    parse_time = dict(timings)['parse']
+    print('persistence (ingest - parse): %.3f s' % (total - parse_time))
+    remove_db(db_path)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        consume(iter_records(lines))
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(args.sort).print_stats(args.top)
+        print()
+        print(out.getvalue().strip())
+
+    if args.memory:
+        print()
+        for name, fn in (('streamed', lambda: consume(iter_records(lines))),
+                         ('list', lambda: list(iter_records(lines)))):
+            tracemalloc.start()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('%-10s peak %8.1f MB' % (name, peak / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, default=20, help='subjects in the input (default 20)')
+    parser.add_argument('--items', type=int, default=5000, help='lines per subject (default 5000)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage; the fastest is reported')
+    parser.add_argument('--profile', action='store_true', help='print cProfile stats for a parse pass')
+    parser.add_argument('--sort', default='tottime', help='pstats sort key (default tottime)')
+    parser.add_argument('--top', type=int, default=15, help='profile rows to print (default 15)')
+    parser.add_argument('--memory', action='store_true', help='report tracemalloc peaks')
+    run(parser.parse_args())
@@ -0,0 +1,89 @@
+"""What the profiling hooks cost a request, off and on.
+
+"hooks" times profiling's before/after handlers alone inside a request
+context: with nothing switched on, and with sampling on for a different
+endpoint. The page rows time full warm (page cache hit) requests with the
+hooks removed and in place, then cold requests without and with an
+admin's X-Profile header (profile written to disk included).
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+from common import ingest_sample, load_app, logged_in_client, measure, quiet, remove_db, temp_db_path
+
+
+def per_call_us(fn, rounds):
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return best / rounds * 1e6
+
+
+def run(args):
+    import database
+    import profiling
+    from app import page_cache
+
+    db_path = temp_db_path()
+    profile_dir = tempfile.mkdtemp(prefix='pw_profiles_')
+    try:
+        app = load_app(db_path)
+        app.config['PROFILE_DIR'] = profile_dir
+        ingest_sample(app)
+        with app.app_context():
+            subject_id = database.get_subjects('bench')[0]['subject_id']
+        url = '/subject/%d' % subject_id
+        client = logged_in_client(app)
+        with client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+
+        def hooks():
+            profiling._start_request()
+            profiling._finish_request(None)
+
+        print('%-34s %10s' % ('hooks', 'us/call'))
+        with app.test_request_context(url):
+            app.preprocess_request()
+            print('%-34s %10.3f' % ('off', per_call_us(hooks, args.rounds)))
+            profiling.set_settings(profile_dir, 1.0, ['show_batch'], 5)
+            print('%-34s %10.3f' % ('sampling another endpoint', per_call_us(hooks, args.rounds)))
+            profiling.set_settings(profile_dir, 0, [], 0)
+
+        def cold(headers=None):
+            page_cache.clear()
+            database.query_cache.clear()
+            return client.get(url, headers=headers)
+
+        handlers = [(app.before_request_funcs[None], profiling._start_request),
+                    (app.after_request_funcs[None], profiling._finish_request),
+                    (app.teardown_request_funcs[None], profiling._abandon_request)]
+        rows = []
+        with quiet():
+            client.get(url)
+            for funcs, fn in handlers:
+                funcs.remove(fn)
+            rows.append(('warm, hooks removed', measure(lambda: client.get(url), args.seconds)[1]))
+            for funcs, fn in handlers:
+                funcs.append(fn)
+            rows.append(('warm, hooks off', measure(lambda: client.get(url), args.seconds)[1]))
+            rows.append(('cold', measure(cold, args.seconds)[1]))
+            rows.append(('cold, X-Profile (saved to disk)', measure(lambda: cold({'X-Profile': '1'}), args.seconds)[1]))
+        print()
+        print('%-34s %10s' % ('page', 'ms/req'))
+        for label, rate in rows:
+            print('%-34s %10.3f' % (label, 1000 / rate))
+    finally:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        remove_db(db_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=2.0, help='seconds per page measurement (default 2)')
+    parser.add_argument('--rounds', type=int, default=100000, help='hook calls timed (default 100000)')
+    run(parser.parse_args())
@@ -0,0 +1,251 @@
+"""Read latency, errors and consistency while a large batch is re-uploaded.
+
+A local gunicorn serves the pages. --clients threads keep requesting
+/batch/<id>, /subject/<id> and the batch's subject list from the API, first
+with no upload running ("idle"), then while another process re-uploads that
+batch ("ingest"). Meanwhile a probe makes one small write every 50ms (like an
+admin action or a second upload) and records how long it waits for the lock.
+
+The upload runs twice:
+
+    legacy   the old ingest: delete and insert in one transaction that holds
+             the write lock while the file is parsed
+    staged   ingest.ingest_file: parse into staging tables, copy them under a
+             hidden batch id in short transactions, swap it in with one quick
+             transaction, then purge the old rows
+
+Every API read must return either the old or the new subject count of the
+batch; anything else is counted as "partial".
+
+    python benchmarks/bench_read_while_ingest.py --subjects 40 --items 2500
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_load import free_port, http_sender, percentile, start_gunicorn
+from common import CHROME_UA, load_app, quiet, remove_db, session_cookie, write_synthetic_batch
+
+TARGET = 'target'
+
+
+def legacy_ingest(filepath, batch_id, title):
+    """The ingest before staging tables, kept here for comparison"""
+    from database import (bump_generation, delete_batch_rows, encode_urls, get_db, index_batch_search,
+                          refresh_batch_counts)
+    from ingest import CHUNK_SIZE, Subject, _next_subject_id, iter_records
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        delete_batch_rows(c, batch_id)
+        c.execute("INSERT INTO batches (batch_id, title, description, created_at) VALUES (?, ?, '', datetime('now'))",
+                  (batch_id, title))
+        subject_id = _next_subject_id(c) - 1
+        rows = []
+
+        def insert(rows):
+            urls = encode_urls(c, [row[3] for row in rows])
+            c.executemany("INSERT INTO contents (subject_id, content_type, title, url_pattern, url_key, "
+                          "media_kind, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          [row[:3] + url + row[4:] for row, url in zip(rows, urls)])
+            rows.clear()
+
+        with open(filepath, encoding='utf-8') as f:
+            for record in iter_records(f):
+                if type(record) is Subject:
+                    subject_id += 1
+                    c.execute("INSERT INTO subjects (subject_id, batch_id, name) VALUES (?, ?, ?)",
+                              (subject_id, batch_id, record.name))
+                    continue
+                rows.append((subject_id,) + record[1:])
+                if len(rows) >= CHUNK_SIZE:
+                    insert(rows)
+        insert(rows)
+        index_batch_search(c, batch_id)
+        refresh_batch_counts(c, batch_id)
+        bump_generation(c, batch_id)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def ingest_worker(mode, filepath, db_path):
+    """Runs in a child process, so the upload does not share our GIL"""
+    app = load_app(db_path)
+    with quiet(), app.app_context():
+        if mode == 'legacy':
+            legacy_ingest(filepath, TARGET, 'Target Batch')
+        else:
+            from ingest import ingest_file
+            ingest_file(filepath, TARGET, 'Target Batch')
+
+
+def subject_count(port, cookie):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', '/api/v1/batches/%s/subjects?limit=1000' % TARGET,
+                     headers={'User-Agent': CHROME_UA, 'Cookie': cookie})
+        response = conn.getresponse()
+        body = response.read()
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+    if response.status != 200:
+        return None
+    return len(json.loads(body)['data'])
+
+
+class Observer:
+    """Reader threads plus the write probe; results are bucketed by phase"""
+
+    def __init__(self, port, cookie, clients, pages, expected_counts, db_path):
+        self.port = port
+        self.cookie = cookie
+        self.clients = clients
+        self.pages = pages
+        self.expected = expected_counts
+        self.db_path = db_path
+        self.phase = 'idle'
+        self.stop = threading.Event()
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def bucket(self):
+        return self.results.setdefault(self.phase, {'latencies': [], 'errors': 0, 'partial': 0, 'waits': [],
+                                                    'write_errors': 0})
+
+    def reader(self, n):
+        send = http_sender(self.port, self.cookie)()
+        i = n
+        while not self.stop.is_set():
+            page = self.pages[i % len(self.pages)]
+            i += 1
+            began = time.perf_counter()
+            status = send(page)
+            elapsed = time.perf_counter() - began
+            with self.lock:
+                bucket = self.bucket()
+                bucket['latencies'].append(elapsed)
+                if status != 200:
+                    bucket['errors'] += 1
+
+    def checker(self):
+        while not self.stop.is_set():
+            count = subject_count(self.port, self.cookie)
+            with self.lock:
+                if count not in self.expected:
+                    self.bucket()['partial'] += 1
+            time.sleep(0.01)
+
+    def writer(self):
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+        while not self.stop.is_set():
+            began = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("UPDATE batches SET description = description WHERE batch_id = 'live'")
+                conn.execute("COMMIT")
+                failed = False
+            except sqlite3.OperationalError:
+                failed = True
+            waited = time.perf_counter() - began
+            with self.lock:
+                bucket = self.bucket()
+                bucket['waits'].append(waited)
+                bucket['write_errors'] += failed
+            time.sleep(0.05)
+        conn.close()
+
+    def __enter__(self):
+        self.threads = [threading.Thread(target=self.reader, args=(n,)) for n in range(self.clients)]
+        self.threads += [threading.Thread(target=self.checker), threading.Thread(target=self.writer)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def print_phase(mode, phase, bucket, seconds):
+    latencies = sorted(bucket['latencies'])
+    waits = sorted(bucket['waits'])
+    print('%-7s %-7s %7.1f %8.0f %8.2f %8.2f %8.2f %6d %7d %9.1f %9.1f %6d' % (
+        mode, phase, seconds, len(latencies) / seconds,
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000, bucket['errors'], bucket['partial'],
+        percentile(waits, 0.50) * 1000, waits[-1] * 1000, bucket['write_errors']))
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='pw_rwi_')
+    db_path = os.path.join(workdir, 'pw_data.db')
+    server = None
+    try:
+        app = load_app(db_path)
+        live = write_synthetic_batch(os.path.join(workdir, 'live.txt'), 20, 200)
+        old = write_synthetic_batch(os.path.join(workdir, 'old.txt'), args.subjects, args.items)
+        new = write_synthetic_batch(os.path.join(workdir, 'new.txt'), args.subjects + 10, args.items)
+        with quiet(), app.app_context():
+            from ingest import ingest_file
+            import database
+            ingest_file(live, 'live', 'Live Batch')
+            ingest_file(old, TARGET, 'Target Batch')
+            subject_id = database.get_subjects('live')[0]['subject_id']
+            database.close_db()
+
+        port = free_port()
+        server = start_gunicorn(workdir, port, args.workers)
+        cookie = session_cookie(app)
+        pages = ('/batch/%s' % TARGET, '/subject/%d' % subject_id, '/batch/live')
+        counts = {args.subjects, args.subjects + 10}
+
+        print('%-7s %-7s %7s %8s %8s %8s %8s %6s %7s %9s %9s %6s' % (
+            'mode', 'phase', 'secs', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'partial',
+            'wait p50', 'wait max', 'w.err'))
+        for n, mode in enumerate(('legacy', 'staged')):
+            # Alternate old/new so every upload really changes the batch
+            upload = new if n % 2 == 0 else old
+            with Observer(port, cookie, args.clients, pages, counts, db_path) as observer:
+                time.sleep(args.idle)
+                with observer.lock:
+                    observer.phase = 'ingest'
+                began = time.perf_counter()
+                subprocess.run([sys.executable, os.path.abspath(__file__), '--ingest-worker', mode, upload, db_path],
+                               check=True)
+                ingest_seconds = time.perf_counter() - began
+            for phase, seconds in (('idle', args.idle), ('ingest', ingest_seconds)):
+                print_phase(mode, phase, observer.results[phase], seconds)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        remove_db(db_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--ingest-worker']:
+        ingest_worker(*sys.argv[2:5])
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, default=40, help='subjects in the re-uploaded batch (default 40)')
+    parser.add_argument('--items', type=int, default=2500, help='content lines per subject (default 2500)')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent reader threads (default 4)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers (default 2)')
+    parser.add_argument('--idle', type=float, default=3.0, help='seconds of reads before the upload')
+    run(parser.parse_args())
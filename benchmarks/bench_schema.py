@@ -0,0 +1,104 @@
+"""Query plans and latencies before/after the index + cascade migration.
+
+For each dataset size a database is built at schema version 1 (the original
+tables, no indexes), measured, migrated to the latest version and measured
+again. Queries are run directly against SQLite, without Flask.
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+from common import temp_db_path
+
+import database
+
+BATCHES = 10
+SUBJECTS_PER_BATCH = 10
+
+# The queries as the app issued them before the migration...
+BEFORE = {
+    'get_subjects': "SELECT subject_id, name FROM subjects WHERE batch_id=?",
+    'get_contents': "SELECT content_type, title, file_url FROM contents WHERE subject_id=?",
+}
+# ...and as database.py issues them now
+AFTER = {
+    'get_subjects': "SELECT subject_id, name FROM subjects WHERE batch_id=? ORDER BY subject_id",
+    'get_contents': ("SELECT c.content_type, c.title, " + database.FILE_URL + " AS file_url FROM contents c "
+                     + database.URL_JOIN + " WHERE c.subject_id=? ORDER BY c.content_type, c.content_id"),
+}
+
+
+def build(path, contents):
+    conn = database._connect(path)
+    database.migrate(conn, target=1)
+    subjects = BATCHES * SUBJECTS_PER_BATCH
+    with conn:
+        conn.executemany("INSERT INTO batches VALUES (?, ?, '', datetime('now'))",
+                         [('b%d' % b, 'Batch %d' % b) for b in range(BATCHES)])
+        conn.executemany("INSERT INTO subjects (subject_id, batch_id, name) VALUES (?, ?, ?)",
+                         [(s + 1, 'b%d' % (s // SUBJECTS_PER_BATCH), 'Subject %d' % s) for s in range(subjects)])
+        types = ('lecture', 'notes', 'dpp', 'solution', 'other')
+        conn.executemany("INSERT INTO contents (subject_id, content_type, title, file_url) VALUES (?, ?, ?, ?)",
+                         ((i % subjects + 1, types[i % 5], 'Lecture %d' % i,
+                           'https://stream.example.app/%d/master.m3u8' % i) for i in range(contents)))
+    return conn
+
+
+def old_delete(conn, batch_id):
+    with conn:
+        c = conn.cursor()
+        c.execute("SELECT subject_id FROM subjects WHERE batch_id = ?", (batch_id,))
+        subject_ids = [row[0] for row in c.fetchall()]
+        if subject_ids:
+            c.execute("DELETE FROM contents WHERE subject_id IN ({})".format(','.join('?' * len(subject_ids))), subject_ids)
+        c.execute("DELETE FROM subjects WHERE batch_id = ?", (batch_id,))
+        c.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+
+
+def new_delete(conn, batch_id):
+    with conn:
+        database.delete_batch_rows(conn.cursor(), batch_id)
+
+
+def timed(fn, reps):
+    start = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - start) / reps * 1000
+
+
+def report(conn, label, queries, delete, reps):
+    print('  [%s]' % label)
+    args = {'get_subjects': ('b1',), 'get_contents': (15,)}
+    for name, sql in queries.items():
+        plan = '; '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, args[name]))
+        ms = timed(lambda: conn.execute(sql, args[name]).fetchall(), reps)
+        print('    %-13s %9.3f ms   plan: %s' % (name, ms, plan))
+    ms = timed(lambda: delete(conn, 'b%d' % (BATCHES - 1 if label == 'before' else BATCHES - 2)), 1)
+    print('    %-13s %9.3f ms' % ('delete_batch', ms))
+
+
+def run(sizes, reps):
+    for size in sizes:
+        path = temp_db_path()
+        print('%d content rows' % size)
+        conn = build(path, size)
+        report(conn, 'before', BEFORE, old_delete, reps)
+        start = time.perf_counter()
+        database.migrate(conn)
+        print('  migration took %.2f s' % (time.perf_counter() - start))
+        report(conn, 'after', AFTER, new_delete, reps)
+        conn.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated content row counts')
+    parser.add_argument('--reps', type=int, default=20)
+    args = parser.parse_args()
+    run([int(s) for s in args.sizes.split(',')], args.reps)
@@ -0,0 +1,50 @@
+"""Search latency (FTS5) against a synthetic catalogue of a given size."""
+import argparse
+import os
+import time
+
+from common import load_app, quiet, temp_db_path, write_synthetic_batch
+
+
+def run(batches, subjects, items, reps):
+    import database
+    from ingest import ingest_file
+
+    db_path = temp_db_path()
+    txt_path = write_synthetic_batch(db_path + '.txt', subjects, items)
+    app = load_app(db_path)
+    start = time.perf_counter()
+    with quiet(), app.app_context():
+        for b in range(batches):
+            ingest_file(txt_path, 'batch%d' % b, 'Batch %d' % b)
+    print('ingested %d content rows in %.1f s' % (batches * subjects * items, time.perf_counter() - start))
+
+    queries = (
+        ('common prefix', 'lect', {}),
+        ('two words', 'lecture 12', {}),
+        ('rare term', 'lecture 999', {}),
+        ('type filter', 'dpp', {'content_type': 'dpp'}),
+        ('batch filter', 'notes', {'batch_id': 'batch0'}),
+        ('deep page', 'lecture', {'offset': 1000}),
+    )
+    with app.app_context():
+        print('%-14s %-12s %10s' % ('case', 'query', 'ms'))
+        for label, text, kwargs in queries:
+            start = time.perf_counter()
+            for _ in range(reps):
+                database.search_contents(text, **kwargs)
+            print('%-14s %-12s %10.2f' % (label, text, (time.perf_counter() - start) / reps * 1000))
+
+    for suffix in ('', '-wal', '-shm', '.txt'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--subjects', type=int, default=20)
+    parser.add_argument('--items', type=int, default=1000, help='content lines per subject')
+    parser.add_argument('--reps', type=int, default=10)
+    args = parser.parse_args()
+    run(args.batches, args.subjects, args.items, args.reps)
@@ -0,0 +1,100 @@
+"""Startup time and first-request latency: plain gunicorn vs. gunicorn.conf.py.
+
+"plain" is ``gunicorn app:app`` with default sync workers: no preload and
+no warm-up. "config" is ``gunicorn -c gunicorn.conf.py``: the app is
+preloaded in the master and every worker warms up after fork. Both run one
+worker against the same pre-migrated synthetic database.
+
+For each: time from spawn until the first response, the first request to
+each page, and the median of the following requests to it.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_load import free_port, http_sender
+from common import ROOT, load_app, quiet, remove_db, session_cookie, write_synthetic_batch
+
+
+def import_time(workdir):
+    """Seconds for ``import app`` plus ``setup_app()`` in a fresh interpreter"""
+    code = ('import time; t = time.perf_counter(); import app; app.setup_app(); '
+            'print(time.perf_counter() - t)')
+    out = subprocess.run([sys.executable, '-c', code], cwd=workdir, check=True, capture_output=True,
+                         env=dict(os.environ, PYTHONPATH=ROOT, LOG_LEVEL='WARNING'), text=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def start(cmd, workdir):
+    return subprocess.Popen(cmd, cwd=workdir, env=dict(os.environ, LOG_LEVEL='WARNING'),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='pw_startup_')
+    db_path = os.path.join(workdir, 'pw_data.db')
+    try:
+        app = load_app(db_path)
+        batch_file = write_synthetic_batch(os.path.join(workdir, 'batch.txt'), args.subjects, args.items)
+        with quiet(), app.app_context():
+            from ingest import ingest_file
+            import database
+            ingest_file(batch_file, 'startup', 'Startup Batch')
+            subject_id = database.get_subjects('startup')[0]['subject_id']
+            database.close_db()
+        pages = ('/', '/batch/startup', '/subject/%d' % subject_id)
+
+        print('import app + setup_app(): %.1f ms' % (import_time(workdir) * 1000))
+        print()
+        print('%-8s %-16s %12s %12s %12s' % ('mode', 'page', 'startup ms', 'first ms', 'median ms'))
+
+        for mode in ('plain', 'config'):
+            port = free_port()
+            bind = '127.0.0.1:%d' % port
+            if mode == 'plain':
+                cmd = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--bind', bind,
+                       '--pythonpath', ROOT, 'app:app']
+            else:
+                cmd = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                       '--workers', '1', '--bind', bind, '--pythonpath', ROOT]
+            send = http_sender(port, session_cookie(app))()
+
+            spawned = time.perf_counter()
+            server = start(cmd, workdir)
+            try:
+                while send('/api/batches') != 200:
+                    if server.poll() is not None or time.perf_counter() - spawned > 30:
+                        raise RuntimeError('%s: gunicorn did not come up' % mode)
+                    time.sleep(0.01)
+                startup = time.perf_counter() - spawned
+
+                for page in pages:
+                    began = time.perf_counter()
+                    assert send(page) == 200, (mode, page)
+                    first = time.perf_counter() - began
+                    later = []
+                    for _ in range(args.repeat):
+                        began = time.perf_counter()
+                        send(page)
+                        later.append(time.perf_counter() - began)
+                    print('%-8s %-16s %12.1f %12.2f %12.2f' % (
+                        mode, page, startup * 1000, first * 1000, statistics.median(later) * 1000))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        remove_db(db_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subjects', type=int, default=50, help='subjects in the dataset (default 50)')
+    parser.add_argument('--items', type=int, default=200, help='content rows per subject (default 200)')
+    parser.add_argument('--repeat', type=int, default=20, help='requests per page after the first')
+    run(parser.parse_args())
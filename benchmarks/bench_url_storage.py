@@ -0,0 +1,116 @@
+"""Database size and page-cache footprint before/after compact URL storage.
+
+A database is built at schema version 8 (full URL in contents.file_url)
+with URLs shaped like the real batch files: two thirds signed stream links
+(https://stream.pwjarvis.app/<JWT>/master.m3u8), the rest PDF notes. It is
+measured, migrated to the latest version (url_patterns + url_key) and
+measured again. Both are VACUUMed first so the sizes compare.
+
+"contents MB" is the contents table plus its index: the pages that have to
+be in the page cache for subject pages to be served without reading the
+file. "page read ms" times the subject page query for random subjects,
+on a connection with the app's pragmas: best of three passes.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import time
+import uuid
+
+from common import remove_db, temp_db_path
+
+import database
+
+JWT_HEADER = 'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9'
+TYPES = ('lecture', 'lecture', 'notes', 'dpp', 'solution', 'other')
+
+BEFORE = ("SELECT content_id, content_type, title, file_url FROM contents "
+          "WHERE subject_id=? AND content_type=? ORDER BY content_id LIMIT 26")
+AFTER = ("SELECT " + database.CARD_COLUMNS + " FROM contents c " + database.URL_JOIN +
+         " WHERE c.subject_id=? AND c.content_type=? ORDER BY c.content_id LIMIT 26")
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def content_url(rng, content_type):
+    video_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    if content_type == 'lecture':
+        payload = b64(json.dumps({'videoId': video_id, 'exp': 1755594056}, separators=(',', ':')).encode())
+        signature = b64(rng.getrandbits(256).to_bytes(32, 'big'))
+        return 'https://stream.pwjarvis.app/%s.%s.%s/master.m3u8' % (JWT_HEADER, payload, signature)
+    return 'https://static.pw.live/5eb393ee95fab7468a79d189/ADMIN/%s.pdf' % video_id
+
+
+def build(path, contents, subjects):
+    conn = database._connect(path)
+    database.migrate(conn, target=8)
+    rng = random.Random(1)
+    per_subject = contents // subjects
+    with conn:
+        conn.execute("INSERT INTO batches (batch_id, title) VALUES ('b', 'Batch')")
+        conn.executemany("INSERT INTO subjects (subject_id, batch_id, name) VALUES (?, 'b', ?)",
+                         [(s + 1, 'Subject %d' % s) for s in range(subjects)])
+
+        def rows():
+            # Subject by subject, the order an upload writes them in
+            for i in range(per_subject * subjects):
+                content_type = TYPES[i % len(TYPES)]
+                yield (i // per_subject + 1, content_type, 'Chapter %d Lecture %d' % (i % 40, i),
+                       content_url(rng, content_type))
+        conn.executemany("INSERT INTO contents (subject_id, content_type, title, file_url) VALUES (?, ?, ?, ?)",
+                         rows())
+    return conn
+
+
+def measure(conn, path, label, sql, subjects, rounds):
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = dict(conn.execute("SELECT name, COUNT(*) FROM dbstat GROUP BY name").fetchall())
+    content_pages = sum(n for name, n in pages.items() if name in ('contents', 'idx_contents_subject_type'))
+    rows = conn.execute("SELECT COUNT(*) FROM contents").fetchone()[0]
+    patterns = sum(n for name, n in pages.items() if 'url_patterns' in name)
+
+    reader = database._connect(path)
+    rng = random.Random(2)
+    picks = [(rng.randrange(1, subjects + 1), rng.choice(TYPES)) for _ in range(rounds)]
+    elapsed = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for params in picks:
+            reader.execute(sql, params).fetchall()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    reader.close()
+
+    print('%-7s %10d %10.1f %12.1f %10.0f %10d %12.3f' % (
+        label, rows, os.path.getsize(path) / 1e6, content_pages * page_size / 1e6,
+        content_pages * page_size / rows, patterns, elapsed / rounds * 1000))
+
+
+def run(args):
+    path = temp_db_path()
+    try:
+        conn = build(path, args.contents, args.subjects)
+        print('%-7s %10s %10s %12s %10s %10s %12s' % (
+            'schema', 'rows', 'db MB', 'contents MB', 'bytes/row', 'dict pages', 'page read ms'))
+        measure(conn, path, 'before', BEFORE, args.subjects, args.rounds)
+        start = time.perf_counter()
+        database.migrate(conn)
+        migrated = time.perf_counter() - start
+        measure(conn, path, 'after', AFTER, args.subjects, args.rounds)
+        print('migration: %.1f s' % migrated)
+        conn.close()
+    finally:
+        remove_db(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contents', type=int, default=1000000, help='content rows (default 1000000)')
+    parser.add_argument('--subjects', type=int, default=2000, help='subjects (default 2000)')
+    parser.add_argument('--rounds', type=int, default=2000, help='subject page queries timed (default 2000)')
+    run(parser.parse_args())
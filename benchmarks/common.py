@@ -0,0 +1,107 @@
+"""Shared helpers for the benchmark scripts in this directory.
+
+Run the scripts from the repository root, e.g. ``python benchmarks/bench_connections.py``.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+SAMPLE_FILE = os.path.join(ROOT, 'static', 'uploads', 'Parishram 2026 Hindi (UP Board 12th).txt')
+CHROME_UA = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+             '(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36')
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow the app's stdout logging so it does not skew timings"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def temp_db_path():
+    fd, path = tempfile.mkstemp(prefix='pw_bench_', suffix='.db')
+    os.close(fd)
+    os.remove(path)
+    return path
+
+
+def load_app(db_path):
+    """Import the Flask app pointed at a fresh database at ``db_path``"""
+    with quiet():
+        from app import app
+        import database
+        app.config['DATABASE'] = db_path
+        with app.app_context():
+            database.init_db()
+    return app
+
+
+def ingest_sample(app, batch_id='bench', title='Benchmark Batch', filepath=SAMPLE_FILE):
+    from app import parse_txt
+    with quiet(), app.app_context():
+        assert parse_txt(filepath, batch_id, title), 'ingest failed'
+
+
+def user_session():
+    """Session contents of a user holding a valid token"""
+    return {
+        'user_token': 'benchmark',
+        'token_expiry': int(time.time()) + 3600,
+    }
+
+
+def logged_in_client(app):
+    """Test client with a valid user token and a Chrome User-Agent"""
+    client = app.test_client()
+    client.environ_base['HTTP_USER_AGENT'] = CHROME_UA
+    with client.session_transaction() as sess:
+        sess.update(user_session())
+    return client
+
+
+def session_cookie(app):
+    """``Cookie`` header value carrying user_session(), for real HTTP clients"""
+    value = app.session_interface.get_signing_serializer(app).dumps(user_session())
+    return '%s=%s' % (app.config['SESSION_COOKIE_NAME'], value)
+
+
+def remove_db(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def measure(fn, seconds=2.0):
+    """Call ``fn`` repeatedly for ``seconds``; return (calls, calls_per_sec)"""
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        fn()
+        calls += 1
+    elapsed = time.perf_counter() - start
+    return calls, calls / elapsed
+
+
+def write_synthetic_batch(path, subjects=20, items_per_subject=1000):
+    """Write a batch file in the ``Subject -`` / ``Title:URL`` upload format"""
+    kinds = (
+        ('Lecture {n}', 'https://stream.example.app/{s}/{n}/master.m3u8'),
+        ('Lecture {n} Class Notes', 'https://cdn.example.com/{s}/{n}/notes.pdf'),
+        ('DPP {n}', 'https://cdn.example.com/{s}/{n}/dpp.pdf'),
+        ('DPP Solution {n}', 'https://cdn.example.com/{s}/{n}/solution.pdf'),
+    )
+    with open(path, 'w', encoding='utf-8') as f:
+        for s in range(subjects):
+            f.write('Subject %d -\n' % s)
+            for n in range(items_per_subject):
+                title, url = kinds[n % len(kinds)]
+                f.write('%s:%s\n' % (title.format(n=n), url.format(s=s, n=n)))
+    return path
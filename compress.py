@@ -0,0 +1,161 @@
+"""Smaller dynamic responses: minified templates and compressed bodies.
+
+Templates are whitespace-minified as Jinja loads them. Every run of
+whitespace that contains a newline becomes a single newline, which drops
+indentation, trailing spaces and blank lines. Newlines are kept so inline
+scripts that rely on them still parse. <pre> and <textarea> blocks are left
+as written. This happens once per template, not per request.
+
+HTML, JSON and plain-text responses of at least COMPRESS_MIN_SIZE bytes
+are compressed with the best encoding the client accepts: brotli at
+COMPRESS_BR_LEVEL, or gzip at COMPRESS_LEVEL. Streamed responses (API
+pages) are compressed as they stream. A body with an ETag always has the
+same bytes, so its compressed form is kept in an LRU keyed by ETag and
+encoding, and page-cache hits are not compressed again. Compressed
+responses get a weak ETag, since their bytes differ per encoding.
+COMPRESS_LEVEL=0 turns compression off, e.g. behind a proxy that already
+compresses.
+
+Brotli needs the optional ``brotli`` package; without it only gzip is
+offered.
+"""
+import re
+import zlib
+
+from flask import request
+from jinja2 import BaseLoader
+
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {'text/html', 'application/json', 'text/plain'}
+
+_PRESERVE = re.compile(r'<(pre|textarea)\b.*?</\1\s*>', re.S | re.I)
+_LINE_BREAKS = re.compile(r'[ \t\r]*\n\s*')
+
+compressed_cache = LRUCache(maxsize=256)
+
+
+def _squeeze(text):
+    return _LINE_BREAKS.sub('\n', text)
+
+
+def minify_html(source):
+    """Collapse whitespace around line breaks, outside <pre> and <textarea>"""
+    out = []
+    pos = 0
+    for match in _PRESERVE.finditer(source):
+        out.append(_squeeze(source[pos:match.start()]))
+        out.append(match.group())
+        pos = match.end()
+    out.append(_squeeze(source[pos:]))
+    return ''.join(out)
+
+
+class MinifyingLoader(BaseLoader):
+    """Wraps a Jinja loader; .html sources come back minified"""
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = self.loader.get_source(environment, template)
+        if template.endswith('.html'):
+            source = minify_html(source)
+        return source, filename, uptodate
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+
+def _compressor(encoding, config):
+    """(compress, flush) for one body"""
+    if encoding == 'br':
+        c = brotli.Compressor(quality=config['COMPRESS_BR_LEVEL'])
+        return c.process, c.finish
+    c = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)   # 31: gzip framing
+    return c.compress, c.flush
+
+
+def compress(data, encoding, config):
+    feed, flush = _compressor(encoding, config)
+    return feed(data) + flush()
+
+
+def _stream(chunks, encoding, config):
+    feed, flush = _compressor(encoding, config)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = feed(chunk)
+            if data:
+                yield data
+        yield flush()
+    finally:
+        # Lets stream_with_context pop its request context
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def negotiate(accept_encodings):
+    """'br', 'gzip' or None, honouring the client's q-values"""
+    offers = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return accept_encodings.best_match(offers)
+
+
+def configure(app):
+    """Size the compressed-body cache and put the template minifier in or
+    out as MINIFY_HTML says; call again after changing the config"""
+    compressed_cache.maxsize = app.config.get('COMPRESS_CACHE_SIZE', compressed_cache.maxsize)
+    loader = app.jinja_loader
+    if isinstance(loader, MinifyingLoader):
+        loader = loader.loader
+    app.jinja_loader = MinifyingLoader(loader) if app.config.get('MINIFY_HTML') else loader
+    # Templates compiled through the other loader must be loaded again
+    if 'jinja_env' in app.__dict__ and app.jinja_env.cache is not None:
+        app.jinja_env.cache.clear()
+
+
+def init_app(app):
+    """Install the template minifier and the compression hook. Call after
+    metrics/profiling init_app, so their timings include compression."""
+    configure(app)
+
+    @app.after_request
+    def compress_response(response):
+        config = app.config
+        if (not config['COMPRESS_LEVEL'] or response.mimetype not in COMPRESSIBLE
+                or response.direct_passthrough or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return response
+        length = response.calculate_content_length()   # None while streaming
+        if length is not None and length < config['COMPRESS_MIN_SIZE']:
+            return response
+        encoding = negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        if response.is_streamed:
+            response.response = _stream(response.response, encoding, config)
+            response.headers.pop('Content-Length', None)
+        else:
+            key = (etag, encoding) if etag else None
+            body = compressed_cache.get(key) if key else None
+            if body is None:
+                body = compress(response.get_data(), encoding, config)
+                if key:
+                    compressed_cache.set(key, body)
+            response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
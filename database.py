@@ -1,22 +1,185 @@
 import sqlite3
 import os
+import logging
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, has_app_context
+
+from cache import LRUCache
+from links import link_expiry, media_kind, url_host
+from metrics import record_query
+from profiling import skip_caches
+
+log = logging.getLogger(__name__)
+
+# Default path, used when no Flask app context is active (CLI scripts etc.)
+DATABASE = 'pw_data.db'
+
+# Pragmas applied once per connection, right after it is opened
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",   # 256MB memory-mapped I/O
+    "PRAGMA cache_size=-16000",     # ~16MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",       # subjects/contents cascade on delete
+)
+
+# Connections are kept per thread and reused across requests
+_local = threading.local()
+
+# SQLite connections must not be used across fork(). A forked child starts
+# with no connections; the ones it inherited are kept referenced (never
+# closed or collected) so the child cannot checkpoint or unlock the
+# parent's database files.
+_inherited = []
+
+
+def _forget_connections():
+    global _local
+    _inherited.append(_local)
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_forget_connections)
+
+
+def _db_path():
+    if has_app_context():
+        return current_app.config.get('DATABASE', DATABASE)
+    return DATABASE
+
+
+# Cursor/connection subclasses that report statement counts and time to metrics
+class MeteredCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(time.perf_counter() - start, sql=sql)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(time.perf_counter() - start, sql=sql)
+
+    # SQLite does most of a SELECT's work while stepping through rows, so
+    # fetch time counts towards query time (but not towards the statement count)
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            record_query(time.perf_counter() - start, statements=0)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            record_query(time.perf_counter() - start, statements=0)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            record_query(time.perf_counter() - start, statements=0)
+
+
+class MeteredConnection(sqlite3.Connection):
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    # The C implementations would bypass MeteredCursor.execute
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=10, factory=MeteredConnection)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_db():
+    """Return this thread's connection for the configured database, opening it on first use"""
+    path = _db_path()
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = _connect(path)
+    return conn
+
+
+def release_db(exc=None):
+    """Teardown hook: keep the connection open but never leak an open transaction"""
+    conns = getattr(_local, 'conns', None)
+    if not conns:
+        return
+    for conn in conns.values():
+        if conn.in_transaction:
+            conn.rollback()
+
+
+def close_db():
+    """Close every connection owned by the current thread"""
+    conns = getattr(_local, 'conns', None)
+    if not conns:
+        return
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
+
+
+def configure(app):
+    """Apply the config read at setup; call again after changing it"""
+    query_cache.maxsize = app.config.get('QUERY_CACHE_SIZE', query_cache.maxsize)
+
+
+def init_app(app):
+    configure(app)
+    app.teardown_appcontext(release_db)
+
 
 def init_db():
-    conn = sqlite3.connect('pw_data.db')
-    c = conn.cursor()
-    
+    conn = get_db()
+    migrate(conn)
+    purge_abandoned_batches(conn)
+
+
+# Schema migrations. MIGRATIONS[n] upgrades a database from version n to
+# n + 1; PRAGMA user_version records the version a file is at, so existing
+# pw_data.db files are upgraded in place the next time the app starts.
+
+def _migration_base_tables(c):
     c.execute('''CREATE TABLE IF NOT EXISTS batches (
                 batch_id TEXT PRIMARY KEY,
                 title TEXT NOT NULL,
                 description TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS subjects (
                 subject_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 batch_id TEXT,
                 name TEXT NOT NULL,
                 FOREIGN KEY (batch_id) REFERENCES batches(batch_id))''')
-    
+
     c.execute('''CREATE TABLE IF NOT EXISTS contents (
             content_id INTEGER PRIMARY KEY AUTOINCREMENT,
             subject_id INTEGER,
@@ -24,68 +187,767 @@ def init_db():
             title TEXT NOT NULL,
             file_url TEXT NOT NULL,
             FOREIGN KEY (subject_id) REFERENCES subjects(subject_id))''')
-    
-    conn.commit()
-    conn.close()
 
+
+def _migration_cascade_and_indexes(c):
+    # SQLite cannot alter a foreign key, so rebuild both child tables.
+    # Rows already orphaned by the old multi-step delete are dropped.
+    c.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('subjects', 'contents')")
+    sequences = c.fetchall()
+
+    c.execute('''CREATE TABLE subjects_new (
+                subject_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id TEXT NOT NULL REFERENCES batches(batch_id) ON DELETE CASCADE,
+                name TEXT NOT NULL)''')
+    c.execute('''INSERT INTO subjects_new (subject_id, batch_id, name)
+                 SELECT subject_id, batch_id, name FROM subjects
+                 WHERE batch_id IN (SELECT batch_id FROM batches)''')
+
+    c.execute('''CREATE TABLE contents_new (
+            content_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject_id INTEGER NOT NULL REFERENCES subjects(subject_id) ON DELETE CASCADE,
+            content_type TEXT CHECK(content_type IN ('lecture', 'notes', 'dpp', 'solution', 'other')),
+            title TEXT NOT NULL,
+            file_url TEXT NOT NULL)''')
+    c.execute('''INSERT INTO contents_new (content_id, subject_id, content_type, title, file_url)
+                 SELECT content_id, subject_id, content_type, title, file_url FROM contents
+                 WHERE subject_id IN (SELECT subject_id FROM subjects_new)''')
+
+    c.execute("DROP TABLE contents")
+    c.execute("DROP TABLE subjects")
+    c.execute("ALTER TABLE subjects_new RENAME TO subjects")
+    c.execute("ALTER TABLE contents_new RENAME TO contents")
+
+    # Keep AUTOINCREMENT from ever handing out an id that was used before
+    for name, seq in sequences:
+        c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq, name))
+
+    c.execute("CREATE INDEX idx_batches_created ON batches(created_at)")
+    c.execute("CREATE INDEX idx_subjects_batch ON subjects(batch_id)")
+    c.execute("CREATE INDEX idx_contents_subject_type ON contents(subject_id, content_type)")
+
+
+def _migration_data_generation(c):
+    # Single-row counter bumped by every write that changes what readers see
+    c.execute('''CREATE TABLE data_generation (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                generation INTEGER NOT NULL)''')
+    c.execute("INSERT INTO data_generation VALUES (1, 0)")
+
+
+def _migration_data_updated_at(c):
+    # Unix time of the last bump, for Last-Modified headers
+    c.execute("ALTER TABLE data_generation ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE data_generation SET updated_at = CAST(strftime('%s', 'now') AS INTEGER)")
+
+
+def _migration_search_index(c):
+    # Full-text index over content titles plus their subject and batch names,
+    # keyed by content_id. Writers add and remove rows in bulk (see
+    # index_batch_search / delete_batch_rows); per-row insert/delete triggers
+    # made a 20k-line ingest several times slower. Renames are rare, so they
+    # are kept in step by triggers.
+    c.execute('''CREATE VIRTUAL TABLE search_index USING fts5(
+                title, subject, batch,
+                tokenize = 'unicode61 remove_diacritics 2')''')
+
+    c.execute('''CREATE TRIGGER contents_search_update AFTER UPDATE OF title, subject_id ON contents BEGIN
+                UPDATE search_index
+                SET title = new.title,
+                    subject = (SELECT name FROM subjects WHERE subject_id = new.subject_id)
+                WHERE rowid = new.content_id;
+                END''')
+    c.execute('''CREATE TRIGGER subjects_search_rename AFTER UPDATE OF name ON subjects BEGIN
+                UPDATE search_index SET subject = new.name
+                WHERE rowid IN (SELECT content_id FROM contents WHERE subject_id = new.subject_id);
+                END''')
+    c.execute('''CREATE TRIGGER batches_search_rename AFTER UPDATE OF title ON batches BEGIN
+                UPDATE search_index SET batch = new.title
+                WHERE rowid IN (SELECT c.content_id FROM contents c
+                                JOIN subjects s ON s.subject_id = c.subject_id
+                                WHERE s.batch_id = new.batch_id);
+                END''')
+
+    c.execute('''INSERT INTO search_index (rowid, title, subject, batch)
+                 SELECT c.content_id, c.title, s.name, b.title
+                 FROM contents c
+                 JOIN subjects s ON s.subject_id = c.subject_id
+                 JOIN batches b ON b.batch_id = s.batch_id''')
+
+
+def _migration_content_counts(c):
+    # Denormalised counters so listing pages never count rows. Writers refresh
+    # a whole batch at once (see refresh_batch_counts); rows go with their
+    # subject through the cascade.
+    c.execute('''CREATE TABLE content_counts (
+                subject_id INTEGER NOT NULL REFERENCES subjects(subject_id) ON DELETE CASCADE,
+                content_type TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (subject_id, content_type)) WITHOUT ROWID''')
+    c.execute("ALTER TABLE batches ADD COLUMN subject_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE batches ADD COLUMN content_count INTEGER NOT NULL DEFAULT 0")
+
+    c.execute('''INSERT INTO content_counts (subject_id, content_type, count)
+                 SELECT subject_id, content_type, COUNT(*) FROM contents
+                 GROUP BY subject_id, content_type''')
+    c.execute('''UPDATE batches SET
+                 subject_count = (SELECT COUNT(*) FROM subjects s WHERE s.batch_id = batches.batch_id),
+                 content_count = (SELECT COALESCE(SUM(cc.count), 0) FROM content_counts cc
+                                  JOIN subjects s ON s.subject_id = cc.subject_id
+                                  WHERE s.batch_id = batches.batch_id)''')
+
+
+def _migration_batch_generation(c):
+    # Data generation of the batch's last change, so exports can skip batches
+    # that did not change
+    c.execute("ALTER TABLE batches ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE batches SET generation = (SELECT generation FROM data_generation WHERE id = 1)")
+
+
+def _migration_batch_published(c):
+    # Uploads build the new batch under a hidden id and swap it in when
+    # complete (see ingest._publish_batch); listings skip unpublished rows
+    c.execute("ALTER TABLE batches ADD COLUMN published INTEGER NOT NULL DEFAULT 1")
+
+
+def _migration_compact_urls(c):
+    # Content URLs repeat their host, leading path, JWT header and suffix on
+    # every row. Intern those in url_patterns and keep only the varying
+    # middle in contents (see split_url); SQLite cannot drop a column, so
+    # contents is rebuilt.
+    c.execute('''CREATE TABLE url_patterns (
+                pattern_id INTEGER PRIMARY KEY,
+                prefix TEXT NOT NULL,
+                suffix TEXT NOT NULL,
+                UNIQUE (prefix, suffix))''')
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'contents'")
+    sequence = c.fetchone()
+
+    c.execute('''CREATE TABLE contents_new (
+            content_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject_id INTEGER NOT NULL REFERENCES subjects(subject_id) ON DELETE CASCADE,
+            content_type TEXT CHECK(content_type IN ('lecture', 'notes', 'dpp', 'solution', 'other')),
+            title TEXT NOT NULL,
+            url_pattern INTEGER NOT NULL REFERENCES url_patterns(pattern_id),
+            url_key TEXT NOT NULL)''')
+    conn = c.connection
+    patterns = {}
+
+    def rows():
+        for content_id, subject_id, content_type, title, file_url in conn.execute(
+                "SELECT content_id, subject_id, content_type, title, file_url FROM contents"):
+            prefix, key, suffix = split_url(file_url)
+            pattern_id = patterns.get((prefix, suffix))
+            if pattern_id is None:
+                pattern_id = conn.execute("INSERT INTO url_patterns (prefix, suffix) VALUES (?, ?)",
+                                          (prefix, suffix)).lastrowid
+                patterns[prefix, suffix] = pattern_id
+            yield content_id, subject_id, content_type, title, pattern_id, key
+
+    c.executemany('''INSERT INTO contents_new (content_id, subject_id, content_type, title, url_pattern, url_key)
+                     VALUES (?, ?, ?, ?, ?, ?)''', rows())
+    c.execute("DROP TABLE contents")
+    # The search triggers on subjects and batches name contents; the legacy
+    # rename leaves them alone instead of failing on the dropped table
+    c.execute("PRAGMA legacy_alter_table=ON")
+    c.execute("ALTER TABLE contents_new RENAME TO contents")
+    c.execute("PRAGMA legacy_alter_table=OFF")
+    if sequence:
+        c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'contents'", (sequence[0],))
+
+    c.execute("CREATE INDEX idx_contents_subject_type ON contents(subject_id, content_type)")
+    c.execute('''CREATE TRIGGER contents_search_update AFTER UPDATE OF title, subject_id ON contents BEGIN
+                UPDATE search_index
+                SET title = new.title,
+                    subject = (SELECT name FROM subjects WHERE subject_id = new.subject_id)
+                WHERE rowid = new.content_id;
+                END''')
+
+
+def _migration_link_metadata(c):
+    # What each link is and when it stops working, read from the URL once at
+    # ingest (see links.py), so pages can filter on it in SQL. The host
+    # depends on the prefix alone, so it is kept with the pattern.
+    c.execute("ALTER TABLE url_patterns ADD COLUMN host TEXT")
+    c.execute("ALTER TABLE contents ADD COLUMN media_kind TEXT")
+    c.execute("ALTER TABLE contents ADD COLUMN expires_at INTEGER")
+    conn = c.connection
+    c.executemany("UPDATE url_patterns SET host = ? WHERE pattern_id = ?",
+                  [(url_host(prefix), pattern_id) for pattern_id, prefix in
+                   conn.execute("SELECT pattern_id, prefix FROM url_patterns").fetchall()])
+    rows = conn.execute("SELECT c.content_id, " + FILE_URL + " FROM contents c " + URL_JOIN)
+    c.executemany("UPDATE contents SET media_kind = ?, expires_at = ? WHERE content_id = ?",
+                  ((media_kind(url), link_expiry(url), content_id) for content_id, url in rows))
+
+    # Partial indexes over the rows that can be dead, so counting those per
+    # subject (get_content_counts) and the expiry report skip live ones
+    c.execute("CREATE INDEX idx_url_patterns_host ON url_patterns(host)")
+    c.execute('''CREATE INDEX idx_contents_expiry ON contents(subject_id, expires_at, content_type)
+                 WHERE expires_at IS NOT NULL''')
+
+
+def _migration_jobs(c):
+    # Upload jobs, shared by every worker process. ``data`` is the job's
+    # report as JSON; the worker running the job rewrites it every few
+    # seconds (updated_at), so a job that stops being written lost its worker.
+    c.execute('''CREATE TABLE jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX idx_jobs_created ON jobs(created_at)")
+    # A job's claim on a batch; claims on one batch are served in seq order
+    c.execute('''CREATE TABLE job_slots (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL REFERENCES jobs(job_id) ON DELETE CASCADE,
+                batch_id TEXT NOT NULL)''')
+    c.execute("CREATE INDEX idx_job_slots_batch ON job_slots(batch_id, seq)")
+    c.execute("CREATE INDEX idx_job_slots_job ON job_slots(job_id)")
+
+
+MIGRATIONS = [
+    _migration_base_tables,
+    _migration_cascade_and_indexes,
+    _migration_data_generation,
+    _migration_data_updated_at,
+    _migration_search_index,
+    _migration_content_counts,
+    _migration_batch_generation,
+    _migration_batch_published,
+    _migration_compact_urls,
+    _migration_link_metadata,
+    _migration_jobs,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn, target=SCHEMA_VERSION):
+    """Apply pending migrations up to ``target``, one transaction each"""
+    # Table rebuilds need foreign keys off; the pragma is a no-op inside a transaction
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        while True:
+            # BEGIN IMMEDIATE so two workers starting together migrate once
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= target:
+                conn.rollback()
+                break
+            try:
+                c = conn.cursor()
+                MIGRATIONS[version](c)
+                if c.execute("PRAGMA foreign_key_check").fetchone():
+                    raise sqlite3.IntegrityError(f"migration {version + 1} left dangling foreign keys")
+                c.execute(f"PRAGMA user_version = {version + 1}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            log.info("Database migrated to schema version %d", version + 1)
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+
+# Search index maintenance; callers pass a WHERE clause over contents c,
+# subjects s and batches b
+SEARCH_INDEX_INSERT = '''INSERT INTO search_index (rowid, title, subject, batch)
+                         SELECT c.content_id, c.title, s.name, b.title
+                         FROM contents c
+                         JOIN subjects s ON s.subject_id = c.subject_id
+                         JOIN batches b ON b.batch_id = s.batch_id'''
+
+
+def index_batch_search(c, batch_id, after_content_id=0):
+    """Add the batch's content rows with ids above ``after_content_id`` to the search index (no commit)"""
+    c.execute(SEARCH_INDEX_INSERT + " WHERE s.batch_id = ? AND c.content_id > ?",
+              (batch_id, after_content_id))
+
+
+def refresh_batch_counts(c, batch_id):
+    """Recount content_counts and the batch's counter columns (no commit)"""
+    c.execute('''DELETE FROM content_counts WHERE subject_id IN (
+                 SELECT subject_id FROM subjects WHERE batch_id = ?)''', (batch_id,))
+    c.execute('''INSERT INTO content_counts (subject_id, content_type, count)
+                 SELECT c.subject_id, c.content_type, COUNT(*) FROM contents c
+                 JOIN subjects s ON s.subject_id = c.subject_id
+                 WHERE s.batch_id = ?
+                 GROUP BY c.subject_id, c.content_type''', (batch_id,))
+    c.execute('''UPDATE batches SET
+                 subject_count = (SELECT COUNT(*) FROM subjects WHERE batch_id = ?),
+                 content_count = (SELECT COALESCE(SUM(cc.count), 0) FROM content_counts cc
+                                  JOIN subjects s ON s.subject_id = cc.subject_id
+                                  WHERE s.batch_id = ?)
+                 WHERE batch_id = ?''', (batch_id, batch_id, batch_id))
+
+
+# Content URLs are stored in three parts: url_patterns interns the prefix
+# and suffix that many rows share, and contents keeps only the varying middle
+# (url_key) plus the pattern id. Readers join them back together with
+# FILE_URL; patterns are never deleted, so an interned id stays valid.
+URL_JOIN = "JOIN url_patterns p ON p.pattern_id = c.url_pattern"
+FILE_URL = "p.prefix || c.url_key || p.suffix"
+# Downloads go through the .com mirror of the .app stream hosts. The
+# rewrite runs on the whole URL, as the page template used to do it
+DOWNLOAD_URL = "replace(" + FILE_URL + ", '.app', '.com')"
+
+_EXTENSION = re.compile(r'\.[A-Za-z0-9]{1,5}$')
+
+
+def split_url(url):
+    """Split a URL into (prefix, key, suffix), where prefix + key + suffix == url.
+
+    The key is the longest path segment (the file id or signed token),
+    widened to take in any all-digit segments (numeric ids). A JWT header,
+    constant per signer, and a file extension are kept out of it. The
+    prefix always holds the scheme and host, when there is one.
+    """
+    scheme = url.find('://')
+    if scheme == -1:
+        return '', url, ''
+    start = url.find('/', scheme + 3)
+    if start == -1:
+        # No path, e.g. https://host?token=...: the rest is the key
+        host_end = min(i for i in (url.find('?', scheme + 3), url.find('#', scheme + 3), len(url)) if i != -1)
+        return url[:host_end], url[host_end:], ''
+    key_start = key_end = pos = start + 1
+    spans = []
+    for segment in url[pos:].split('/'):
+        if len(segment) > key_end - key_start:
+            key_start, key_end = pos, pos + len(segment)
+        if segment.isdigit():
+            spans.append((pos, pos + len(segment)))
+        pos += len(segment) + 1
+    if spans:
+        key_start = min(key_start, spans[0][0])
+        key_end = max(key_end, spans[-1][1])
+    if url.startswith('eyJ', key_start) and url.count('.', key_start, key_end) == 2:
+        key_start = url.index('.', key_start) + 1
+    extension = _EXTENSION.search(url, key_start, key_end)
+    if extension and extension.start() > key_start:
+        key_end = extension.start()
+    return url[:key_start], url[key_start:key_end], url[key_end:]
+
+
+def encode_urls(c, urls):
+    """(url_pattern, url_key) for each URL, interning new patterns (no commit)"""
+    parts = [split_url(url) for url in urls]
+    ids = {}
+    for prefix, _, suffix in parts:
+        if (prefix, suffix) not in ids:
+            c.execute("INSERT OR IGNORE INTO url_patterns (prefix, suffix, host) VALUES (?, ?, ?)",
+                      (prefix, suffix, url_host(prefix)))
+            ids[prefix, suffix] = c.execute("SELECT pattern_id FROM url_patterns WHERE prefix = ? AND suffix = ?",
+                                            (prefix, suffix)).fetchone()[0]
+    return [(ids[prefix, suffix], key) for prefix, key, suffix in parts]
+
+
+# Data generation. Every write bumps the shared counter inside its own
+# transaction. Readers re-read it only when PRAGMA data_version says another
+# connection (another thread or gunicorn worker) has committed, so checking
+# for changes costs one pragma on the already-open connection.
+
+def bump_generation(c, batch_id=None):
+    """Bump the data generation; with ``batch_id``, also stamp it on that batch"""
+    c.execute("""UPDATE data_generation
+                 SET generation = generation + 1,
+                     updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+                 WHERE id = 1""")
+    if batch_id is not None:
+        c.execute("""UPDATE batches SET generation = (SELECT generation FROM data_generation WHERE id = 1)
+                     WHERE batch_id = ?""", (batch_id,))
+    # This connection's own commits do not change its data_version
+    getattr(_local, 'generations', {}).pop(_db_path(), None)
+
+
+def current_generation():
+    conn = get_db()
+    path = _db_path()
+    generations = getattr(_local, 'generations', None)
+    if generations is None:
+        generations = _local.generations = {}
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    seen = generations.get(path)
+    if seen is not None and seen[0] == data_version:
+        return seen[1]
+    generation = conn.execute("SELECT generation FROM data_generation WHERE id = 1").fetchone()[0]
+    if not conn.in_transaction:
+        generations[path] = (data_version, generation)
+    return generation
+
+
+# Read-through cache for the lookup helpers below. The generation is part of
+# the key, so entries from older generations are never hit and age out.
+query_cache = LRUCache(maxsize=512)
+
+
+def cached_query(fn):
+    @wraps(fn)
+    def wrapper(*args):
+        # Inside a write transaction we may see uncommitted rows; never cache those
+        if get_db().in_transaction or skip_caches():
+            return fn(*args)
+        generation = current_generation()
+        key = (_db_path(), generation, fn.__name__) + args
+        entry = query_cache.get(key)
+        if entry is not None:
+            return entry[0]
+        value = fn(*args)
+        query_cache.set(key, (value,))
+        return value
+    return wrapper
+
+
+# `with conn:` commits on success and rolls back on error, so a failed insert
+# never leaves the shared per-thread connection inside an open transaction
 def add_batch(batch_id, title, description=""):
-    conn = sqlite3.connect('pw_data.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO batches VALUES (?, ?, ?, datetime('now'))", 
-              (batch_id, title, description))
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT INTO batches (batch_id, title, description, created_at) VALUES (?, ?, ?, datetime('now'))",
+                     (batch_id, title, description))
+        bump_generation(conn, batch_id)
 
 def add_subject(batch_id, subject_name):
-    conn = sqlite3.connect('pw_data.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO subjects (batch_id, name) VALUES (?, ?)",
-              (batch_id, subject_name))
-    subject_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return subject_id
+    conn = get_db()
+    with conn:
+        c = conn.execute("INSERT INTO subjects (batch_id, name) VALUES (?, ?)",
+                         (batch_id, subject_name))
+        conn.execute("UPDATE batches SET subject_count = subject_count + 1 WHERE batch_id = ?", (batch_id,))
+        bump_generation(conn, batch_id)
+    return c.lastrowid
 
 def add_content(subject_id, content_type, title, file_url):
-    conn = sqlite3.connect('pw_data.db')
+    conn = get_db()
+    with conn:
+        bump_generation(conn)
+        (url_pattern, url_key), = encode_urls(conn, [file_url])
+        c = conn.execute("""INSERT INTO contents (subject_id, content_type, title, url_pattern, url_key,
+                                                  media_kind, expires_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                         (subject_id, content_type, title, url_pattern, url_key,
+                          media_kind(file_url), link_expiry(file_url)))
+        conn.execute(SEARCH_INDEX_INSERT + " WHERE c.content_id = ?", (c.lastrowid,))
+        conn.execute('''INSERT INTO content_counts (subject_id, content_type, count) VALUES (?, ?, 1)
+                        ON CONFLICT (subject_id, content_type) DO UPDATE SET count = count + 1''',
+                     (subject_id, content_type))
+        conn.execute('''UPDATE batches SET content_count = content_count + 1,
+                        generation = (SELECT generation FROM data_generation WHERE id = 1)
+                        WHERE batch_id = (SELECT batch_id FROM subjects WHERE subject_id = ?)''',
+                     (subject_id,))
+
+# Ingest staging: uploads are parsed into a private scratch database first,
+# so neither a slow upload nor a bad file holds the write lock on the live
+# tables, then published with one INSERT ... SELECT transaction.
+STAGING_SCHEMA = (
+    "CREATE TABLE staging.staged_subjects (seq INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+    """CREATE TABLE staging.staged_patterns (
+        seq INTEGER PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        suffix TEXT NOT NULL,
+        host TEXT
+    )""",
+    """CREATE TABLE staging.staged_contents (
+        seq INTEGER PRIMARY KEY,
+        subject_seq INTEGER NOT NULL,
+        content_type TEXT NOT NULL,
+        title TEXT NOT NULL,
+        pattern_seq INTEGER NOT NULL,
+        url_key TEXT NOT NULL,
+        media_kind TEXT,
+        expires_at INTEGER
+    )""",
+)
+
+@contextmanager
+def staging_db(conn):
+    """Attach an empty scratch database to ``conn`` as ``staging`` for the block.
+
+    It lives in a file next to the main database, so staging a huge upload
+    does not grow memory, and is deleted on exit.
+    """
+    path = '%s.staging-%s' % (_db_path(), secrets.token_hex(4))
+    conn.execute("ATTACH DATABASE ? AS staging", (path,))
+    try:
+        # Scratch data: no journal, no fsync
+        conn.execute("PRAGMA staging.journal_mode=OFF")
+        conn.execute("PRAGMA staging.synchronous=OFF")
+        for statement in STAGING_SCHEMA:
+            conn.execute(statement)
+        yield
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE staging")
+        if os.path.exists(path):
+            os.remove(path)
+
+def swap_batch(c, batch_id, shadow_id, retired_id):
+    """Publish the unpublished batch ``shadow_id`` as ``batch_id`` (no commit).
+
+    The live batch's subjects move to the unpublished ``retired_id`` for
+    ``purge_batch``. Only batch rows and subject rows change, so this is
+    quick however many contents either batch has.
+    """
+    c.execute("SELECT 1 FROM batches WHERE batch_id = ?", (batch_id,))
+    if c.fetchone():
+        c.execute("""INSERT INTO batches (batch_id, title, description, created_at, published)
+                     SELECT ?, title, description, created_at, 0 FROM batches WHERE batch_id = ?""",
+                  (retired_id, batch_id))
+        c.execute("UPDATE subjects SET batch_id = ? WHERE batch_id = ?", (retired_id, batch_id))
+        c.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+    c.execute("""INSERT INTO batches (batch_id, title, description, created_at, subject_count, content_count)
+                 SELECT ?, title, description, created_at, subject_count, content_count
+                 FROM batches WHERE batch_id = ?""", (batch_id, shadow_id))
+    c.execute("UPDATE subjects SET batch_id = ? WHERE batch_id = ?", (batch_id, shadow_id))
+    c.execute("DELETE FROM batches WHERE batch_id = ?", (shadow_id,))
+
+# Chunked writers hold the write lock for WRITE_SLICE seconds at most, then
+# leave it free for WRITE_PAUSE. SQLite's busy handler polls with backoff (up
+# to every 100ms), so a writer that re-takes the lock at once starves everyone
+# else, and a shorter gap can fall between two polls. Writes that finish
+# within one slice never pause.
+WRITE_SLICE = 0.5
+WRITE_PAUSE = 0.1
+
+def write_pacer():
+    """A function for chunked writers to call after each commit; it sleeps
+    WRITE_PAUSE once WRITE_SLICE seconds have gone by since the last pause"""
+    last = time.monotonic()
+
+    def pace():
+        nonlocal last
+        if time.monotonic() - last >= WRITE_SLICE:
+            time.sleep(WRITE_PAUSE)
+            last = time.monotonic()
+    return pace
+
+def purge_batch(conn, batch_id, chunk_size=5000):
+    """Delete an unpublished batch in short transactions of whole subjects
+    (about ``chunk_size`` contents each), so other writers get the lock in
+    between; readers never see the batch, so partial progress is fine"""
+    pace = write_pacer()
     c = conn.cursor()
-    c.execute("INSERT INTO contents (subject_id, content_type, title, file_url) VALUES (?, ?, ?, ?)",
-              (subject_id, content_type, title, file_url))
-    conn.commit()
-    conn.close()
+    try:
+        c.execute("""SELECT s.subject_id, (SELECT COUNT(*) FROM contents c WHERE c.subject_id = s.subject_id)
+                     FROM subjects s WHERE s.batch_id = ?""", (batch_id,))
+        groups = [[]]
+        size = 0
+        for subject_id, count in c.fetchall():
+            if size >= chunk_size:
+                groups.append([])
+                size = 0
+            groups[-1].append((subject_id,))
+            size += count
+        for group in groups:
+            c.execute("BEGIN IMMEDIATE")
+            c.executemany("DELETE FROM search_index WHERE rowid IN "
+                          "(SELECT content_id FROM contents WHERE subject_id = ?)", group)
+            c.executemany("DELETE FROM subjects WHERE subject_id = ?", group)
+            conn.commit()
+            pace()
+        c.execute("DELETE FROM batches WHERE batch_id = ? AND published = 0", (batch_id,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def purge_abandoned_batches(conn):
+    """Remove unpublished batches left behind by an ingest that died midway"""
+    rows = conn.execute("""SELECT batch_id FROM batches
+                           WHERE published = 0 AND created_at < datetime('now', '-1 hour')""").fetchall()
+    for row in rows:
+        log.warning("Removing unpublished batch %s left by an interrupted upload", row[0])
+        purge_batch(conn, row[0])
 
+def delete_batch_rows(c, batch_id):
+    """Delete a batch using cursor ``c`` (no commit); subjects and contents cascade"""
+    c.execute('''DELETE FROM search_index WHERE rowid IN (
+                 SELECT c.content_id FROM contents c
+                 JOIN subjects s ON s.subject_id = c.subject_id
+                 WHERE s.batch_id = ?)''', (batch_id,))
+    c.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+
+def delete_batch(batch_id):
+    conn = get_db()
+    with conn:
+        c = conn.cursor()
+        delete_batch_rows(c, batch_id)
+        bump_generation(c)
+
+@cached_query
+def get_data_updated_at():
+    """Unix time of the last write to batches/subjects/contents"""
+    return get_db().execute("SELECT updated_at FROM data_generation WHERE id = 1").fetchone()[0]
+
+@cached_query
 def get_all_batches():
-    conn = sqlite3.connect('pw_data.db')
-    conn.row_factory = sqlite3.Row  # Use Row factory for dictionary-like access
-    c = conn.cursor()
-    c.execute("SELECT batch_id, title, created_at FROM batches ORDER BY created_at DESC")
-    batches = c.fetchall()
-    conn.close()
-    return batches
+    c = get_db().execute("""SELECT batch_id, title, created_at, subject_count, content_count
+                            FROM batches WHERE published = 1 ORDER BY created_at DESC""")
+    return c.fetchall()
 
+@cached_query
 def get_batch(batch_id):
-    conn = sqlite3.connect('pw_data.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT batch_id, title, created_at FROM batches WHERE batch_id=?", (batch_id,))
-    batch = c.fetchone()
-    conn.close()
-    return batch
+    c = get_db().execute("""SELECT batch_id, title, created_at, subject_count, content_count
+                            FROM batches WHERE batch_id=? AND published = 1""", (batch_id,))
+    return c.fetchone()
 
-def get_subjects(batch_id):
-    conn = sqlite3.connect('pw_data.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT subject_id, name FROM subjects WHERE batch_id=?", (batch_id,))
-    subjects = c.fetchall()
-    conn.close()
-    return subjects
+@cached_query
+def get_subject(subject_id):
+    # Subjects of unpublished batches (an upload still being copied in, or
+    # the old rows of a replaced batch awaiting purge) are not visible
+    c = get_db().execute("""SELECT s.* FROM subjects s JOIN batches b ON b.batch_id = s.batch_id
+                            WHERE s.subject_id = ? AND b.published = 1""", (subject_id,))
+    return c.fetchone()
+
+@cached_query
+def get_subjects(batch_id, live_at=None):
+    """Subjects of a batch with their content and lecture counts.
 
+    With ``live_at``, links expired by then (see LIVE_LINK) are not counted,
+    so the counts match the subject page. As in get_content_counts, they
+    are counted through the partial expiry index. Without it, expires_at <= NULL
+    matches nothing and every link counts.
+    """
+    c = get_db().execute("""SELECT s.subject_id, s.name,
+                                   COALESCE(SUM(cc.count), 0) - COALESCE(d.contents, 0) AS content_count,
+                                   COALESCE(SUM(CASE WHEN cc.content_type = 'lecture' THEN cc.count END), 0)
+                                       - COALESCE(d.lectures, 0) AS lecture_count
+                            FROM subjects s
+                            LEFT JOIN content_counts cc ON cc.subject_id = s.subject_id
+                            LEFT JOIN (SELECT c.subject_id, COUNT(*) AS contents,
+                                              SUM(c.content_type = 'lecture') AS lectures
+                                       FROM subjects ds JOIN contents c ON c.subject_id = ds.subject_id
+                                       WHERE ds.batch_id = ? AND c.expires_at <= ?
+                                       GROUP BY c.subject_id) d ON d.subject_id = s.subject_id
+                            WHERE s.batch_id=?
+                            GROUP BY s.subject_id ORDER BY s.subject_id""", (batch_id, live_at, batch_id))
+    return c.fetchall()
+
+@cached_query
 def get_contents(subject_id):
-    conn = sqlite3.connect('pw_data.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT content_type, title, file_url FROM contents WHERE subject_id=?", (subject_id,))
-    contents = c.fetchall()
-    conn.close()
-    return contents
\ No newline at end of file
+    c = get_db().execute("SELECT c.content_type, c.title, " + FILE_URL + " AS file_url FROM contents c " + URL_JOIN +
+                         " WHERE c.subject_id=? ORDER BY c.content_type, c.content_id", (subject_id,))
+    return c.fetchall()
+
+# Columns of a content card on the subject page
+CARD_COLUMNS = ("c.content_id, c.content_type, c.title, " + FILE_URL + " AS file_url, "
+                + DOWNLOAD_URL + " AS download_url")
+
+# Links a visitor can still open: not expired at the time passed for the ?.
+# Links of an unknown media kind (notes, DPPs on other hosts) stay; only the
+# expiry is known to kill a link. Pass link_clock(), which moves in steps, so
+# cached queries and pages stay valid in between.
+LIVE_LINK = "(c.expires_at IS NULL OR c.expires_at > ?)"
+EXPIRY_CHECK_INTERVAL = 300
+
+def link_clock():
+    """Now, rounded up to EXPIRY_CHECK_INTERVAL: links about to expire count as expired"""
+    now = int(time.time())
+    return now - now % EXPIRY_CHECK_INTERVAL + EXPIRY_CHECK_INTERVAL
+
+def _live_filter(live_at):
+    return (" AND " + LIVE_LINK, [live_at]) if live_at is not None else ("", [])
+
+@cached_query
+def get_contents_page(subject_id, content_type, after_id=0, limit=25, live_at=None):
+    """One keyset page of a subject's contents of one type, oldest first.
+
+    With ``live_at``, only links still live at that time (see LIVE_LINK).
+    """
+    live, live_params = _live_filter(live_at)
+    c = get_db().execute("SELECT " + CARD_COLUMNS + " FROM contents c " + URL_JOIN + """
+                            WHERE c.subject_id=? AND c.content_type=? AND c.content_id>?""" + live + """
+                            ORDER BY c.content_id LIMIT ?""",
+                         [subject_id, content_type, after_id] + live_params + [limit])
+    return c.fetchall()
+
+@cached_query
+def get_subject_sections(subject_id, content_types, per_type, live_at=None):
+    """First ``per_type`` contents of each type, as {content_type: rows}.
+
+    One ordered statement: a UNION ALL of per-type LIMIT queries, each a short walk
+    of idx_contents_subject_type, so the cost does not grow with the subject.
+    ``live_at`` filters as in get_contents_page.
+    """
+    live, live_params = _live_filter(live_at)
+    arm = "SELECT * FROM (SELECT " + CARD_COLUMNS + " FROM contents c " + URL_JOIN + """
+                          WHERE c.subject_id=? AND c.content_type=?""" + live + """
+                          ORDER BY c.content_id LIMIT ?)"""
+    params = []
+    for content_type in content_types:
+        params += [subject_id, content_type] + live_params + [per_type]
+    sections = {content_type: [] for content_type in content_types}
+    sql = " UNION ALL ".join([arm] * len(content_types)) + " ORDER BY content_type, content_id"
+    for row in get_db().execute(sql, params):
+        sections[row['content_type']].append(row)
+    return sections
+
+@cached_query
+def get_content_counts(subject_id, live_at=None):
+    """{content_type: count} for a subject, from the content_counts table.
+
+    With ``live_at``, rows expired by then (see LIVE_LINK) are left out.
+    Those are counted through the partial expiry index, so the cost grows
+    with the dead rows only.
+    """
+    db = get_db()
+    counts = dict(db.execute("SELECT content_type, count FROM content_counts WHERE subject_id=?",
+                             (subject_id,)).fetchall())
+    if live_at is not None:
+        dead = db.execute("""SELECT content_type, COUNT(*) FROM contents
+                             WHERE subject_id=? AND expires_at <= ? GROUP BY content_type""",
+                          (subject_id, live_at))
+        for content_type, n in dead:
+            counts[content_type] -= n
+    return counts
+
+def get_expiring_batches(until, now):
+    """Published batches with links expiring before ``until`` (Unix time), soonest first.
+
+    ``expired`` counts those already dead at ``now``. Seeks idx_contents_expiry
+    per subject.
+    """
+    c = get_db().execute("""SELECT b.batch_id, b.title, b.content_count,
+                                   COUNT(*) AS expiring, SUM(c.expires_at <= ?) AS expired,
+                                   MIN(c.expires_at) AS first_expiry, MAX(c.expires_at) AS last_expiry
+                            FROM batches b
+                            JOIN subjects s ON s.batch_id = b.batch_id
+                            JOIN contents c ON c.subject_id = s.subject_id
+                            WHERE c.expires_at < ? AND b.published = 1
+                            GROUP BY b.batch_id ORDER BY first_expiry""", (now, until))
+    return c.fetchall()
+
+# Full-text search
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix"""
+    terms = [t.replace('"', '') for t in text.split()]
+    terms = [t for t in terms if t]
+    if not terms:
+        return None
+    return ' '.join('"%s"' % t for t in terms) + '*'
+
+def search_contents(text, content_type=None, batch_id=None, limit=20, offset=0):
+    """Ranked matches for ``text`` (best first); title matches weigh most"""
+    query = fts_query(text)
+    if query is None:
+        return []
+    sql = '''SELECT c.content_id, c.content_type, c.title, ''' + FILE_URL + ''' AS file_url,
+                     s.subject_id, s.name AS subject_name,
+                     b.batch_id, b.title AS batch_title
+              FROM search_index
+              JOIN contents c ON c.content_id = search_index.rowid
+              ''' + URL_JOIN + '''
+              JOIN subjects s ON s.subject_id = c.subject_id
+              JOIN batches b ON b.batch_id = s.batch_id
+              WHERE search_index MATCH ? AND b.published = 1'''
+    params = [query]
+    if content_type:
+        sql += " AND c.content_type = ?"
+        params.append(content_type)
+    if batch_id:
+        sql += " AND s.batch_id = ?"
+        params.append(batch_id)
+    sql += " ORDER BY bm25(search_index, 10.0, 3.0, 1.0) LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    return get_db().execute(sql, params).fetchall()
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""Static HTML export of the catalogue.
+
+``flask export-site`` renders the home page and every batch, subject and
+"load more" fragment into EXPORT_DIR, each with precompressed .gz (and .br)
+variants::
+
+    index.html
+    batch/<batch_id>.html
+    subject/<subject_id>.html
+    subject/<subject_id>/<content_type>/<after>.html
+
+Exports are incremental. export.json records the generation each batch was
+exported at, and only batches whose generation moved are rendered again.
+Deleted batches have their files removed. A template or asset change forces
+a full export. When EXPORT_DIR is set, finished upload jobs refresh the
+export on their own. With HIDE_DEAD_LINKS, links are checked for expiry
+at export time; ones that expire later stay in the files until their
+batch is exported again (``--batch`` or ``--full``).
+
+Pages are rendered as an anonymous visitor, without the token gate. nginx
+serves the files and only hands token and admin routes to Flask::
+
+    location / {
+        gzip_static on;
+        try_files $uri.html $uri/index.html @flask;
+    }
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+import click
+from flask import render_template
+from werkzeug.utils import secure_filename
+
+import assets
+from database import LIVE_LINK, get_all_batches, get_db, get_subjects, link_clock
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'export.json'
+
+# Exports write one directory and manifest; run them one at a time
+_lock = threading.Lock()
+
+
+def _write(output, relpath, body):
+    """Write ``body`` to output/relpath atomically, plus compressed variants"""
+    path = os.path.join(output, *relpath.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(body)
+    assets.precompress(tmp, body)
+    for suffix in ('.gz', '.br'):
+        if os.path.exists(tmp + suffix):
+            os.replace(tmp + suffix, path + suffix)
+    os.replace(tmp, path)
+
+
+def _remove(output, relpath):
+    path = os.path.join(output, *relpath.split('/'))
+    for suffix in ('', '.gz', '.br'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _render(app, path, endpoint, **kwargs):
+    """Render a view as an anonymous request to ``path``, skipping the page cache"""
+    view = app.view_functions[endpoint]
+    view = getattr(view, '__wrapped__', view)
+    with app.test_request_context(path, base_url=app.config['SITE_URL']):
+        return view(**kwargs).encode('utf-8')
+
+
+def _export_batch(app, output, batch_id):
+    """Render one batch; returns the subject ids written"""
+    _write(output, 'batch/%s.html' % batch_id, _render(app, '/batch/' + batch_id, 'show_batch', batch_id=batch_id))
+    size = app.config['SUBJECT_PAGE_SIZE']
+    live_at = link_clock() if app.config['HIDE_DEAD_LINKS'] else None
+    subject_ids = []
+    for subject in get_subjects(batch_id):
+        subject_id = subject['subject_id']
+        _remove_subject(output, subject_id)
+        _write(output, 'subject/%d.html' % subject_id,
+               _render(app, '/subject/%d' % subject_id, 'show_subject', subject_id=subject_id))
+        for content_type in app.extensions['export']['sections']:
+            # The same rows the pages list, so fragments start where "load more" points
+            sql = "SELECT content_id FROM contents c WHERE c.subject_id = ? AND c.content_type = ?"
+            params = [subject_id, content_type]
+            if live_at is not None:
+                sql += " AND " + LIVE_LINK
+                params.append(live_at)
+            c = get_db().execute(sql + " ORDER BY content_id", params)
+            ids = [row[0] for row in c]
+            # A "load more" fragment starts after every size-th card that has more behind it
+            for after in ids[size - 1:-1:size]:
+                path = '/subject/%d/%s/%d' % (subject_id, content_type, after)
+                _write(output, path[1:] + '.html', _render(app, path, 'subject_items', subject_id=subject_id,
+                                                           content_type=content_type, after=after))
+        subject_ids.append(subject_id)
+    return subject_ids
+
+
+def _remove_subject(output, subject_id):
+    _remove(output, 'subject/%d.html' % subject_id)
+    shutil.rmtree(os.path.join(output, 'subject', str(subject_id)), ignore_errors=True)
+
+
+def _remove_batch(output, batch_id, entry):
+    _remove(output, 'batch/%s.html' % batch_id)
+    for subject_id in entry['subjects']:
+        _remove_subject(output, subject_id)
+
+
+def export_site(app, output, full=False, force=(), echo=log.info):
+    """Bring the export in ``output`` up to date; returns the batch ids rendered.
+
+    ``full`` re-renders everything; ``force`` lists batch ids to re-render
+    even if they look unchanged.
+    """
+    templates = app.extensions['export']['templates_digest']
+    with _lock, app.app_context():
+        os.makedirs(output, exist_ok=True)
+        manifest_path = os.path.join(output, MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        previous = manifest.get('batches', {})
+        if manifest.get('templates') != templates:
+            full = True
+
+        rows = get_db().execute("SELECT batch_id, generation FROM batches WHERE published = 1").fetchall()
+        current = {row['batch_id']: row['generation'] for row in rows}
+
+        removed = set(previous) - set(current)
+        for batch_id in removed:
+            _remove_batch(output, batch_id, previous[batch_id])
+            echo('removed batch %s' % batch_id)
+        exported = {batch_id: entry for batch_id, entry in previous.items() if batch_id in current}
+
+        rendered = []
+        for batch_id, generation in sorted(current.items()):
+            if secure_filename(batch_id) != batch_id:
+                log.warning("Skipping batch %r: id is not safe as a file name", batch_id)
+                continue
+            entry = exported.get(batch_id)
+            if entry and entry['generation'] == generation and not full and batch_id not in force:
+                continue
+            if entry:
+                _remove_batch(output, batch_id, entry)
+            subject_ids = _export_batch(app, output, batch_id)
+            exported[batch_id] = {'generation': generation, 'subjects': subject_ids}
+            rendered.append(batch_id)
+            echo('exported batch %s (%d subjects)' % (batch_id, len(subject_ids)))
+
+        # The home page lists every batch, so any change re-renders it
+        if rendered or removed or full or not os.path.exists(os.path.join(output, 'index.html')):
+            with app.test_request_context('/', base_url=app.config['SITE_URL']):
+                body = render_template('index.html', batches=get_all_batches(), token_info=None)
+            _write(output, 'index.html', body.encode('utf-8'))
+
+        tmp = manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'templates': templates, 'batches': exported}, f, indent=2, sort_keys=True)
+        os.replace(tmp, manifest_path)
+    return rendered
+
+
+def init_app(app, sections, templates_digest):
+    """``sections``: content types with "load more" fragments; ``templates_digest``
+    changes whenever rendered output would (see app.TEMPLATES_DIGEST)"""
+    app.extensions['export'] = {'sections': sections, 'templates_digest': templates_digest}
+
+    @app.cli.command('export-site')
+    @click.option('--output', default=None, help='Target directory (default: EXPORT_DIR or ./site).')
+    @click.option('--full', is_flag=True, help='Re-render every page, not just changed batches.')
+    @click.option('--batch', 'batch_ids', multiple=True, help='Re-render this batch even if unchanged.')
+    def export_site_command(output, full, batch_ids):
+        """Pre-render batch and subject pages to static HTML."""
+        output = output or app.config.get('EXPORT_DIR') or 'site'
+        rendered = export_site(app, output, full=full, force=set(batch_ids), echo=click.echo)
+        click.echo('%d batches rendered into %s' % (len(rendered), output))
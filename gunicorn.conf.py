@@ -0,0 +1,56 @@
+"""gunicorn settings. Run with: gunicorn -c gunicorn.conf.py
+
+The app is imported and set up (migrations, upload folder) once in the
+master, then forked. Each worker then compiles its templates, primes its
+query cache and opens a DB connection on every request thread before it
+takes traffic.
+
+Requests are short: a page-cache hit, or a few SQLite reads and a template
+render, mostly CPU under the GIL. So: one process per core for parallelism,
+and a few threads per process so slow mobile clients and uploads do not
+hold a whole worker.
+
+Upload jobs keep their state and their per-batch order in the database
+(see jobs.py), so a job's status can be polled from any worker.
+"""
+import multiprocessing
+import os
+import threading
+
+wsgi_app = 'app:setup_app()'
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+preload_app = True
+
+workers = int(os.environ.get('WEB_CONCURRENCY', max(2, multiprocessing.cpu_count())))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 4))
+keepalive = 5
+timeout = 60
+
+# Restart workers now and then so a slow leak cannot grow without bound
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def post_worker_init(worker):
+    from app import warm_up
+    import database
+
+    app = worker.wsgi
+    warm_up(app)
+
+    # gthread workers serve requests from a thread pool; connections are
+    # per thread, so open one on each pool thread. The barrier keeps every
+    # task busy until all have started, forcing one task per thread.
+    pool = getattr(worker, 'tpool', None)
+    if pool is None:
+        return
+    barrier = threading.Barrier(worker.cfg.threads)
+
+    def open_connection():
+        with app.app_context():
+            database.get_db()
+            barrier.wait(timeout=5)
+
+    for _ in range(worker.cfg.threads):
+        pool.submit(open_connection)
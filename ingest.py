@@ -0,0 +1,410 @@
+"""Bulk ingestion of batch TXT files.
+
+A batch file looks like::
+
+    Physics -
+    Electric Charges 01:https://example.com/lecture1.m3u8
+    Electric Charges 01 Class Notes:https://example.com/notes1.pdf
+
+Lines ending in " -" start a new subject; every "Title:URL" line below it is
+a content row of that subject.
+"""
+import gzip
+import logging
+import os
+import secrets
+from collections import namedtuple
+
+from database import (FILE_URL, URL_JOIN, get_db, bump_generation, encode_urls,
+                      index_batch_search, purge_batch, refresh_batch_counts, split_url, staging_db,
+                      swap_batch, write_pacer)
+from links import VIDEO_KINDS, link_expiry, media_kind, url_host
+
+log = logging.getLogger(__name__)
+
+# Records yielded by iter_records
+Subject = namedtuple('Subject', 'line_number name')
+Content = namedtuple('Content', 'line_number content_type title url media_kind expires_at')
+
+# Rows are written with executemany in chunks of this size, so memory stays
+# bounded however big the file is
+CHUNK_SIZE = 5000
+
+
+def classify(title, kind):
+    """Content type for a title and its link's media kind (same rules the upload form documents)"""
+    if kind in VIDEO_KINDS:
+        return 'lecture'
+    title_lower = title.lower()
+    if 'class notes' in title_lower:
+        return 'notes'
+    if 'dpp solution' in title_lower:
+        return 'solution'
+    if 'dpp' in title_lower:
+        return 'dpp'
+    return 'other'
+
+
+def iter_records(lines):
+    """Parse batch-file lines without touching the database.
+
+    Yields ``Subject`` and ``Content`` records in file order. Content lines
+    that appear before any subject, or that are malformed, are skipped.
+    """
+    in_subject = False
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        # Subject lines (format: "SubjectName - ")
+        if line.endswith(' -'):
+            name = line[:-2].strip()
+            in_subject = bool(name)
+            if in_subject:
+                yield Subject(line_number, name)
+            continue
+
+        # Content lines (format: "Title:URL")
+        if not in_subject or 'http' not in line:
+            continue
+        title, sep, url = line.partition(':')
+        if not sep:
+            continue
+        title = title.strip()
+        url = url.strip()
+        if not title or not url or not url.startswith(('http://', 'https://')):
+            continue
+        kind = media_kind(url)
+        yield Content(line_number, classify(title, kind), title, url, kind, link_expiry(url))
+
+
+def _next_subject_id(c):
+    # AUTOINCREMENT never reuses ids, so start after both the live rows and
+    # the highest id ever handed out
+    c.execute("SELECT MAX(subject_id) FROM subjects")
+    max_row = c.fetchone()[0] or 0
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'subjects'")
+    row = c.fetchone()
+    return max(max_row, row[0] if row else 0) + 1
+
+
+def _counted(lines, stats):
+    for line in lines:
+        stats['lines'] += 1
+        yield line
+
+
+def ingest_batch(lines, batch_id, batch_title, description="", stats=None, incremental=False,
+                 before_write=None):
+    """Load ``lines`` into ``batch_id`` in one transaction.
+
+    By default the batch is replaced outright. With ``incremental=True`` an
+    existing batch is synced instead (see ``_sync_batch``), which keeps the
+    ids of unchanged subjects and contents.
+
+    Returns a dict with ``lines``, ``subjects`` and ``contents`` counts (plus
+    the diff counts for an incremental sync). Pass your own ``stats`` dict to
+    watch those counts while the ingest runs.
+
+    The file is parsed into staging tables first, without locking the live
+    ones, so memory does not grow with the file in either mode. A replaced
+    batch is built under a hidden id in short transactions before one quick
+    swap publishes it (see ``_publish_batch``); a sync is one transaction.
+    Readers see either the old batch or the new one, and on any error the
+    previous batch is left intact.
+
+    ``before_write``, if given, is called once every line is staged and
+    before the live tables are touched; raising there abandons the ingest.
+    """
+    if stats is None:
+        stats = {}
+    stats['lines'] = 0
+    return ingest_records(iter_records(_counted(lines, stats)), batch_id, batch_title,
+                          description, stats, incremental, before_write)
+
+
+def ingest_records(records, batch_id, batch_title, description="", stats=None, incremental=False,
+                   before_write=None):
+    """Like ``ingest_batch``, for records already parsed by ``iter_records``.
+
+    ``stats['lines']`` is left as the caller set it.
+    """
+    conn = get_db()
+    c = conn.cursor()
+    if stats is None:
+        stats = {}
+    stats.setdefault('lines', 0)
+    stats.update(subjects=0, contents=0)
+
+    with staging_db(conn):
+        _stage_records(c, records, stats)
+        conn.commit()
+        if before_write is not None:
+            before_write()
+        if incremental:
+            # Writes only the differences, usually few: one transaction
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.execute("SELECT title, description FROM batches WHERE batch_id = ?", (batch_id,))
+                existing = c.fetchone()
+                if existing:
+                    if _sync_batch(conn, batch_id, batch_title, description, existing, stats):
+                        refresh_batch_counts(c, batch_id)
+                        bump_generation(c, batch_id)
+                    conn.commit()
+                    return stats
+                conn.rollback()
+            except BaseException:
+                conn.rollback()
+                raise
+        _publish_batch(conn, batch_id, batch_title, description)
+    return stats
+
+
+def _stage_records(c, records, stats):
+    """Write ``records`` to the staging tables; touches only the staging database"""
+    subject_rows = []
+    content_rows = []
+    patterns = {}   # (url prefix, url suffix) -> seq, see database.split_url
+
+    def flush():
+        if subject_rows:
+            c.executemany("INSERT INTO staging.staged_subjects (seq, name) VALUES (?, ?)", subject_rows)
+            subject_rows.clear()
+        if content_rows:
+            c.executemany("""INSERT INTO staging.staged_contents (subject_seq, content_type, title, pattern_seq,
+                                                                 url_key, media_kind, expires_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)""", content_rows)
+            content_rows.clear()
+
+    subject_seq = 0
+    for record in records:
+        if type(record) is Subject:
+            subject_seq += 1
+            subject_rows.append((subject_seq, record.name))
+            stats['subjects'] += 1
+        else:
+            prefix, key, suffix = split_url(record.url)
+            pattern_seq = patterns.get((prefix, suffix))
+            if pattern_seq is None:
+                pattern_seq = patterns[prefix, suffix] = len(patterns) + 1
+            content_rows.append((subject_seq, record.content_type, record.title, pattern_seq, key,
+                                 record.media_kind, record.expires_at))
+            stats['contents'] += 1
+            if len(content_rows) >= CHUNK_SIZE:
+                flush()
+    flush()
+    c.executemany("INSERT INTO staging.staged_patterns (seq, prefix, suffix, host) VALUES (?, ?, ?, ?)",
+                  [(seq, prefix, suffix, url_host(prefix)) for (prefix, suffix), seq in patterns.items()])
+
+
+def _publish_batch(conn, batch_id, batch_title, description):
+    """Replace the live batch with the staged one.
+
+    The rows are copied under an unpublished shadow id, CHUNK_SIZE contents
+    per transaction, pausing now and then (write_pacer) so other writers get
+    the lock. One short transaction then swaps the shadow in; the old rows
+    are purged after.
+    """
+    shadow_id = '%s~%s' % (batch_id, secrets.token_hex(4))
+    pace = write_pacer()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""INSERT INTO batches (batch_id, title, description, created_at, published)
+                     VALUES (?, ?, ?, datetime('now'), 0)""", (shadow_id, batch_title, description))
+        # Staged subjects are numbered 1..n; shift them onto fresh subject ids
+        offset = _next_subject_id(c) - 1
+        c.execute("""INSERT INTO subjects (subject_id, batch_id, name)
+                     SELECT ? + seq, ?, name FROM staging.staged_subjects ORDER BY seq""", (offset, shadow_id))
+        c.execute("""INSERT OR IGNORE INTO url_patterns (prefix, suffix, host)
+                     SELECT prefix, suffix, host FROM staging.staged_patterns""")
+        conn.commit()
+
+        last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM staging.staged_contents").fetchone()[0]
+        for first in range(0, last_seq, CHUNK_SIZE):
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT COALESCE(MAX(content_id), 0) FROM contents")
+            last_id = c.fetchone()[0]
+            c.execute("""INSERT INTO contents (subject_id, content_type, title, url_pattern, url_key,
+                                               media_kind, expires_at)
+                         SELECT ? + sc.subject_seq, sc.content_type, sc.title, p.pattern_id, sc.url_key,
+                                sc.media_kind, sc.expires_at
+                         FROM staging.staged_contents sc
+                         JOIN staging.staged_patterns sp ON sp.seq = sc.pattern_seq
+                         JOIN url_patterns p ON p.prefix = sp.prefix AND p.suffix = sp.suffix
+                         WHERE sc.seq > ? AND sc.seq <= ? ORDER BY sc.seq""", (offset, first, first + CHUNK_SIZE))
+            index_batch_search(c, shadow_id, after_content_id=last_id)
+            conn.commit()
+            pace()
+
+        c.execute("BEGIN IMMEDIATE")
+        refresh_batch_counts(c, shadow_id)
+        retired_id = '%s~%s' % (batch_id, secrets.token_hex(4))
+        swap_batch(c, batch_id, shadow_id, retired_id)
+        bump_generation(c, batch_id)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        _purge_quietly(conn, shadow_id)
+        raise
+    _purge_quietly(conn, retired_id)
+
+
+def _purge_quietly(conn, batch_id):
+    # Leftovers are invisible and swept at startup (purge_abandoned_batches)
+    try:
+        purge_batch(conn, batch_id)
+    except Exception as e:
+        log.warning("Could not remove unpublished batch %s: %s", batch_id, e)
+
+
+def _occurrences(keys):
+    """Number repeated keys, so duplicates match up one to one: a, a -> (a, 0), (a, 1)"""
+    seen = {}
+    for key in keys:
+        n = seen.get(key, 0)
+        seen[key] = n + 1
+        yield key, n
+
+
+def _staged_subjects(conn):
+    """(name, [(type, title, url, media kind, expiry), ...]) for each staged
+    subject in file order, holding one subject's contents at a time"""
+    contents = conn.execute("""SELECT sc.subject_seq, sc.content_type, sc.title,
+                                      sp.prefix || sc.url_key || sp.suffix, sc.media_kind, sc.expires_at
+                               FROM staging.staged_contents sc
+                               JOIN staging.staged_patterns sp ON sp.seq = sc.pattern_seq
+                               ORDER BY sc.seq""")
+    pending = contents.fetchone()
+    for seq, name in conn.execute("SELECT seq, name FROM staging.staged_subjects ORDER BY seq"):
+        items = []
+        while pending is not None and pending[0] == seq:
+            items.append(tuple(pending[1:]))
+            pending = contents.fetchone()
+        yield name, items
+
+
+def _stored_contents(c, subject_id):
+    """{(title, url, n): (content_id, content_type)} for a stored subject"""
+    c.execute("SELECT c.content_id, c.content_type, c.title, " + FILE_URL + " FROM contents c " + URL_JOIN +
+              " WHERE c.subject_id = ? ORDER BY c.content_id", (subject_id,))
+    rows = c.fetchall()
+    keys = _occurrences((row[2], row[3]) for row in rows)
+    return {(title, url, n): (row[0], row[1]) for row, ((title, url), n) in zip(rows, keys)}
+
+
+def _sync_batch(conn, batch_id, batch_title, description, existing, stats):
+    """Apply only the changes between the stored batch and the staged file.
+
+    Subjects are matched by name and contents by (subject, title, url);
+    repeated names/lines are matched in order. Unmatched stored rows are
+    deleted, new ones inserted, and matched contents whose type changed are
+    updated. New contents get new ids, so they sort after existing ones of
+    the same type. Subjects are compared one at a time, so only one
+    subject's rows are in memory. Returns True if anything changed.
+    """
+    c = conn.cursor()
+    diff = dict(subjects_added=0, subjects_removed=0, contents_added=0,
+                contents_updated=0, contents_removed=0, contents_unchanged=0)
+
+    c.execute("SELECT subject_id, name FROM subjects WHERE batch_id = ? ORDER BY subject_id", (batch_id,))
+    rows = c.fetchall()
+    stored_subjects = {key: row[0] for row, key in zip(rows, _occurrences(row[1] for row in rows))}
+
+    changed = existing['title'] != batch_title or (existing['description'] or "") != description
+    if changed:
+        c.execute("UPDATE batches SET title = ?, description = ? WHERE batch_id = ?",
+                  (batch_title, description, batch_id))
+
+    # Removals wait until every insert is done, so new contents all get ids
+    # above last_id and the search index catches them in one pass
+    c.execute("SELECT COALESCE(MAX(content_id), 0) FROM contents")
+    last_id = c.fetchone()[0]
+    removed_contents = []
+    next_subject_id = _next_subject_id(c)
+    seen = {}
+    for name, items in _staged_subjects(conn):
+        n = seen.get(name, 0)
+        seen[name] = n + 1
+        subject_id = stored_subjects.pop((name, n), None)
+        if subject_id is None:
+            subject_id = next_subject_id
+            next_subject_id += 1
+            c.execute("INSERT INTO subjects (subject_id, batch_id, name) VALUES (?, ?, ?)",
+                      (subject_id, batch_id, name))
+            diff['subjects_added'] += 1
+            stored = {}
+        else:
+            stored = _stored_contents(c, subject_id)
+
+        new_contents = []
+        retyped = []
+        for item, k in _occurrences(items):
+            content_type, title, url = item[:3]
+            match = stored.pop((title, url, k), None)
+            if match is None:
+                new_contents.append((subject_id,) + item)
+            elif match[1] != content_type:
+                retyped.append((content_type, match[0]))
+            else:
+                diff['contents_unchanged'] += 1
+        # Whatever is left under a kept subject is gone from the file
+        removed_contents += [(content_id,) for content_id, _ in stored.values()]
+
+        if retyped:
+            c.executemany("UPDATE contents SET content_type = ? WHERE content_id = ?", retyped)
+            diff['contents_updated'] += len(retyped)
+        if new_contents:
+            urls = encode_urls(c, [row[3] for row in new_contents])
+            c.executemany("""INSERT INTO contents (subject_id, content_type, title, url_pattern, url_key,
+                                                   media_kind, expires_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                          [row[:3] + url + row[4:] for row, url in zip(new_contents, urls)])
+            diff['contents_added'] += len(new_contents)
+
+    if diff['contents_added']:
+        index_batch_search(c, batch_id, after_content_id=last_id)
+    if removed_contents:
+        c.executemany("DELETE FROM search_index WHERE rowid = ?", removed_contents)
+        c.executemany("DELETE FROM contents WHERE content_id = ?", removed_contents)
+    # Stored subjects the file no longer has go with their contents
+    removed_subjects = [(subject_id,) for subject_id in stored_subjects.values()]
+    if removed_subjects:
+        for params in removed_subjects:
+            c.execute("SELECT COUNT(*) FROM contents WHERE subject_id = ?", params)
+            diff['contents_removed'] += c.fetchone()[0]
+        c.executemany("DELETE FROM search_index WHERE rowid IN "
+                      "(SELECT content_id FROM contents WHERE subject_id = ?)", removed_subjects)
+        c.executemany("DELETE FROM subjects WHERE subject_id = ?", removed_subjects)
+    diff['contents_removed'] += len(removed_contents)
+    diff['subjects_removed'] = len(removed_subjects)
+    stats.update(diff)
+
+    return changed or any(diff[k] for k in diff if k != 'contents_unchanged')
+
+
+def ingest_file(filepath, batch_id, batch_title, description="", stats=None, incremental=False):
+    # Streamed uploads that are kept as an archive arrive gzipped
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt', encoding='utf-8') as file:
+        return ingest_batch(file, batch_id, batch_title, description, stats, incremental)
+
+
+def parse_file(filepath):
+    """Parse a whole batch file; returns (rows, line_count).
+
+    Needs no database or app context, so it can run in a worker process.
+    ``rows`` are the records as plain tuples, which pickle about five times
+    faster than the namedtuples; ``records_from_rows`` turns them back.
+    """
+    stats = {'lines': 0}
+    with open(filepath, 'r', encoding='utf-8') as file:
+        rows = [tuple(record) for record in iter_records(_counted(file, stats))]
+    return rows, stats['lines']
+
+
+def records_from_rows(rows):
+    for row in rows:
+        yield Subject._make(row) if len(row) == 2 else Content._make(row)
@@ -0,0 +1,548 @@
+"""Background ingestion jobs for /admin/upload.
+
+Uploads are queued here and parsed on a small thread pool, so the HTTP
+request returns straight away. Jobs for different batches run concurrently;
+jobs for the same batch run one after another, in submission order.
+
+A bundle (a zip or several files uploaded at once) is one job: its files are
+parsed in parallel on a process pool, and the job's own thread is the single
+writer that loads each parsed file as its own batch, one transaction each.
+Each file claims its batch like a single-file job does, so uploads of one
+batch keep their order whether they came alone or in a bundle.
+
+A streamed upload (submit_stream) is parsed as it arrives: the request
+writes the body into a pipe, and the job's own thread stages the lines
+from the other end. Nothing is written to disk unless the upload is to be
+archived. The job waits for its batch only once the whole body is staged.
+
+Job state is kept in the database (the jobs table), so any worker process
+can report on a job, whichever worker accepted the upload. The worker
+running a job rewrites its row every HEARTBEAT seconds; an unfinished job
+whose row has not been written for STALE_AFTER seconds lost its worker
+(killed or restarted) and is reported as failed. Same-batch ordering holds
+across workers too: each job claims its batch in job_slots at submission
+and waits, on its pool thread, until the earlier claims are released.
+"""
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import export
+from database import get_db
+from ingest import ingest_batch, ingest_file, ingest_records, parse_file, records_from_rows
+
+log = logging.getLogger(__name__)
+
+# How many jobs to keep in the table for the status endpoints
+MAX_JOBS = 100
+HEARTBEAT = 2        # seconds between writes of a running job's progress
+STALE_AFTER = 120    # an unfinished job not written for this long lost its worker
+SLOT_POLL = 0.5      # seconds between checks while a job waits for its batch
+
+_lock = threading.Lock()
+_executor = None
+_parse_pool = None
+_heartbeat = None
+_active = {}            # job id -> Job, the unfinished jobs of this process
+
+
+def _reset_after_fork():
+    # Pool threads do not survive fork(), and queued jobs belong to the parent
+    global _executor, _parse_pool, _heartbeat, _lock
+    _executor = None
+    _parse_pool = None
+    _heartbeat = None
+    _lock = threading.Lock()
+    _active.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Job:
+    """One batch file; with ``archive_path`` the file is moved there once
+    ingested, instead of being deleted. A streamed job's ``filepath`` is
+    its gzipped copy, or None when it is not archived."""
+
+    def __init__(self, filepath, batch_id, title, incremental=False, archive_path=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.filepath = filepath
+        self.archive_path = archive_path
+        self.batch_id = batch_id
+        self.title = title
+        self.incremental = incremental
+        self.status = 'queued'
+        self.stats = {'lines': 0, 'subjects': 0, 'contents': 0}
+        self.errors = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.aborted = None   # why a streamed body did not arrive whole
+
+    def to_dict(self):
+        if self.started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        data = {
+            'job_id': self.id,
+            'batch_id': self.batch_id,
+            'mode': 'incremental' if self.incremental else 'replace',
+            'status': self.status,
+            'lines_parsed': self.stats['lines'],
+            'rows_inserted': self.stats['subjects'] + self.stats['contents'],
+            'subjects': self.stats['subjects'],
+            'contents': self.stats['contents'],
+            'errors': list(self.errors),
+            'archive': os.path.basename(self.archive_path) if self.archive_path else None,
+            'elapsed': round(elapsed, 3),
+        }
+        if 'contents_added' in self.stats:
+            data['diff'] = {k: v for k, v in self.stats.items()
+                            if k.startswith(('subjects_', 'contents_'))}
+        return data
+
+
+class BundleJob:
+    """Several batch files ingested together; ``files`` is a list of dicts with
+    ``file`` (name shown to the admin), ``path``, ``batch_id`` and ``title``.
+    An entry with an ``error`` already set is reported as skipped."""
+
+    def __init__(self, files, incremental=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.incremental = incremental
+        self.status = 'queued'
+        self.files = []
+        for entry in files:
+            entry = dict(entry, lines=0, subjects=0, contents=0, elapsed=0.0)
+            entry.setdefault('error', None)
+            entry['status'] = 'skipped' if entry['error'] else 'queued'
+            self.files.append(entry)
+        self.errors = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        if self.started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        # dict(entry) copies in one step, while the job thread may add keys
+        report = [{k: v for k, v in dict(entry).items() if k != 'path'} for entry in self.files]
+        return {
+            'job_id': self.id,
+            'kind': 'bundle',
+            'mode': 'incremental' if self.incremental else 'replace',
+            'status': self.status,
+            'files': report,
+            'batches_done': sum(1 for entry in report if entry['status'] == 'done'),
+            'batches_failed': sum(1 for entry in report if entry['status'] == 'failed'),
+            'batches_skipped': sum(1 for entry in report if entry['status'] == 'skipped'),
+            'lines_parsed': sum(entry['lines'] for entry in report),
+            'rows_inserted': sum(entry['subjects'] + entry['contents'] for entry in report),
+            'errors': list(self.errors),
+            'elapsed': round(elapsed, 3),
+        }
+
+
+def _get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config.get('INGEST_WORKERS', 2),
+                                       thread_name_prefix='ingest')
+    return _executor
+
+
+def submit(app, filepath, batch_id, title, incremental=False, archive_path=None):
+    """Queue ``filepath`` for ingestion into ``batch_id`` and return the Job"""
+    job = Job(filepath, batch_id, title, incremental, archive_path)
+    _register(app, job, [batch_id])
+    _get_executor(app).submit(_run, app, job)
+    return job
+
+
+class StreamSink:
+    """Where the request writes a streamed upload's body (see submit_stream).
+
+    Bytes go down the pipe to the job and, when archived, into a gzipped
+    copy. Close it when the body ends, best in a ``with`` block: leaving
+    that block on an exception tells the job the body was cut short, so it
+    fails instead of loading part of a batch. If the job stops reading (it
+    failed), the rest of the body is read and dropped.
+    """
+
+    def __init__(self, job, fd):
+        self.job = job
+        self.pipe = open(fd, 'wb')
+        self.copy = None
+        if job.filepath:
+            os.makedirs(os.path.dirname(job.filepath) or '.', exist_ok=True)
+            self.copy = gzip.open(job.filepath, 'wb', compresslevel=6)
+
+    def write(self, data):
+        if self.pipe is None:
+            return
+        try:
+            self.pipe.write(data)
+        except BrokenPipeError:
+            self.pipe = None
+            return
+        if self.copy is not None:
+            self.copy.write(data)
+
+    def close(self, error=None):
+        if error is not None:
+            self.job.aborted = str(error) or type(error).__name__
+        # The copy is complete before the job can see the end of the body
+        if self.copy is not None:
+            self.copy.close()
+        if self.pipe is not None:
+            try:
+                self.pipe.close()
+            except BrokenPipeError:
+                pass
+            self.pipe = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(exc)
+
+
+def submit_stream(app, batch_id, title, incremental=False, archive_path=None):
+    """Start a job that parses an upload as the request receives it.
+
+    Returns (job, sink): write the body to the StreamSink and close it. With
+    ``archive_path`` a gzipped copy is written next to it while the body
+    arrives and moved there once the batch is in.
+    """
+    job = Job(archive_path + '.part' if archive_path else None, batch_id, title, incremental, archive_path)
+    _register(app, job, [batch_id])
+    read_fd, write_fd = os.pipe()
+    lines = open(read_fd, 'r', encoding='utf-8')
+    try:
+        sink = StreamSink(job, write_fd)
+    except BaseException as e:
+        os.close(write_fd)
+        lines.close()
+        job.status = 'failed'
+        job.errors.append(str(e))
+        _finish(job)
+        raise
+    # Its own thread, not the pool: the request would block until a pool thread is free
+    threading.Thread(target=_run, args=(app, job, lines), name='ingest-stream').start()
+    return job, sink
+
+
+# Job table. Rows are written with the job's own report (to_dict), so the
+# status endpoints return them as stored.
+
+def _stopped(data):
+    data['status'] = 'failed'
+    data['errors'] = data.get('errors', []) + ['worker stopped before the job finished']
+    return data
+
+
+def _report(row, now):
+    data = json.loads(row['data'])
+    if row['status'] in ('queued', 'running') and row['updated_at'] < now - STALE_AFTER:
+        data = _stopped(data)
+    return data
+
+
+def _reap(conn, now):
+    """Fail the unfinished jobs no worker has written for STALE_AFTER seconds"""
+    rows = conn.execute("""SELECT job_id, data FROM jobs
+                           WHERE status IN ('queued', 'running') AND updated_at < ?""",
+                        (now - STALE_AFTER,)).fetchall()
+    for row in rows:
+        conn.execute("UPDATE jobs SET status = 'failed', data = ? WHERE job_id = ?",
+                     (json.dumps(_stopped(json.loads(row['data']))), row['job_id']))
+        conn.execute("DELETE FROM job_slots WHERE job_id = ?", (row['job_id'],))
+
+
+def _register(app, job, batch_ids):
+    """Store a new job with its claims on ``batch_ids``; needs an app context"""
+    now = time.time()
+    conn = get_db()
+    with conn:
+        _reap(conn, now)
+        conn.execute("INSERT INTO jobs (job_id, status, data, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                     (job.id, job.status, json.dumps(job.to_dict()), job.created_at, now))
+        conn.executemany("INSERT INTO job_slots (job_id, batch_id) VALUES (?, ?)",
+                         [(job.id, batch_id) for batch_id in batch_ids])
+        conn.execute("""DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND job_id IN
+                        (SELECT job_id FROM jobs ORDER BY created_at DESC LIMIT -1 OFFSET ?)""", (MAX_JOBS,))
+    with _lock:
+        _active[job.id] = job
+    _start_heartbeat(app)
+
+
+def _save(job):
+    # A finished row is final: a heartbeat that waited out a long write must
+    # not put back the state it read before the job ended
+    conn = get_db()
+    with conn:
+        conn.execute("""UPDATE jobs SET status = ?, data = ?, updated_at = ?
+                        WHERE job_id = ? AND status IN ('queued', 'running')""",
+                     (job.status, json.dumps(job.to_dict()), time.time(), job.id))
+
+
+def _save_running(job):
+    job.status = 'running'
+    job.started_at = time.time()
+    _save(job)
+
+
+def _finish(job):
+    """Write the job's final state and release its batches"""
+    try:
+        conn = get_db()
+        with conn:
+            conn.execute("DELETE FROM job_slots WHERE job_id = ?", (job.id,))
+        _save(job)
+    except sqlite3.Error as e:
+        log.error("Job %s: could not record the result: %s", job.id, e)
+    finally:
+        with _lock:
+            _active.pop(job.id, None)
+
+
+def _release(job, batch_id):
+    """Hand ``batch_id`` over to the next job that claimed it"""
+    try:
+        conn = get_db()
+        with conn:
+            conn.execute("DELETE FROM job_slots WHERE job_id = ? AND batch_id = ?", (job.id, batch_id))
+    except sqlite3.Error as e:
+        # _finish drops every claim of the job in the end
+        log.warning("Job %s: could not release batch %s: %s", job.id, batch_id, e)
+
+
+def _wait_for_batch(job, batch_id):
+    """Block until the jobs that claimed ``batch_id`` before ``job`` are done with it"""
+    conn = get_db()
+    while True:
+        row = conn.execute("""SELECT 1 FROM job_slots s JOIN jobs j ON j.job_id = s.job_id
+                              WHERE s.batch_id = ? AND j.updated_at >= ? AND s.seq <
+                                    (SELECT MIN(seq) FROM job_slots WHERE job_id = ? AND batch_id = ?)
+                              LIMIT 1""",
+                           (batch_id, time.time() - STALE_AFTER, job.id, batch_id)).fetchone()
+        if row is None:
+            return
+        time.sleep(SLOT_POLL)
+
+
+def _beat(app):
+    with app.app_context():
+        while True:
+            time.sleep(HEARTBEAT)
+            with _lock:
+                active = list(_active.values())
+            for job in active:
+                try:
+                    _save(job)
+                except sqlite3.Error as e:
+                    # Busy behind a long write; the next beat tries again
+                    log.warning("Job %s: could not write progress: %s", job.id, e)
+
+
+def _start_heartbeat(app):
+    global _heartbeat
+    with _lock:
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_beat, args=(app,), name='job-heartbeat', daemon=True)
+            _heartbeat.start()
+
+
+def _parse_workers(app):
+    return app.config.get('INGEST_PROCESSES') or os.cpu_count() or 2
+
+
+def _get_parse_pool(app):
+    # spawn, not fork: the web process has threads (and maybe open SQLite
+    # handles) that a forked child must not inherit
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=_parse_workers(app),
+                                          mp_context=multiprocessing.get_context('spawn'))
+    return _parse_pool
+
+
+def submit_bundle(app, files, incremental=False):
+    """Queue several batch files (see BundleJob) as one job and return it"""
+    job = BundleJob(files, incremental)
+    _register(app, job, [entry['batch_id'] for entry in job.files if entry['status'] != 'skipped'])
+    _get_executor(app).submit(_run_bundle, app, job)
+    return job
+
+
+def get_job(job_id):
+    """A job's report as a dict, or None; any worker can answer for any job"""
+    with _lock:
+        job = _active.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    row = get_db().execute("SELECT status, data, updated_at FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return _report(row, time.time()) if row else None
+
+
+def recent_jobs():
+    """Reports of the newest MAX_JOBS jobs, newest first"""
+    now = time.time()
+    rows = get_db().execute("""SELECT job_id, status, data, updated_at FROM jobs
+                               ORDER BY created_at DESC LIMIT ?""", (MAX_JOBS,)).fetchall()
+    with _lock:
+        active = dict(_active)
+    return [active[row['job_id']].to_dict() if row['job_id'] in active else _report(row, now)
+            for row in rows]
+
+
+def _refresh_export(app):
+    # The upload itself succeeded; a failed export is logged, not reported on the job
+    try:
+        export.export_site(app, app.config['EXPORT_DIR'])
+    except Exception as e:
+        log.exception("Static export after upload failed: %s", e)
+
+
+def refresh_export_later(app):
+    """Queue a static export refresh after an ingest that did not run as a job"""
+    if app.config.get('EXPORT_DIR'):
+        _get_executor(app).submit(_refresh_export, app)
+
+
+def _run(app, job, lines=None):
+    """Ingest ``job.filepath``, or with ``lines`` a streamed body read from its pipe"""
+    with app.app_context():
+        try:
+            if lines is None:
+                _wait_for_batch(job, job.batch_id)
+                _save_running(job)
+                ingest_file(job.filepath, job.batch_id, job.title, stats=job.stats,
+                            incremental=job.incremental)
+            else:
+                _ingest_stream(job, lines)
+            job.status = 'done'
+            log.info("Job %s: batch %s ingested, %d contents from %d lines",
+                     job.id, job.batch_id, job.stats['contents'], job.stats['lines'])
+            if job.archive_path:
+                _keep_archive(job)
+        except Exception as e:
+            job.status = 'failed'
+            job.errors.append(str(e))
+            log.exception("Job %s failed: %s", job.id, e)
+        finally:
+            if job.filepath and os.path.exists(job.filepath):
+                os.remove(job.filepath)
+            job.finished_at = time.time()
+            # Hands the batch over to the next job queued for it, if any
+            _finish(job)
+    if job.status == 'done' and app.config.get('EXPORT_DIR'):
+        _refresh_export(app)
+
+
+def _ingest_stream(job, lines):
+    def before_write():
+        if job.aborted:
+            raise ValueError(f'upload did not arrive whole: {job.aborted}')
+        _wait_for_batch(job, job.batch_id)
+
+    # Closing the pipe on a failure lets the request's writes fail fast
+    with lines:
+        _save_running(job)
+        ingest_batch(lines, job.batch_id, job.title, stats=job.stats, incremental=job.incremental,
+                     before_write=before_write)
+
+
+def _keep_archive(job):
+    # The batch is in; a copy that cannot be kept is reported, not a failure
+    try:
+        os.makedirs(os.path.dirname(job.archive_path) or '.', exist_ok=True)
+        shutil.move(job.filepath, job.archive_path)
+    except OSError as e:
+        job.errors.append(f'could not keep the archive: {e}')
+        log.error("Job %s: could not move %s to %s: %s", job.id, job.filepath, job.archive_path, e)
+
+
+def _write_parsed(app, job, entry, future):
+    """Single writer: load one parsed file as its batch (in the job's app context)"""
+    global _parse_pool
+    try:
+        rows, entry['lines'] = future.result()
+        _wait_for_batch(job, entry['batch_id'])
+        entry['status'] = 'running'
+        started = time.time()
+        ingest_records(records_from_rows(rows), entry['batch_id'], entry['title'], stats=entry,
+                       incremental=job.incremental)
+        entry['elapsed'] = round(time.time() - started, 3)
+        entry['status'] = 'done'
+    except Exception as e:
+        entry['status'] = 'failed'
+        entry['error'] = str(e) or type(e).__name__
+        log.warning("Job %s: %s (batch %s) failed: %s", job.id, entry['file'], entry['batch_id'], entry['error'])
+        if isinstance(e, BrokenProcessPool):
+            # A worker died; start a fresh pool for the next bundle
+            _parse_pool = None
+    finally:
+        _release(job, entry['batch_id'])
+        if os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+
+def _run_bundle(app, job):
+    with app.app_context():
+        try:
+            _save_running(job)
+            _write_bundle(app, job)
+        finally:
+            for entry in job.files:
+                if entry['status'] in ('queued', 'running'):
+                    entry['status'] = 'failed'
+                    entry['error'] = entry['error'] or 'not processed'
+                if entry.get('path') and os.path.exists(entry['path']):
+                    os.remove(entry['path'])
+            done = sum(1 for entry in job.files if entry['status'] == 'done')
+            failed = sum(1 for entry in job.files if entry['status'] == 'failed')
+            # Skipped entries (not .txt, duplicate batch id) are not failures
+            job.status = 'failed' if not done else 'partial' if failed else 'done'
+            job.finished_at = time.time()
+            _finish(job)
+            log.info("Job %s: bundle of %d files, %d batches ingested", job.id, len(job.files), done)
+    if done and app.config.get('EXPORT_DIR'):
+        _refresh_export(app)
+
+
+def _write_bundle(app, job):
+    global _parse_pool
+    try:
+        pool = _get_parse_pool(app)
+        # Parse ahead of the writer, but only a couple of files per process,
+        # so parsed records waiting for the writer stay bounded
+        window = deque()
+        ahead = 2 * _parse_workers(app)
+        for entry in job.files:
+            if entry['status'] == 'skipped':
+                continue
+            window.append((entry, pool.submit(parse_file, entry['path'])))
+            if len(window) >= ahead:
+                _write_parsed(app, job, *window.popleft())
+        while window:
+            _write_parsed(app, job, *window.popleft())
+    except Exception as e:
+        job.errors.append(str(e))
+        log.exception("Job %s failed: %s", job.id, e)
+        if isinstance(e, BrokenProcessPool):
+            _parse_pool = None
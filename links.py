@@ -0,0 +1,55 @@
+"""What a content link points at, read from the URL alone.
+
+Ingest stores the result with each row, so pages can leave out expired
+links and the API can filter on the kind without looking at the URLs again. Stream links
+are signed JWTs whose payload carries an ``exp`` claim (Unix time).
+"""
+import base64
+import binascii
+import re
+from urllib.parse import urlsplit
+
+# Endings of the media kinds the site serves; any other link is unsupported
+MEDIA_KINDS = (('.m3u8', 'hls'), ('.mpd', 'dash'), ('.mp4', 'mp4'), ('.pdf', 'pdf'))
+VIDEO_KINDS = ('hls', 'dash', 'mp4')
+
+_JWT_PAYLOAD = re.compile(r'eyJ[\w-]*\.(eyJ[\w-]*)\.')
+# The claim is read straight from the decoded JSON; a full json.loads was
+# most of the cost of ingesting a stream line
+_EXP_CLAIM = re.compile(rb'"exp"\s*:\s*(\d{1,18})\b')
+
+
+def media_kind(url):
+    """'hls', 'dash', 'mp4' or 'pdf', or None for anything else"""
+    path = url.partition('?')[0].partition('#')[0].lower()
+    for ending, kind in MEDIA_KINDS:
+        if path.endswith(ending):
+            return kind
+    # The extension elsewhere, e.g. .../video.mp4/playlist or ?file=a.m3u8
+    url = url.lower()
+    for ending, kind in MEDIA_KINDS:
+        if ending in url:
+            return kind
+    return None
+
+
+def link_expiry(url):
+    """The ``exp`` claim of a JWT in the URL as Unix time, or None"""
+    match = _JWT_PAYLOAD.search(url)
+    if not match:
+        return None
+    payload = match.group(1)
+    try:
+        claims = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    exp = _EXP_CLAIM.search(claims)
+    return int(exp.group(1)) if exp else None
+
+
+def url_host(url):
+    """Lower-cased host name of ``url``, or None"""
+    try:
+        return urlsplit(url).hostname
+    except ValueError:
+        return None
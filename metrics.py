@@ -0,0 +1,214 @@
+"""Per-route request metrics, exposed at /admin/metrics.
+
+Records, per endpoint: request count, a latency histogram (p50/p95/p99 are
+estimated from its buckets), SQLite statements and time spent in them, plus
+a render-time histogram per template. Everything is kept in the memory of
+the current worker process.
+
+A request can also be traced (see profiling.py): its tracer then gets
+every statement and template render as it happens.
+"""
+import threading
+import time
+
+from flask import before_render_template, request, template_rendered
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used for queries that run outside a request (background jobs, CLI)
+BACKGROUND = '<background>'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)   # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        for bound in BUCKETS:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate the q-quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            'p50_ms': round(self.quantile(0.50) * 1000, 3),
+            'p95_ms': round(self.quantile(0.95) * 1000, 3),
+            'p99_ms': round(self.quantile(0.99) * 1000, 3),
+        }
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.queries = 0
+        self.query_time = 0.0
+
+
+_lock = threading.Lock()
+_endpoints = {}   # endpoint -> EndpointStats
+_templates = {}   # template name -> Histogram
+_current = threading.local()
+
+
+def record_query(duration, statements=1, sql=None):
+    """Called by the database layer for every statement it runs.
+
+    Fetches report ``statements=0`` and no ``sql``.
+    """
+    if getattr(_current, 'active', False):
+        _current.queries += statements
+        _current.query_time += duration
+        if _current.tracer is not None:
+            _current.tracer.query(sql, duration)
+        return
+    with _lock:
+        stats = _endpoints.get(BACKGROUND)
+        if stats is None:
+            stats = _endpoints[BACKGROUND] = EndpointStats()
+        stats.queries += statements
+        stats.query_time += duration
+
+
+def _start_request():
+    _current.active = True
+    _current.start = time.perf_counter()
+    _current.queries = 0
+    _current.query_time = 0.0
+    _current.tracer = None
+
+
+def trace(tracer):
+    """Send this request's statements and renders to ``tracer.query(sql,
+    seconds)`` and ``tracer.template(name, seconds)``; None stops it"""
+    _current.tracer = tracer
+
+
+def _finish_request(response):
+    if not getattr(_current, 'active', False):
+        return response
+    _current.active = False
+    _current.tracer = None
+    elapsed = time.perf_counter() - _current.start
+    endpoint = request.endpoint or 'unmatched'
+    with _lock:
+        stats = _endpoints.get(endpoint)
+        if stats is None:
+            stats = _endpoints[endpoint] = EndpointStats()
+        stats.latency.observe(elapsed)
+        stats.statuses[response.status_code] = stats.statuses.get(response.status_code, 0) + 1
+        stats.queries += _current.queries
+        stats.query_time += _current.query_time
+    return response
+
+
+def _abandon_request(exc=None):
+    # after_request does not run when a view raises; just stop counting
+    _current.active = False
+    _current.tracer = None
+
+
+def _before_render(sender, template, context, **extra):
+    _current.render_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    start = getattr(_current, 'render_start', None)
+    if start is None:
+        return
+    _current.render_start = None
+    elapsed = time.perf_counter() - start
+    if getattr(_current, 'tracer', None) is not None:
+        _current.tracer.template(template.name, elapsed)
+    with _lock:
+        hist = _templates.get(template.name)
+        if hist is None:
+            hist = _templates[template.name] = Histogram()
+        hist.observe(elapsed)
+
+
+def init_app(app):
+    """Register the hooks. Call before any other before_request handler is added."""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_abandon_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+
+def snapshot():
+    with _lock:
+        endpoints = {}
+        for name, stats in _endpoints.items():
+            entry = stats.latency.summary()
+            entry['statuses'] = {str(k): v for k, v in stats.statuses.items()}
+            entry['sql_queries'] = stats.queries
+            entry['sql_ms'] = round(stats.query_time * 1000, 3)
+            if stats.latency.count:
+                entry['sql_queries_per_request'] = round(stats.queries / stats.latency.count, 2)
+                entry['sql_ms_per_request'] = round(stats.query_time * 1000 / stats.latency.count, 3)
+            endpoints[name] = entry
+        templates = {name: hist.summary() for name, hist in _templates.items()}
+    return {'endpoints': endpoints, 'templates': templates}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _histogram_lines(name, label, value, hist):
+    lines = []
+    cumulative = 0
+    for bound, n in zip(BUCKETS, hist.counts):
+        cumulative += n
+        lines.append('%s_bucket{%s="%s",le="%s"} %d' % (name, label, _label(value), bound, cumulative))
+    lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (name, label, _label(value), hist.count))
+    lines.append('%s_sum{%s="%s"} %.6f' % (name, label, _label(value), hist.sum))
+    lines.append('%s_count{%s="%s"} %d' % (name, label, _label(value), hist.count))
+    return lines
+
+
+def prometheus():
+    """Metrics in the Prometheus text exposition format"""
+    lines = ['# TYPE lbhub_request_duration_seconds histogram']
+    with _lock:
+        for name, stats in _endpoints.items():
+            if stats.latency.count:
+                lines += _histogram_lines('lbhub_request_duration_seconds', 'endpoint', name, stats.latency)
+        lines.append('# TYPE lbhub_requests_total counter')
+        for name, stats in _endpoints.items():
+            for status, n in stats.statuses.items():
+                lines.append('lbhub_requests_total{endpoint="%s",status="%s"} %d' % (_label(name), status, n))
+        lines.append('# TYPE lbhub_sql_queries_total counter')
+        for name, stats in _endpoints.items():
+            lines.append('lbhub_sql_queries_total{endpoint="%s"} %d' % (_label(name), stats.queries))
+        lines.append('# TYPE lbhub_sql_seconds_total counter')
+        for name, stats in _endpoints.items():
+            lines.append('lbhub_sql_seconds_total{endpoint="%s"} %.6f' % (_label(name), stats.query_time))
+        lines.append('# TYPE lbhub_template_render_seconds histogram')
+        for name, hist in _templates.items():
+            lines += _histogram_lines('lbhub_template_render_seconds', 'template', name, hist)
+    return '\n'.join(lines) + '\n'
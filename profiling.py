@@ -0,0 +1,287 @@
+"""On-demand request profiling for admins, browsed at /admin/profile.
+
+A request is profiled when either:
+
+    - a logged-in admin sends it with an ``X-Profile: 1`` header (the
+      /admin/profile page can send one for any URL), or
+    - sampling is switched on at /admin/profile: that share of requests,
+      optionally only to some endpoints, until the toggle runs out
+
+Header requests skip the page and query caches, so they show what a cache
+miss costs. Sampled requests are served as usual.
+
+A profile holds the cProfile stats (the .prof file loads in pstats or
+snakeviz), every SQL statement with its time (fetch time counts towards
+the statement before it) and the render time of each template. The newest
+PROFILE_KEEP profiles are kept in PROFILE_DIR. Writing one deletes the
+oldest. The sampling settings are a file in that directory, so every
+worker follows them; each worker looks at it at most once a second.
+
+One request per worker is profiled at a time, because cProfile only sees
+the thread it was started on. With nothing switched on, a request pays
+for a clock read and a header lookup.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask import current_app, request, session
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+HEADER = 'HTTP_X_PROFILE'
+SETTINGS = 'settings.json'
+MAX_STATEMENTS = 2000   # statements listed per profile; the rest are only counted
+TOP_FUNCTIONS = 60      # rows of the pstats listing kept in the summary
+
+# Profile names: UTC time to the microsecond, then the worker pid
+_NAME = re.compile(r'^\d{8}-\d{6}-\d{6}-\d+$')
+
+_current = threading.local()
+_busy = threading.Lock()
+_settings = {'rate': 0.0, 'endpoints': [], 'until': 0}
+_settings_mtime = None
+_next_check = 0.0
+
+
+class Profile:
+    """One profiled request; also the metrics tracer for it"""
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.started = time.time()
+        self.statements = []
+        self.dropped = 0
+        self.sql_time = 0.0
+        self.templates = []
+        self.profiler = cProfile.Profile()
+        self.clock = time.perf_counter()
+        self.profiler.enable()
+
+    def query(self, sql, duration):
+        self.sql_time += duration
+        if sql is None:
+            if self.statements:
+                self.statements[-1][1] += duration
+        elif len(self.statements) < MAX_STATEMENTS:
+            self.statements.append([sql, duration])
+        else:
+            self.dropped += 1
+
+    def template(self, name, duration):
+        self.templates.append((name, duration))
+
+    def stop(self):
+        self.profiler.disable()
+        self.duration = time.perf_counter() - self.clock
+
+    @property
+    def name(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(self.started))
+        return '%s-%06d-%d' % (stamp, self.started % 1 * 1000000, os.getpid())
+
+    def summary(self, response):
+        req = request._get_current_object()
+        stats = pstats.Stats(self.profiler)
+        # Compiled Jinja code keeps the template's file name
+        template_code = {}
+        for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+            if filename.endswith('.html'):
+                name = filename.replace(os.sep, '/').rpartition('/templates/')[2]
+                template_code[name] = template_code.get(name, 0.0) + tt
+        queries = {}
+        for sql, duration in self.statements:
+            entry = queries.setdefault(' '.join(sql.split()), [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+        listing = io.StringIO()
+        stats.stream = listing
+        stats.strip_dirs().sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        return {
+            'name': self.name,
+            'time': int(self.started),
+            'trigger': self.trigger,
+            'method': req.method,
+            'path': req.full_path.rstrip('?'),
+            'endpoint': req.endpoint,
+            'status': response.status_code,
+            'bytes': response.calculate_content_length(),
+            'duration_ms': round(self.duration * 1000, 3),
+            'sql_ms': round(self.sql_time * 1000, 3),
+            'sql_count': len(self.statements) + self.dropped,
+            'queries': sorted(([sql, n, round(t * 1000, 3)] for sql, (n, t) in queries.items()),
+                              key=lambda q: -q[2]),
+            'statements': [[sql, round(t * 1000, 3)] for sql, t in self.statements],
+            'templates': [[name, round(t * 1000, 3)] for name, t in self.templates],
+            'template_code': sorted(([name, round(t * 1000, 3)] for name, t in template_code.items()),
+                                    key=lambda item: -item[1]),
+            'pstats': listing.getvalue(),
+        }
+
+
+def skip_caches():
+    """True while an admin's X-Profile request runs: views should do the real work"""
+    profile = getattr(_current, 'profile', None)
+    return profile is not None and profile.trigger == 'header'
+
+
+def _refresh_settings(directory):
+    global _settings, _settings_mtime
+    path = os.path.join(directory, SETTINGS)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime == _settings_mtime:
+        return
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    _settings = {
+        'rate': float(data.get('rate', 0.0)),
+        'endpoints': list(data.get('endpoints', [])),
+        'until': data.get('until', 0),
+    }
+    _settings_mtime = mtime
+
+
+def _start_request():
+    global _next_check
+    _current.profile = None
+    # Attribute lookups through the request proxy cost microseconds each
+    req = request._get_current_object()
+    trigger = None
+    if req.environ.get(HEADER) and session.get('admin_logged_in'):
+        trigger = 'header'
+    else:
+        now = time.monotonic()
+        if now >= _next_check:
+            _next_check = now + 1.0
+            _refresh_settings(current_app.config['PROFILE_DIR'])
+        settings = _settings
+        if (settings['rate'] and random.random() < settings['rate'] and time.time() < settings['until']
+                and (not settings['endpoints'] or req.endpoint in settings['endpoints'])):
+            trigger = 'sample'
+    if trigger is None or not _busy.acquire(blocking=False):
+        return
+    try:
+        profile = Profile(trigger)
+    except ValueError:
+        # Another profiler (a debugger, say) owns the interpreter
+        _busy.release()
+        return
+    _current.profile = profile
+    metrics.trace(profile)
+
+
+def _finish_request(response):
+    profile = getattr(_current, 'profile', None)
+    if profile is None:
+        return response
+    _current.profile = None
+    profile.stop()
+    metrics.trace(None)
+    try:
+        config = current_app.config
+        save(config['PROFILE_DIR'], config['PROFILE_KEEP'], profile, response)
+        if profile.trigger == 'header':
+            response.headers['X-Profile-Id'] = profile.name
+    except Exception:
+        log.exception("Could not save profile for %s", request.path)
+    finally:
+        _busy.release()
+    return response
+
+
+def _abandon_request(exc=None):
+    # after_request did not run (the view raised): drop the profile
+    profile = getattr(_current, 'profile', None)
+    if profile is not None:
+        _current.profile = None
+        profile.stop()
+        _busy.release()
+
+
+def save(directory, keep, profile, response):
+    """Write ``profile`` as <name>.prof and <name>.json, then trim to ``keep``"""
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, profile.name)
+    profile.profiler.dump_stats(base + '.prof.tmp')
+    os.replace(base + '.prof.tmp', base + '.prof')
+    with open(base + '.json.tmp', 'w') as f:
+        json.dump(profile.summary(response), f)
+    os.replace(base + '.json.tmp', base + '.json')
+
+    names = sorted(name[:-5] for name in os.listdir(directory) if _NAME.match(name[:-5]) and name.endswith('.json'))
+    for name in names[:-keep] if keep > 0 else names:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, name + suffix))
+            except OSError:
+                pass
+
+
+def list_profiles(directory):
+    """Summaries of the saved profiles, newest first, without the long fields"""
+    profiles = []
+    try:
+        names = sorted((name[:-5] for name in os.listdir(directory) if name.endswith('.json')), reverse=True)
+    except OSError:
+        return profiles
+    for name in names:
+        profile = load_profile(directory, name)
+        if profile is not None:
+            for key in ('queries', 'statements', 'templates', 'template_code', 'pstats'):
+                profile.pop(key, None)
+            profiles.append(profile)
+    return profiles
+
+
+def load_profile(directory, name):
+    if not _NAME.match(name):
+        return None
+    try:
+        with open(os.path.join(directory, name + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def stats_file(directory, name):
+    """Path of the .prof file for ``name``, or None"""
+    path = os.path.join(directory, name + '.prof')
+    return path if _NAME.match(name) and os.path.exists(path) else None
+
+
+def get_settings(directory):
+    _refresh_settings(directory)
+    return dict(_settings)
+
+
+def set_settings(directory, rate, endpoints, minutes):
+    """Sample ``rate`` (0-1) of requests to ``endpoints`` (all if empty) for ``minutes``"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, SETTINGS)
+    data = {'rate': rate, 'endpoints': endpoints, 'until': int(time.time() + minutes * 60) if rate else 0}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+    _refresh_settings(directory)
+
+
+def init_app(app):
+    """Register the hooks; call right after metrics.init_app so the profile covers check_access"""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_abandon_request)
@@ -0,0 +1,310 @@
+// ===== Chrome check =====
+const isRealChrome = () => {
+    const userAgent = navigator.userAgent.toLowerCase();
+    return (
+        userAgent.includes('chrome') &&
+        !userAgent.includes('edg/') &&
+        !userAgent.includes('opr/') &&
+        !userAgent.includes('brave') &&
+        window.chrome !== undefined
+    );
+};
+if (!isRealChrome()) {
+    window.location.href = "https://t.me/contact_262524_bot";
+    throw new Error("Browser not supported");
+}
+
+// ===== Lazy sections =====
+// Only the first cards of each section come with the page. When a section's
+// "load more" marker scrolls into view, fetch the next page and append it.
+function loadMore(marker) {
+    if (marker.dataset.loading) return;
+    marker.dataset.loading = '1';
+    fetch(marker.dataset.next, { credentials: 'same-origin' })
+        .then(res => {
+            if (res.redirected) { window.location.href = res.url; throw new Error('redirected'); }
+            if (!res.ok) throw new Error(res.status);
+            return res.text();
+        })
+        .then(html => {
+            const grid = marker.parentNode;
+            if (lazyObserver) lazyObserver.unobserve(marker);
+            marker.remove();
+            grid.insertAdjacentHTML('beforeend', html);
+            watchLoadMore(grid.querySelector('.load-more'));
+        })
+        .catch(() => { delete marker.dataset.loading; });
+}
+const lazyObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        entries.forEach(entry => { if (entry.isIntersecting) loadMore(entry.target); });
+    }, { rootMargin: '600px 0px' })
+    : null;
+function watchLoadMore(marker) {
+    if (!marker) return;
+    marker.querySelector('button').addEventListener('click', () => loadMore(marker));
+    if (lazyObserver) lazyObserver.observe(marker);
+}
+document.querySelectorAll('.load-more').forEach(watchLoadMore);
+
+// ===== Player elements =====
+const video = document.getElementById('videoPlayer');
+const videoContainer = document.getElementById('videoContainer');
+const playPauseBtn = document.getElementById('playPauseBtn');
+const bigPlayBtn = document.getElementById('bigPlayBtn');
+const progressBar = document.getElementById('progressBar');
+const progressContainer = document.getElementById('progressContainer');
+const volumeBtn = document.getElementById('volumeBtn');
+const volumeSlider = document.getElementById('volumeSlider');
+const currentTimeEl = document.getElementById('currentTime');
+const durationEl = document.getElementById('duration');
+const speedSelect = document.getElementById('speedSelect');
+const fullscreenBtn = document.getElementById('fullscreenBtn');
+const loadingSpinner = document.getElementById('loadingSpinner');
+const settingsBtn = document.getElementById('settingsBtn');
+const settingsMenu = document.getElementById('settingsMenu');
+const seekFeedback = document.getElementById('seekFeedback');
+const speedChips = document.querySelectorAll('.speed-chip');
+
+let hls;
+let levels = [];
+let lastTap = 0;
+
+// ===== Settings menu toggle =====
+settingsBtn.addEventListener('click', function(e) {
+    e.stopPropagation();
+    settingsMenu.style.display = settingsMenu.style.display === 'block' ? 'none' : 'block';
+});
+document.addEventListener('click', function(e) {
+    if (!settingsMenu.contains(e.target) && e.target !== settingsBtn) {
+        settingsMenu.style.display = 'none';
+    }
+});
+
+// ===== Helpers =====
+function togglePlay() {
+    if (video.paused) {
+        updateQualityOptions();
+        video.play();
+    } else {
+        video.pause();
+    }
+}
+function updateProgress() {
+    const percent = (video.currentTime / video.duration) * 100;
+    progressBar.style.width = `${percent}%`;
+    currentTimeEl.textContent = formatTime(video.currentTime);
+}
+function updateQualityOptions() {
+    const qualityOptions = document.getElementById('qualityOptions');
+    qualityOptions.innerHTML = '';
+
+    if (levels.length > 1) {
+        levels.forEach((level, index) => {
+            const option = document.createElement('div');
+            option.className = 'settings-option';
+            option.textContent = `${level.height}p`;
+            option.addEventListener('click', () => {
+                hls.currentLevel = index;
+                document.querySelectorAll('.quality-options .settings-option').forEach(opt => {
+                    opt.style.color = 'white';
+                });
+                option.style.color = 'var(--primary-light)';
+                settingsMenu.style.display = 'none';
+            });
+            qualityOptions.appendChild(option);
+        });
+    } else {
+        const option = document.createElement('div');
+        option.className = 'settings-option';
+        option.textContent = 'Auto';
+        qualityOptions.appendChild(option);
+    }
+}
+function setProgress(e) {
+    const width = this.clientWidth;
+    const clickX = e.offsetX;
+    video.currentTime = (clickX / width) * video.duration;
+}
+function formatTime(seconds) {
+    const hrs = Math.floor(seconds / 3600);
+    const mins = Math.floor((seconds % 3600) / 60);
+    const secs = Math.floor(seconds % 60);
+    return hrs > 0
+      ? `${hrs.toString().padStart(2,'0')}:${mins.toString().padStart(2,'0')}:${secs.toString().padStart(2,'0')}`
+      : `${mins.toString().padStart(2,'0')}:${secs.toString().padStart(2,'0')}`;
+}
+function updateVolumeIcon() {
+    if (video.muted || video.volume === 0) {
+        volumeBtn.innerHTML = '<i class="fas fa-volume-mute"></i>';
+    } else if (video.volume < 0.5) {
+        volumeBtn.innerHTML = '<i class="fas fa-volume-down"></i>';
+    } else {
+        volumeBtn.innerHTML = '<i class="fas fa-volume-up"></i>';
+    }
+}
+function toggleMute() {
+    video.muted = !video.muted;
+    updateVolumeIcon();
+}
+function setVolume() {
+    video.volume = this.value;
+    video.muted = this.value === '0';
+    updateVolumeIcon();
+}
+function changeSpeed(speed) {
+    video.playbackRate = parseFloat(speed);
+    speedSelect.value = speed;
+    speedChips.forEach(chip => chip.classList.remove('active'));
+    const activeChip = document.querySelector(`.speed-chip[data-speed="${speed}"]`);
+    if (activeChip) activeChip.classList.add('active');
+    localStorage.setItem('playbackSpeed', speed);
+}
+function toggleFullscreen() {
+    if (!document.fullscreenElement) {
+        videoContainer.requestFullscreen();
+        fullscreenBtn.innerHTML = '<i class="fas fa-compress"></i>';
+    } else {
+        document.exitFullscreen();
+        fullscreenBtn.innerHTML = '<i class="fas fa-expand"></i>';
+    }
+}
+function showLoading(){ loadingSpinner.classList.add('active'); }
+function hideLoading(){ loadingSpinner.classList.remove('active'); }
+function seek(seconds) {
+    video.currentTime = Math.max(0, Math.min(video.currentTime + seconds, video.duration));
+    showSeekFeedback(seconds > 0 ? `⏩ +${seconds}s` : `⏪ ${seconds}s`);
+}
+function showSeekFeedback(text) {
+    seekFeedback.textContent = text;
+    seekFeedback.classList.add('show');
+    setTimeout(() => seekFeedback.classList.remove('show'), 1000);
+}
+
+// ===== Controls init =====
+function initPlayer() {
+    // Video events - REMOVED the video click handler
+    video.addEventListener('play', () => {
+    playPauseBtn.innerHTML = '<i class="fas fa-pause"></i>';
+    bigPlayBtn.innerHTML = '<i class="fas fa-pause"></i>'; // Change to pause icon
+    bigPlayBtn.classList.add('hidden');
+});
+
+video.addEventListener('pause', () => {
+    playPauseBtn.innerHTML = '<i class="fas fa-play"></i>';
+    bigPlayBtn.innerHTML = '<i class="fas fa-play"></i>'; // Change back to play icon
+    bigPlayBtn.classList.remove('hidden');
+});
+
+    // Only allow play/pause through these controls:
+    playPauseBtn.addEventListener('click', togglePlay);
+
+    videoContainer.addEventListener('click', function(e) {
+    // Get container dimensions
+    const rect = videoContainer.getBoundingClientRect();
+    const centerX = rect.width / 2;
+    const centerY = rect.height / 2;
+
+    // Calculate click position relative to center
+    const clickX = e.clientX - rect.left;
+    const clickY = e.clientY - rect.top;
+
+    // Define center area (adjust these values as needed)
+    const centerAreaWidth = rect.width * 0.6;  // 60% of width
+    const centerAreaHeight = rect.height * 0.6; // 60% of height
+
+    // Check if click is in center area
+    if (Math.abs(clickX - centerX) < centerAreaWidth/2 &&
+        Math.abs(clickY - centerY) < centerAreaHeight/2) {
+        // Toggle play/pause
+        if (video.paused) {
+            video.play();
+        } else {
+            video.pause();
+        }
+    }
+});
+    video.addEventListener('timeupdate', updateProgress);
+    video.addEventListener('durationchange', () => {
+        durationEl.textContent = formatTime(video.duration);
+    });
+    video.addEventListener('waiting', showLoading);
+    video.addEventListener('playing', hideLoading);
+    video.addEventListener('seeking', showLoading);
+    video.addEventListener('seeked', hideLoading);
+    video.addEventListener('ended', () => {
+        playPauseBtn.innerHTML = '<i class="fas fa-play"></i>';
+        bigPlayBtn.classList.remove('hidden');
+    });
+
+    // UI
+    playPauseBtn.addEventListener('click', togglePlay);
+    bigPlayBtn.addEventListener('click', togglePlay);
+    progressContainer.addEventListener('click', setProgress);
+    volumeBtn.addEventListener('click', toggleMute);
+    volumeSlider.addEventListener('input', setVolume);
+    fullscreenBtn.addEventListener('click', toggleFullscreen);
+    speedChips.forEach(chip => chip.addEventListener('click', () => changeSpeed(chip.dataset.speed)));
+    speedSelect.addEventListener('change', function(){ changeSpeed(this.value); });
+}
+
+// ===== Load video =====
+function loadVideo(url, title) {
+    if (hls) { hls.destroy(); hls = null; }
+    video.pause(); video.removeAttribute('src'); video.load();
+
+    url = url.replace(".app", ".com");
+
+    if (Hls.isSupported()) {
+        hls = new Hls({ enableWorker: true });
+        hls.loadSource(url);
+        hls.attachMedia(video);
+        hls.on(Hls.Events.MANIFEST_PARSED, function(event, data) {
+            levels = data.levels;
+            video.play();
+            document.title = `${title} | ${document.title}`;
+        });
+                hls.on(Hls.Events.MANIFEST_PARSED, function(event, data) {
+            levels = data.levels;
+            updateQualityOptions();
+            video.play();
+            document.title = `${title} | ${document.title}`;
+        });
+    } else if (video.canPlayType('application/vnd.apple.mpegurl')) {
+        video.src = url;
+        video.addEventListener('loadedmetadata', function() {
+            updateQualityOptions();
+            video.play();
+            document.title = `${title} | ${document.title}`;
+        }, { once: true });
+    }
+}
+
+// ===== Init =====
+initPlayer();
+video.volume = volumeSlider.value;
+updateVolumeIcon();
+const savedSpeed = localStorage.getItem('playbackSpeed') || '1';
+changeSpeed(savedSpeed);
+
+// Mobile double tap seek
+videoContainer.addEventListener('touchend', function(e) {
+    const now = Date.now();
+    if (now - lastTap < 300) {
+        const rect = videoContainer.getBoundingClientRect();
+        const x = e.changedTouches[0].clientX - rect.left;
+        if (x > rect.width/2) seek(10);
+        else seek(-10);
+        e.preventDefault();
+    }
+    lastTap = now;
+});
+
+// Keyboard shortcuts
+document.addEventListener('keydown', function(e) {
+    if (e.code === 'Space' || e.code === 'KeyK') { e.preventDefault(); togglePlay(); }
+    if (e.code === 'ArrowRight' || e.code === 'KeyL') { e.preventDefault(); seek(5); }
+    if (e.code === 'ArrowLeft' || e.code === 'KeyJ') { e.preventDefault(); seek(-5); }
+    if (e.code === 'KeyF') { e.preventDefault(); toggleFullscreen(); }
+    if (e.code === 'KeyM') { e.preventDefault(); toggleMute(); }
+});